@@ -0,0 +1,86 @@
+# Measures how much the interruption checker slows down the main loop, with the checker as a process of its own (the
+# default) and as a thread of the main process (--low-memory), where it shares the GIL with the main loop.
+#
+# Frames of noise are written to the shared audio ring in real time, 512 samples every 32ms, and main's work on each
+# frame (features, VAD and the interruption check) is timed, together with how late the loop woke up for it. The
+# checker is measured idle, between replies, and listening, forced by sending it the "listen" message directly. The echo
+# check is enabled here, since while it's disabled no checker is started at all. Run it from the bmo folder, on the
+# Raspberry Pi for realistic numbers:
+#
+#   python benchmarks/interruption_check_lag.py
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from lib.audio_features import extract_features
+import lib.interruption_detection
+from lib.interruption_detection import InterruptionDetection
+from lib.shared_audio import SharedAudioRing
+from lib.voice_activity_detection import VoiceActivityDetector
+
+frame_length = 512
+frame_duration = frame_length / 16000
+
+
+def measure(in_thread: bool, listen: bool, seconds: float):
+    shared_audio = SharedAudioRing(frame_length, 256)
+    interruption_detection = InterruptionDetection(shared_audio, in_thread=in_thread)
+    vad = VoiceActivityDetector()
+    if listen:
+        interruption_detection.interruption_check_in_queue.put(
+            ("listen", interruption_detection.generation, 0.0)
+        )
+
+    rng = np.random.default_rng(0)
+    frames = [rng.normal(0, 200, frame_length).astype(np.int16) for _ in range(64)]
+    wake_up_lags = []
+    frame_times = []
+    next_frame_at = time.perf_counter()
+    for i in range(int(seconds / frame_duration)):
+        next_frame_at += frame_duration
+        delay = next_frame_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        started_at = time.perf_counter()
+        wake_up_lags.append(started_at - next_frame_at)
+
+        pcm = frames[i % len(frames)]
+        shared_audio.write(pcm)
+        features = extract_features(pcm)
+        interruption_detection.check_for_interruption(not vad.is_speech(features))
+        frame_times.append(time.perf_counter() - started_at)
+
+    interruption_detection.shutdown()
+    shared_audio.close()
+
+    wake_up_lags_ms = np.array(wake_up_lags) * 1000
+    frame_times_ms = np.array(frame_times) * 1000
+    print(
+        f"{'thread' if in_thread else 'process':<8} {'listening' if listen else 'idle':<10}"
+        f"wake up lag p50 {np.percentile(wake_up_lags_ms, 50):.2f}ms p99 {np.percentile(wake_up_lags_ms, 99):.2f}ms, "
+        f"frame work p50 {np.percentile(frame_times_ms, 50):.2f}ms p99 {np.percentile(frame_times_ms, 99):.2f}ms "
+        f"max {frame_times_ms.max():.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the main loop lag with the interruption checker as a process and as a thread"
+    )
+    parser.add_argument("--seconds", type=float, default=10.0, help="of audio per run")
+    cli_args = parser.parse_args()
+
+    lib.interruption_detection.echo_check_enabled = True
+    for in_thread in [False, True]:
+        for listen in [False, True]:
+            measure(in_thread, listen, cli_args.seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# Measures the real time factor of the local speech recognition engines: seconds spent transcribing per second of
+# audio, below 1.0 the engine keeps up with the user speaking. It's also how long the last chunk takes, which is what
+# the user waits for after they stop talking.
+#
+# The sample is cut in chunks like the ones sent while listening, 1s of new audio plus the overlap, and transcribed one
+# after the other, each primed with the end of the text so far, as much of it as the engines get while listening. An
+# engine whose optional package is not installed is skipped, saying what to install. Run it from the bmo folder, on
+# the Raspberry Pi for realistic numbers, tuning faster-whisper through the environment:
+#
+#   python benchmarks/speech_recognition_rtf.py
+#   FASTER_WHISPER_MODEL=small FASTER_WHISPER_BEAM_SIZE=5 python benchmarks/speech_recognition_rtf.py
+
+import argparse
+import importlib.util
+import os
+import statistics
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+from lib.replay import load_audio_file
+import lib.speech_recognition as speech_recognition
+from lib.speech_recognition.incremental_transcription import (
+    IncrementalTranscription,
+    max_prompt_characters,
+    overlap,
+    sample_rate,
+    stitch,
+)
+
+chunk_bytes = sample_rate * 2  # 1s of new audio per flush, like main
+# engine -> (module, pip package) of the engines that need an optional package
+optional_engines = {
+    "faster-whisper": ("faster_whisper", "faster-whisper"),
+    "lightning-whisper-mlx": ("lightning_whisper_mlx", "lightning-whisper-mlx"),
+}
+
+
+def missing_package(engine: str) -> Optional[str]:
+    if engine not in optional_engines:
+        return None
+    module, package = optional_engines[engine]
+    return package if importlib.util.find_spec(module) is None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the real time factor of a speech recognition engine"
+    )
+    parser.add_argument("audio_file", nargs="?", default="static/sample_long_audio.mp3")
+    parser.add_argument(
+        "-sr",
+        "--speech-recognition",
+        dest="speech_recognition",
+        choices=speech_recognition.ENGINES.keys(),
+        default="faster-whisper",
+    )
+    cli_args = parser.parse_args()
+
+    package = missing_package(cli_args.speech_recognition)
+    if package is not None:
+        print(
+            f"Skipping {cli_args.speech_recognition}, run `pip install {package}` to benchmark it"
+        )
+        return
+
+    pcm = load_audio_file(cli_args.audio_file).tobytes()
+    chunks = [
+        pcm[max(start - overlap, 0) : start + chunk_bytes]
+        for start in range(0, len(pcm), chunk_bytes)
+    ]
+    audio_seconds = len(pcm) / (sample_rate * 2)
+
+    engine_class = speech_recognition.ENGINES[cli_args.speech_recognition]
+    if not issubclass(engine_class, IncrementalTranscription):
+        parser.error(f"{cli_args.speech_recognition} doesn't transcribe in chunks")
+    engine = engine_class()
+    # waits for the model to load, and warms it up
+    engine.transcribe_chunk(chunks[0], "", None)
+
+    text = ""
+    language = None
+    chunk_times = []
+    cpu_start = time.process_time()
+    for chunk in chunks:
+        started_at = time.perf_counter()
+        chunk_text, detected_language = engine.transcribe_chunk(
+            chunk, text[-max_prompt_characters:], language
+        )
+        chunk_times.append(time.perf_counter() - started_at)
+        language = language or detected_language
+        text = stitch(text, chunk_text.strip())
+    cpu_time = time.process_time() - cpu_start
+
+    print(text)
+    print(
+        f"{cli_args.speech_recognition}: {audio_seconds:.1f}s of audio in {len(chunks)} chunks, "
+        f"real time factor {sum(chunk_times) / audio_seconds:.2f} "
+        f"({cpu_time / audio_seconds:.2f} CPU-seconds per second of audio), "
+        f"per chunk p50 {statistics.median(chunk_times) * 1000:.0f}ms, max {max(chunk_times) * 1000:.0f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
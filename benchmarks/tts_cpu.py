@@ -0,0 +1,64 @@
+# Measures how much CPU the reply process burns per second of speech with a given TTS engine, the busy waits while
+# sentences are synthesized and played used to pin a whole core on the Raspberry Pi.
+#
+# Run it from the bmo folder, on two revisions to compare them:
+#
+#   python benchmarks/tts_cpu.py -tts native
+
+import argparse
+from multiprocessing import Queue
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+import lib.text_to_speech as text_to_speech
+
+sentences = [
+    "Hey there, good to hear from you again.",
+    "I was just thinking about that trip we talked about last week,",
+    "the one to the mountains, remember?",
+    "Honestly, I think you should go for it, the weather looks great.",
+    "Just don't forget to pack a jacket, it gets cold at night.",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure CPU time per second of speech for a TTS engine"
+    )
+    parser.add_argument(
+        "-tts",
+        "--text-to-speech",
+        dest="text_to_speech",
+        choices=text_to_speech.ENGINES.keys(),
+        default="native",
+    )
+    cli_args = parser.parse_args()
+
+    reply_in_queue: Queue = Queue()
+    reply_out_queue: Queue = Queue()
+    tts = text_to_speech.ENGINES[cli_args.text_to_speech](
+        reply_in_queue, reply_out_queue
+    )
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for sentence in sentences:
+        tts.consume(sentence)
+    tts.wait_to_finish()
+    cpu_time = time.process_time() - cpu_start
+    wall_time = time.perf_counter() - wall_start
+
+    print(
+        f"{cli_args.text_to_speech}: {wall_time:.2f}s of speech, {cpu_time:.2f}s of CPU in this process, "
+        f"{cpu_time / wall_time:.3f} CPU-seconds per second of speech"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Compares the codecs the transcription audio can be uploaded with: how long encoding takes, how many bytes it saves
+# compared to WAV, and, with --transcribe, the end to end latency of transcribing each chunk through the Whisper API.
+#
+# The sample is cut in chunks like the ones sent while listening, 1s of new audio plus the overlap. Run it from the
+# bmo folder, on the Raspberry Pi for realistic encode times:
+#
+#   python benchmarks/upload_codecs.py
+#   python benchmarks/upload_codecs.py --transcribe static/sample_long_audio.mp3
+
+import argparse
+from io import BytesIO
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from dotenv import load_dotenv
+
+load_dotenv()
+from lib.replay import load_audio_file
+import lib.speech_recognition.audio_codecs as audio_codecs
+from lib.speech_recognition.incremental_transcription import overlap
+
+chunk_samples = audio_codecs.sample_rate  # 1s of new audio per flush, like main
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure encode time, bytes saved and transcription latency per upload codec"
+    )
+    parser.add_argument("audio_file", nargs="?", default="static/sample_long_audio.mp3")
+    parser.add_argument(
+        "--transcribe",
+        action="store_true",
+        help="Also send every chunk to the Whisper API and measure the end to end latency",
+    )
+    cli_args = parser.parse_args()
+
+    pcm = load_audio_file(cli_args.audio_file).tobytes()
+    chunks = [
+        pcm[max(start - overlap, 0) : start + chunk_samples * 2]
+        for start in range(0, len(pcm), chunk_samples * 2)
+    ]
+    chunks = [chunk for chunk in chunks if len(chunk) >= audio_codecs.sample_rate // 5]
+
+    if cli_args.transcribe:
+        from lib.speech_recognition.whisper_api import openai
+
+    wav_bytes = sum(len(audio_codecs.encode(chunk, "wav").data) for chunk in chunks)
+    print(
+        f"{len(chunks)} chunks of ~{chunk_samples / audio_codecs.sample_rate + overlap / 32000:.1f}s"
+    )
+    for codec in audio_codecs.codecs:
+        encode_times = []
+        total_bytes = 0
+        latencies = []
+        for chunk in chunks:
+            encoded = audio_codecs.encode(chunk, codec)
+            encode_times.append(encoded.encode_time)
+            total_bytes += len(encoded.data)
+
+            if cli_args.transcribe:
+                audio_file = BytesIO(encoded.data)
+                audio_file.name = encoded.filename
+                started_at = time.perf_counter()
+                openai().audio.transcriptions.create(model="whisper-1", file=audio_file)
+                latencies.append(encoded.encode_time + time.perf_counter() - started_at)
+
+        line = (
+            f"{codec:>5}: encode {statistics.mean(encode_times) * 1000:6.1f}ms/chunk, "
+            f"{total_bytes / 1024:7.1f}KB ({100 * (1 - total_bytes / wav_bytes):3.0f}% saved)"
+        )
+        if latencies:
+            line += (
+                f", end to end p50 {statistics.median(latencies) * 1000:.0f}ms, "
+                f"max {max(latencies) * 1000:.0f}ms"
+            )
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
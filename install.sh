@@ -5,7 +5,7 @@ set -eo pipefail
 if [ "$(uname)" == "Darwin" ]; then
   brew install libunistring sdl2
 else
-  sudo apt-get install -y libsdl2-dev espeak-ng
+  sudo apt-get install -y libsdl2-dev libportaudio2 espeak-ng
 fi
 
 pip install -r requirements.txt
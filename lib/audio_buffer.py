@@ -0,0 +1,66 @@
+from typing import Optional
+import numpy as np
+
+# Fixed-capacity ring buffer for the int16 audio captured while listening.
+#
+# Every sample is stored twice, at position `i` and again at `i + size`, so any window of up to `size` samples is a
+# single contiguous slice of the backing array. That gives O(1) drop-oldest (we only move the length) and lets
+# snapshots be read-only NumPy views instead of copies.
+#
+# A snapshot stays valid until the ring wraps around onto it, which takes at least `headroom` samples of new audio,
+# so consumers that hold on to a snapshot for a while (like the transcription threads) should get some headroom.
+
+
+class AudioBuffer:
+    capacity: int
+    size: int
+    samples: np.ndarray
+    written: int
+    length: int
+
+    def __init__(self, capacity: int, headroom: int = 0) -> None:
+        self.capacity = capacity
+        self.size = capacity + headroom
+        self.samples = np.zeros(self.size * 2, dtype=np.int16)
+        self.written = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def extend(self, pcm):
+        pcm = np.asarray(pcm, dtype=np.int16)
+        if len(pcm) > self.size:
+            pcm = pcm[-self.size :]
+        n = len(pcm)
+
+        start = self.written % self.size
+        first = min(n, self.size - start)
+        self.samples[start : start + first] = pcm[:first]
+        self.samples[start + self.size : start + self.size + first] = pcm[:first]
+        rest = n - first
+        if rest > 0:
+            self.samples[:rest] = pcm[first:]
+            self.samples[self.size : self.size + rest] = pcm[first:]
+
+        self.written += n
+        self.length = min(self.length + n, self.capacity)
+
+    def keep_last(self, n_samples: int):
+        self.length = max(min(self.length, n_samples), 0)
+
+    def drop_oldest(self, n_samples: int):
+        self.length = max(self.length - n_samples, 0)
+
+    def clear(self):
+        self.length = 0
+
+    def snapshot(self, n_samples: Optional[int] = None) -> np.ndarray:
+        n = self.length if n_samples is None else max(min(n_samples, self.length), 0)
+        start = (self.written - n) % self.size
+        view = self.samples[start : start + n]
+        view.flags.writeable = False
+        return view
+
+    def snapshot_bytes(self, n_samples: Optional[int] = None) -> memoryview:
+        return memoryview(self.snapshot(n_samples)).cast("B")
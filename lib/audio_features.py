@@ -0,0 +1,67 @@
+from typing import Dict, Iterable, NamedTuple
+import numpy as np
+
+# Frame ingest: every PvRecorder frame is converted to an int16 array exactly once here, and all the per-frame
+# measurements the rest of the pipeline needs (VAD, interruption detection, status line) are computed in a single
+# vectorized pass, so nobody has to rebuild arrays from the raw Python list again.
+
+sample_rate = 16000  # same as from main
+# Hz, where most of the voice energy is, above mains hum and rumble
+speech_band = (200, 4000)
+
+_speech_band_masks: Dict[int, np.ndarray] = {}
+
+
+class FrameFeatures(NamedTuple):
+    pcm: np.ndarray  # read-only int16 samples
+    rms: float
+    peak: float
+    zero_crossing_rate: float  # sign changes per sample, 0..1
+    speech_band_rms: float  # rms of the speech band only, same scale as rms
+    speech_band_ratio: float  # share of the frame energy inside the speech band, 0..1
+
+
+def speech_band_mask(n_samples: int) -> np.ndarray:
+    mask = _speech_band_masks.get(n_samples)
+    if mask is None:
+        frequencies = np.fft.rfftfreq(n_samples, d=1 / sample_rate)
+        mask = (frequencies >= speech_band[0]) & (frequencies <= speech_band[1])
+        _speech_band_masks[n_samples] = mask
+    return mask
+
+
+def extract_features(pcm) -> FrameFeatures:
+    samples = np.array(pcm, dtype=np.int16)
+    samples.flags.writeable = False
+    n_samples = len(samples)
+    if n_samples < 2:
+        return FrameFeatures(samples, 0.0, 0.0, 0.0, 0.0, 0.0)
+
+    x = samples.astype(np.float32)
+    power = float(np.dot(x, x)) / n_samples
+    signs = np.signbit(x)
+    zero_crossings = np.count_nonzero(signs[1:] != signs[:-1])
+
+    spectrum = np.abs(np.fft.rfft(x)) ** 2
+    spectrum_total = float(spectrum[1:].sum())
+    speech_band_energy = float(spectrum[speech_band_mask(n_samples)].sum())
+    # Parseval: the one-sided spectrum carries about half of N * sum(x ** 2)
+    speech_band_power = 2 * speech_band_energy / (n_samples * n_samples)
+
+    return FrameFeatures(
+        pcm=samples,
+        rms=float(np.sqrt(power)),
+        peak=float(np.abs(x).max()),
+        zero_crossing_rate=float(zero_crossings / (n_samples - 1)),
+        speech_band_rms=float(np.sqrt(speech_band_power)),
+        speech_band_ratio=(
+            speech_band_energy / spectrum_total if spectrum_total > 0 else 0.0
+        ),
+    )
+
+
+def combined_rms(features: Iterable[FrameFeatures]) -> float:
+    rms_values = np.array([f.rms for f in features], dtype=np.float64)
+    if len(rms_values) == 0:
+        return 0.0
+    return float(np.sqrt(np.mean(rms_values**2)))
@@ -1,33 +1,64 @@
 import argparse
+import queue
 import re
 from multiprocessing import Process, Queue
 from multiprocessing.sharedctypes import Synchronized
 import os
+import threading
+from threading import Thread
 import time
-from typing import Any, Iterable, List, Optional, cast
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
 from typing_extensions import Literal, TypedDict
 
 from openai import OpenAI
 from openai.types.chat import ChatCompletionMessageParam
-from groq import Groq
 
 from lib.text_to_speech import TextToSpeech
+import lib.http_transport as http_transport
 import lib.delta_logging as delta_logging
 from lib.delta_logging import logging, log_formatter
+import lib.latency_tracing as latency_tracing
+from lib.per_process import per_process
+from lib.sentence_segmenter import SentenceSegmenter
+from lib.reply_events import AssistantMessage, ReplyEvent
 import lib.text_to_speech as text_to_speech
+import lib.text_to_speech.audio_output as audio_output
 
 logger = logging.getLogger()
 
-openai = OpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
+openai_api_key = os.environ["OPENAI_API_KEY"]
+openai = per_process(
+    lambda: OpenAI(api_key=openai_api_key, http_client=http_transport.http_client())
 )
-groq: Optional[Groq] = None
-if os.environ.get("GROQ_API_KEY"):
-    groq = Groq(
+http_transport.register("https://api.openai.com/v1")
+
+
+def create_groq():
+    from groq import Groq  # only imported when it's going to be used
+
+    return Groq(
         api_key=os.environ.get("GROQ_API_KEY"),
+        http_client=http_transport.http_client(),
     )
 
 
+groq: Optional[Callable[[], Any]] = None
+if os.environ.get("GROQ_API_KEY"):
+    groq = per_process(create_groq)
+    http_transport.register("https://api.groq.com")
+
+
 class Message(TypedDict):
     role: Literal["system", "user", "assistant"]
     content: str
@@ -58,163 +89,509 @@ prompt = (
 
 initial_message: Message = {"role": "system", "content": prompt}
 
+summary_prompt = (
+    "Summarize the conversation below between a user and a voice assistant in a few short sentences, "
+    "keeping names, facts, plans and anything the assistant promised, so it can carry on the conversation "
+    "without the full history. Write it in the language of the conversation."
+)
+
+
+def summarize_conversation(
+    conversation: Conversation, previous_summary: Optional[str]
+) -> str:
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in conversation)
+    if previous_summary:
+        transcript = f"Summary of what came before: {previous_summary}\n{transcript}"
+
+    response = openai().chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": summary_prompt},
+            {"role": "user", "content": transcript},
+        ],
+        timeout=15,
+    )
+    return (response.choices[0].message.content or "").strip()
+
+
+# Replies run on long-lived worker processes, so no turn pays for spawning a process and importing everything again.
+#
+# The main process talks to a worker through its control queue, with ("reply", turn_id, conversation),
+# ("speak", turn_id, text) for replies that are already known, like the ones from the reply cache, and
+# ("cancel", turn_id) messages, plus ("prewarm",) to open the HTTP connections the next turn will need. Every event
+# coming back is tagged with the turn it belongs to, so events from a cancelled turn can simply be ignored. There are
+# always two workers, the active one and a warm spare: when a reply gets cancelled the workers swap, so the next turn
+# never waits for the cancelled one to wind down.
+#
+# In speculative mode, ("speculate", turn_id, conversation) starts streaming a reply to a partial transcript while the
+# user is still pausing. It runs on its own thread and only collects the sentences, nothing is spoken nor sent back
+# until main confirms it with ("commit", turn_id), which turns it into a regular turn, or drops it with a cancel.
+
+
+class ReplyWorker:
+    process: Process
+    control_queue: Queue
+
+    def __init__(self, cli_args: argparse.Namespace, reply_out_queue: Queue) -> None:
+        self.control_queue = Queue()
+        self.process = Process(
+            target=ChatGPT.reply_loop,
+            args=(
+                cli_args,
+                self.control_queue,
+                reply_out_queue,
+                log_formatter.start_time,
+                latency_tracing.trace_queue,
+                audio_output.worker_channel(),
+            ),
+            daemon=True,
+        )
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def send(self, message: Tuple[Any, ...]):
+        self.control_queue.put(message)
+
+    def shutdown(self):
+        self.process.terminate()
+
+
+class TurnQueue:
+    """Tags everything the TTS engine puts on the reply queue with the turn it belongs to"""
+
+    reply_out_queue: Queue
+    turn_id: int
+
+    def __init__(self, reply_out_queue: Queue) -> None:
+        self.reply_out_queue = reply_out_queue
+        self.turn_id = -1
+
+    def put(self, event: ReplyEvent):
+        self.reply_out_queue.put((self.turn_id, event))
+
+
+class ReplyTurns:
+    """Worker side bookkeeping of which turn is running and which ones got cancelled before they started"""
+
+    lock: threading.Lock
+    turn_id: Optional[int]
+    tts_in_queue: "queue.Queue[str]"
+    cancelled: threading.Event
+    cancelled_turns: Set[int]
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.turn_id = None
+        self.tts_in_queue = queue.Queue()
+        self.cancelled = threading.Event()
+        self.cancelled_turns = set()
+
+    def begin(self, turn_id: int, tts_in_queue: "queue.Queue[str]") -> bool:
+        with self.lock:
+            if turn_id in self.cancelled_turns:
+                self.cancelled_turns.discard(turn_id)
+                return False
+            self.cancelled_turns = {t for t in self.cancelled_turns if t > turn_id}
+            self.turn_id = turn_id
+            self.tts_in_queue = tts_in_queue
+            self.cancelled = threading.Event()
+            return True
+
+    def end(self):
+        with self.lock:
+            self.turn_id = None
+
+    def cancel(self, turn_id: int):
+        with self.lock:
+            if self.turn_id == turn_id:
+                self.cancelled.set()
+                self.tts_in_queue.put("stop")
+            else:
+                self.cancelled_turns.add(turn_id)
+
+
+class SpeculativeReply:
+    """A reply streamed ahead of the end of the user speech, held back until it's committed or cancelled"""
+
+    condition: threading.Condition
+    sentences: List[str]
+    message: Optional[Message]
+    error: Optional[Exception]
+    cancelled: threading.Event
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.sentences = []
+        self.message = None
+        self.error = None
+        self.cancelled = threading.Event()
+
+    def add(self, sentence: str):
+        with self.condition:
+            self.sentences.append(sentence)
+            self.condition.notify_all()
+
+    def finish(self, message: Message):
+        with self.condition:
+            self.message = message
+            self.condition.notify_all()
+
+    def fail(self, error: Exception):
+        with self.condition:
+            self.error = error
+            self.condition.notify_all()
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def follow(self) -> Iterator[str]:
+        """Yields the sentences already streamed and then the rest as they arrive"""
+        index = 0
+        while True:
+            with self.condition:
+                while (
+                    index >= len(self.sentences)
+                    and self.message is None
+                    and self.error is None
+                    and not self.cancelled.is_set()
+                ):
+                    self.condition.wait()
+                if index < len(self.sentences):
+                    sentence = self.sentences[index]
+                    index += 1
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    return
+            yield sentence
+
 
 class ChatGPT:
     cli_args: argparse.Namespace
-    reply_process: Process
-    tts_reply_in_queue: Queue
-    reply_in_queue: Queue
     reply_out_queue: Queue
+    workers: List[ReplyWorker]  # active first, then the warm spare
+    turn_id: int
+    turn_worker: ReplyWorker  # where the current turn runs
+    last_turn_id: int
+    speculations: Dict[int, ReplyWorker]
 
     def __init__(self, cli_args: argparse.Namespace) -> None:
         self.cli_args = cli_args
         self.start()
 
     def start(self):
-        self.tts_reply_in_queue = Queue()
-        self.reply_in_queue = Queue()
         self.reply_out_queue = Queue()
-        self.reply_process = Process(
-            target=ChatGPT.reply_loop,
-            args=(
-                self.cli_args,
-                self.tts_reply_in_queue,
-                self.reply_in_queue,
-                self.reply_out_queue,
-                log_formatter.start_time,
-            ),
-        )
-        self.reply_process.start()
+        self.turn_id = 0
+        self.last_turn_id = 0
+        self.speculations = {}
+        self.workers = [
+            ReplyWorker(self.cli_args, self.reply_out_queue),
+            ReplyWorker(self.cli_args, self.reply_out_queue),
+        ]
+        self.turn_worker = self.workers[0]
 
     def stop(self):
-        if self.reply_process.is_alive():
-            self.tts_reply_in_queue.put("stop")
-            self.reply_out_queue.put(("reply_audio_ended", None))
-            # self.reply_process.terminate()
+        self.turn_worker.send(("cancel", self.turn_id))
+        self.turn_id = self.next_turn_id()
+
+    def next_turn_id(self) -> int:
+        self.last_turn_id += 1
+        return self.last_turn_id
 
     def restart(self):
         self.stop()
-        self.start()
+        # the cancelled worker may still be winding down its turn, so the next one goes to the warm spare
+        active, spare = self.workers
+        if not spare.is_alive():
+            logger.warning("Spare reply worker died, starting a new one")
+            spare = ReplyWorker(self.cli_args, self.reply_out_queue)
+        self.workers = [spare, active]
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown()
+        # wakes main's reply event pump up, so it returns instead of waiting on this queue forever
+        self.reply_out_queue.put((self.turn_id, None))
+
+    def prewarm(self):
+        for worker in self.workers:
+            worker.send(("prewarm",))
 
     def reply(self, conversation: Conversation):
-        self.reply_in_queue.put(conversation)
-
-    def get(self, block: bool):
-        return self.reply_out_queue.get(block=block)
+        self.send_turn("reply", conversation)
+
+    def speak(self, text: str):
+        self.send_turn("speak", text)
+
+    def send_turn(self, kind: Literal["reply", "speak"], payload: Any):
+        self.turn_id = self.next_turn_id()
+        self.turn_worker = self.active_worker()
+        self.turn_worker.send((kind, self.turn_id, payload))
+
+    def speculate(self, conversation: Conversation) -> int:
+        turn_id = self.next_turn_id()
+        worker = self.active_worker()
+        worker.send(("speculate", turn_id, conversation))
+        self.speculations[turn_id] = worker
+        return turn_id
+
+    def commit_speculation(self, turn_id: int):
+        self.turn_id = turn_id
+        self.turn_worker = self.speculations.pop(turn_id)
+        self.turn_worker.send(("commit", turn_id))
+
+    def cancel_speculation(self, turn_id: int):
+        worker = self.speculations.pop(turn_id, None)
+        if worker is not None:
+            worker.send(("cancel", turn_id))
+
+    def active_worker(self) -> ReplyWorker:
+        if not self.workers[0].is_alive():
+            logger.warning("Reply worker died, starting a new one")
+            self.workers[0] = ReplyWorker(self.cli_args, self.reply_out_queue)
+        return self.workers[0]
+
+    def get(
+        self, block: bool, timeout: Optional[float] = None
+    ) -> Tuple[int, Optional[ReplyEvent]]:
+        return self.reply_out_queue.get(block=block, timeout=timeout)
 
     @classmethod
     def reply_loop(
         cls,
         cli_args: argparse.Namespace,
-        tts_reply_in_queue: Queue,
-        reply_in_queue: Queue,
+        control_queue: Queue,
         reply_out_queue: Queue,
         start_time: Synchronized,
+        trace_queue: Optional[Queue],
+        output_channel: audio_output.WorkerChannel,
     ):
         log_formatter.start_time = start_time
+        latency_tracing.trace_queue = trace_queue
+        audio_output.channel = output_channel
+
+        pending_turns: "queue.Queue[Tuple[str, int, Any]]" = queue.Queue()
+        turns = ReplyTurns()
+        speculations: Dict[int, SpeculativeReply] = {}
+        min_words = text_to_speech.ENGINES[cli_args.text_to_speech].min_words
+        listener = Thread(
+            target=ChatGPT.listen_for_control,
+            args=(control_queue, pending_turns, turns, speculations, min_words),
+            daemon=True,
+        )
+        listener.start()
+        text_to_speech.preload("error.mp3")
+
+        # the TTS engine for the next turn is always built ahead of time
+        tts_in_queue: "queue.Queue[str]" = queue.Queue()
+        turn_queue = TurnQueue(reply_out_queue)
         tts = text_to_speech.ENGINES[cli_args.text_to_speech](
-            tts_reply_in_queue, reply_out_queue
+            tts_in_queue, turn_queue  # type: ignore
         )
         while True:
+            kind, turn_id, payload = pending_turns.get()
+            if not turns.begin(turn_id, tts_in_queue):
+                continue
+
+            turn_queue.turn_id = turn_id
             try:
-                conversation = reply_in_queue.get(block=True)
-                ChatGPT.non_blocking_reply(conversation, tts, reply_out_queue)
-                tts = text_to_speech.ENGINES[cli_args.text_to_speech](
-                    tts_reply_in_queue, reply_out_queue
-                )
+                if kind == "speak":
+                    ChatGPT.speak_known_reply(payload, tts, turn_queue)  # type: ignore
+                elif kind == "commit":
+                    ChatGPT.speak_speculative_reply(payload, tts, turn_queue)  # type: ignore
+                else:
+                    ChatGPT.non_blocking_reply(
+                        payload, tts, turn_queue, turns.cancelled  # type: ignore
+                    )
             except Exception:
                 logging.exception("Exception thrown in reply")
-                text_to_speech.play_audio_file("error.mp3", reply_out_queue)
+                tts.stop()
+                text_to_speech.play_audio_file("error.mp3", turn_queue)  # type: ignore
+            finally:
+                turns.end()
+                speculations.pop(turn_id, None)
+            http_transport.log_stats("reply worker")
+
+            tts_in_queue = queue.Queue()
+            turn_queue = TurnQueue(reply_out_queue)
+            tts = text_to_speech.ENGINES[cli_args.text_to_speech](
+                tts_in_queue, turn_queue  # type: ignore
+            )
+
+    @classmethod
+    def listen_for_control(
+        cls,
+        control_queue: Queue,
+        pending_turns: "queue.Queue[Tuple[str, int, Any]]",
+        turns: ReplyTurns,
+        speculations: Dict[int, SpeculativeReply],
+        min_words: int,
+    ):
+        while True:
+            message = control_queue.get()
+            if message[0] in ["reply", "speak"]:
+                pending_turns.put(message)
+            elif message[0] == "speculate":
+                _, turn_id, conversation = message
+                speculation = SpeculativeReply()
+                speculations[turn_id] = speculation
+                thread = Thread(
+                    target=ChatGPT.speculate_reply,
+                    args=(conversation, min_words, speculation),
+                    daemon=True,
+                )
+                thread.start()
+            elif message[0] == "commit":
+                turn_id = message[1]
+                if turn_id in speculations:
+                    pending_turns.put(("commit", turn_id, speculations[turn_id]))
+            elif message[0] == "cancel":
+                turn_id = message[1]
+                if turn_id in speculations:
+                    speculations.pop(turn_id).cancel()
+                turns.cancel(turn_id)
+            elif message[0] == "prewarm":
+                http_transport.prewarm()
+
+    @classmethod
+    def speak_known_reply(cls, text: str, tts: TextToSpeech, reply_out_queue: Queue):
+        reply_out_queue.put(AssistantMessage({"role": "assistant", "content": text}))
+        segmenter = SentenceSegmenter(min_words=tts.min_words)
+        for sentence in segmenter.feed(text):
+            tts.consume(speechify(sentence))
+        tts.consume(speechify(segmenter.flush() or ""))
+        tts.wait_to_finish()
+
+    @classmethod
+    def speculate_reply(
+        cls, conversation: Conversation, min_words: int, speculation: SpeculativeReply
+    ):
+        try:
+            message = ChatGPT.stream_reply(
+                conversation,
+                min_words,
+                speculation.add,
+                speculation.cancelled,
+                speculative=True,
+            )
+            speculation.finish(message)
+        except Exception as err:
+            speculation.fail(err)
+
+    @classmethod
+    def speak_speculative_reply(
+        cls, speculation: SpeculativeReply, tts: TextToSpeech, reply_out_queue: Queue
+    ):
+        say = tts_consumer(tts)
+        for sentence in speculation.follow():
+            say(sentence)
+        if speculation.message is not None:
+            logger.info(
+                "Chat GPT reply (speculative): %s", speculation.message["content"]
+            )
+            reply_out_queue.put(AssistantMessage(speculation.message))
+        tts.wait_to_finish()
 
     @classmethod
     def non_blocking_reply(
-        cls, conversation: Conversation, tts: TextToSpeech, reply_out_queue: Queue
+        cls,
+        conversation: Conversation,
+        tts: TextToSpeech,
+        reply_out_queue: Queue,
+        cancelled: Optional[threading.Event] = None,
     ):
+        assistant_message = ChatGPT.stream_reply(
+            conversation, tts.min_words, tts_consumer(tts), cancelled
+        )
+        reply_out_queue.put(AssistantMessage(assistant_message))
+        tts.wait_to_finish()
+
+    @classmethod
+    def stream_reply(
+        cls,
+        conversation: Conversation,
+        min_words: int,
+        on_sentence: Callable[[str], None],
+        cancelled: Optional[threading.Event] = None,
+        speculative: bool = False,
+    ) -> Message:
         def chat_completion_create():
             if groq:
-                return groq.chat.completions.create(
+                return groq().chat.completions.create(
                     model="mixtral-8x7b-32768",
                     messages=cast(Any, conversation),
                     timeout=3,
                     stream=True,
                 )
-            return openai.chat.completions.create(
+            return openai().chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=cast(Any, conversation),
                 timeout=3,
                 stream=True,
             )
 
-        def flush_to_tts(next_sentence, split_token, join_token=""):
-            splitted = next_sentence.split(split_token)
-            to_say = join_token.join(splitted[:-1]).strip()
-            if len(to_say.split(" ")) >= tts.min_words:
-                next_sentence = splitted[-1]
-                tts.consume(speechify(to_say))
-            return next_sentence
-
         try:
             stream = chat_completion_create()
         except:
             # retry once
             stream = chat_completion_create()
 
-        full_message = ""
-        next_sentence = ""
+        segmenter = SentenceSegmenter(min_words=min_words)
+        full_message: List[str] = []
         first = True
 
         try:
             for response in stream:
+                if cancelled is not None and cancelled.is_set():
+                    stream.response.close()
+                    break
+
                 content = response.choices[0].delta.content
                 if not content:
                     continue
 
-                token = (
-                    content.replace("!", "!·")
-                    .replace("?", "?·")
-                    .replace(".", ".·")
-                    .replace(",", ",·")
-                    .replace("- ", "-· ")
-                    .replace("/ ", "/· ")
-                )
-                if first:
+                if speculative:
+                    pass  # not logged nor traced, it's not a turn yet and may never be
+                elif first:
+                    latency_tracing.mark("first_llm_delta")
                     delta_logging.handler.terminator = ""
-                    logger.info("Chat GPT reply: %s", token)
+                    logger.info("Chat GPT reply: %s", content)
                     delta_logging.handler.terminator = "\n"
                     first = False
                 else:
-                    print(token, end="", flush=True)
+                    print(content, end="", flush=True)
 
-                full_message += token
-                next_sentence += token
+                full_message.append(content)
+                for sentence in segmenter.feed(content):
+                    on_sentence(speechify(sentence))
 
-                if not groq and "·" in next_sentence:
-                    next_sentence = flush_to_tts(next_sentence, split_token="·")
-
-                if len(next_sentence.split(" ")) > (
-                    100 if groq else 20
-                ):  # flush if over 20 words already without stop points
-                    next_sentence = flush_to_tts(
-                        next_sentence, split_token=" ", join_token=" "
-                    )
-
-                if len(full_message.split(" ")) > (500 if groq else 100):
+                if segmenter.total_words > (500 if groq else 100):
                     break
         except Exception as e:
             if len(full_message) == 0:
                 raise e
-        print("")
+        if not speculative:
+            print("")
 
-        full_message = full_message.replace("·", "").strip()
-        assistant_message: Message = {
-            "role": "assistant",
-            "content": full_message,  # type: ignore
-        }
+        on_sentence(speechify(segmenter.flush() or ""))
+        return {"role": "assistant", "content": "".join(full_message).strip()}
 
-        reply_out_queue.put(("assistent_message", assistant_message))
 
-        tts.consume(speechify(next_sentence.replace("·", "").strip()))
-        tts.wait_to_finish()
+def tts_consumer(tts: TextToSpeech) -> Callable[[str], None]:
+    first_flush = True
+
+    def say(text: str):
+        nonlocal first_flush
+        if first_flush and text != "":
+            latency_tracing.mark("first_tts_flush")
+            first_flush = False
+        tts.consume(text)
+
+    return say
 
 
 def speechify(text: str):
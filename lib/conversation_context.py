@@ -0,0 +1,182 @@
+from functools import lru_cache
+import threading
+from threading import Thread
+from typing import TYPE_CHECKING, Callable, List, Optional
+import numpy as np
+
+from lib.delta_logging import logging
+
+if TYPE_CHECKING:
+    from lib.chatgpt import Conversation, Message
+
+try:
+    import tiktoken
+
+    tiktoken_available = True
+except ImportError:
+    tiktoken_available = False
+
+# Keeps what is sent to the LLM on every turn within a token budget, so long sessions don't get slower and more
+# expensive turn after turn.
+#
+# The full history is kept, but once the older turns go over a share of the budget they are folded into a rolling
+# summary by a background thread, so summarizing never sits on the reply path. Until the summary is ready, or if it
+# fails, the oldest turns are simply dropped from what is sent. The system prompt and the most recent turns are always
+# sent as they are.
+#
+# Tokens are counted with tiktoken when it is installed, falling back to an approximation of 4 characters per token,
+# and counts are cached since the same messages are counted again on every turn. The encoding is only loaded on the
+# first count, since tiktoken downloads it when it's not cached yet, and if that fails the approximation is used.
+#
+# Only the prompts actually sent for a turn go into the prompt token stats: speculative prompts are built with
+# `record=False` and recorded with `record_prompt()` only if their speculation is committed.
+
+logger = logging.getLogger()
+
+max_prompt_tokens = 2000
+summarize_over_tokens = 1200  # older turns are summarized once they go over this
+keep_recent_messages = 6  # the last 3 exchanges are never summarized nor dropped
+# role and separators overhead, as in OpenAI's token counting guide
+tokens_per_message = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding() -> Optional["tiktoken.Encoding"]:
+    if not tiktoken_available:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        logger.warning("Could not load the tiktoken encoding, approximating tokens")
+        return None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: "Message") -> int:
+    return count_tokens(message["content"]) + tokens_per_message
+
+
+class ConversationContext:
+    system_message: "Message"
+    history: "Conversation"
+    summary: Optional[str]
+    summarized_until: int  # history index up to which the summary covers
+    summarize: Optional[Callable[["Conversation", Optional[str]], str]]
+    summarizer: Optional[Thread]
+    lock: threading.Lock
+    prompt_tokens: List[int]
+
+    def __init__(
+        self,
+        system_message: "Message",
+        summarize: Optional[Callable[["Conversation", Optional[str]], str]] = None,
+    ) -> None:
+        self.system_message = system_message
+        self.history = []
+        self.summary = None
+        self.summarized_until = 0
+        self.summarize = summarize
+        self.summarizer = None
+        self.lock = threading.Lock()
+        self.prompt_tokens = []
+
+    def append(self, message: "Message"):
+        with self.lock:
+            self.history.append(message)
+        self.maybe_summarize()
+
+    def last(self) -> "Message":
+        with self.lock:
+            return self.history[-1] if self.history else self.system_message
+
+    def messages(self, record: bool = True) -> "Conversation":
+        with self.lock:
+            head: "Conversation" = [self.system_message]
+            if self.summary:
+                head.append(
+                    {
+                        "role": "system",
+                        "content": "Summary of the conversation so far: "
+                        + self.summary,
+                    }
+                )
+            recent = self.history[self.summarized_until :]
+
+        budget = max_prompt_tokens - sum(message_tokens(m) for m in head)
+        tokens = [message_tokens(m) for m in recent]
+        total = sum(tokens)
+        dropped = 0
+        while total > budget and len(recent) - dropped > keep_recent_messages:
+            total -= tokens[dropped]
+            dropped += 1
+
+        messages = head + recent[dropped:]
+        prompt_tokens = max_prompt_tokens - budget + total
+        if record:
+            self.prompt_tokens.append(prompt_tokens)
+        logger.info(
+            "Prompt: %d tokens, %d messages (%d summarized, %d dropped)",
+            prompt_tokens,
+            len(messages),
+            self.summarized_until,
+            dropped,
+        )
+        return messages
+
+    def record_prompt(self, conversation: "Conversation"):
+        self.prompt_tokens.append(sum(message_tokens(m) for m in conversation))
+
+    def maybe_summarize(self):
+        if self.summarize is None:
+            return
+        if self.summarizer is not None and self.summarizer.is_alive():
+            return
+
+        with self.lock:
+            until = len(self.history) - keep_recent_messages
+            older = self.history[self.summarized_until : until]
+            previous_summary = self.summary
+        if sum(message_tokens(m) for m in older) < summarize_over_tokens:
+            return
+
+        self.summarizer = Thread(
+            target=self.summarize_in_background,
+            args=(older, previous_summary, until),
+            daemon=True,
+        )
+        self.summarizer.start()
+
+    def summarize_in_background(
+        self, older: "Conversation", previous_summary: Optional[str], until: int
+    ):
+        assert self.summarize is not None
+        try:
+            summary = self.summarize(older, previous_summary)
+        except Exception:
+            logger.exception("Failed to summarize the conversation")
+            return
+
+        with self.lock:
+            self.summary = summary
+            self.summarized_until = until
+        logger.info(
+            "Summarized %d messages into %d tokens", len(older), count_tokens(summary)
+        )
+
+    def log_stats(self):
+        if len(self.prompt_tokens) == 0:
+            return
+        logger.info(
+            "Prompt tokens over %d turns: p50 %.0f, p90 %.0f, max %d",
+            len(self.prompt_tokens),
+            np.percentile(self.prompt_tokens, 50),
+            np.percentile(self.prompt_tokens, 90),
+            max(self.prompt_tokens),
+        )
@@ -0,0 +1,42 @@
+import importlib
+from typing import Dict, Generic, Iterator, Mapping, Type, TypeVar
+
+# Registry of the speech recognition and text to speech engines, by name, that only imports an engine's module when
+# that engine is picked.
+#
+# Each engine pulls heavy dependencies (elevenlabs, lightning_whisper_mlx, faster_whisper, ...) and some even need
+# their API keys just to be imported, so importing all of them up front slowed down the start on the Raspberry Pi and
+# broke it when an unused engine was not installed. Engines are registered as "module:Class" strings instead, the
+# names can be listed (for the CLI choices) without importing anything.
+
+T = TypeVar("T")
+
+
+class EngineRegistry(Mapping[str, Type[T]], Generic[T]):
+    paths: Dict[str, str]
+    loaded: Dict[str, Type[T]]
+
+    def __init__(self, paths: Dict[str, str]) -> None:
+        self.paths = paths
+        self.loaded = {}
+
+    def module(self, name: str) -> str:
+        return self.paths[name].split(":")[0]
+
+    def __getitem__(self, name: str) -> Type[T]:
+        engine = self.loaded.get(name)
+        if engine is None:
+            module_name, class_name = self.paths[name].split(":")
+            engine = getattr(importlib.import_module(module_name), class_name)
+            self.loaded[name] = engine
+        return engine
+
+    def __contains__(self, name: object) -> bool:
+        # Mapping would look the engine up, importing it, argparse checks the CLI choices with this
+        return name in self.paths
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
@@ -0,0 +1,157 @@
+import os
+import threading
+from threading import Thread
+import time
+from typing import Dict, List
+import httpx
+
+from lib.delta_logging import logging
+
+try:
+    import h2  # noqa: F401, only needed for httpx to speak HTTP/2
+
+    http2_available = True
+except ImportError:
+    http2_available = False
+
+# Shared HTTP transport for the OpenAI, Groq and ElevenLabs clients.
+#
+# Each process gets its own httpx.Client (a pool inherited through fork can't be shared safely), with long lived
+# keep-alive connections and HTTP/2 when the h2 package is installed, so one connection per host serves all the
+# concurrent sentence and transcription requests. The SDK clients are also created per process, with
+# `lib.per_process`, so they all go through that pool.
+#
+# To take DNS, TCP and TLS setup off the critical path, `prewarm()` opens connections to every host registered in
+# this process in the background, as soon as the wake word or the start of speech is detected, before the first
+# request of the turn needs them.
+#
+# Every request is traced, so we can tell how many requests reused a warm connection and how much time went into
+# setting up new ones.
+
+logger = logging.getLogger()
+
+keepalive_expiry = 300.0  # seconds, how long idle connections are kept around
+max_keepalive_connections = 20
+max_connections = 50
+prewarm_interval = 10.0  # seconds, don't prewarm again if it was just done
+prewarm_timeout = 3.0
+
+hosts: List[str] = []
+_clients: Dict[int, httpx.Client] = {}
+_last_prewarm: float = 0.0
+
+
+class ConnectionStats:
+    lock: threading.Lock
+    requests: int
+    new_connections: int  # opened by the requests themselves, on the critical path
+    prewarmed_connections: int
+    setup_time: float  # spent by the requests themselves on DNS, TCP and TLS
+    setup_started_at: Dict[int, float]
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.prewarmed_connections = 0
+        self.setup_time = 0.0
+        self.setup_started_at = {}
+
+    def trace(self, event_name: str, info: dict, prewarm: bool = False):
+        thread_id = threading.get_ident()
+        with self.lock:
+            if event_name.startswith(
+                ("connection.connect_tcp.", "connection.start_tls.")
+            ):
+                if event_name.endswith(".started"):
+                    self.setup_started_at[thread_id] = time.perf_counter()
+                    return
+
+                started_at = self.setup_started_at.pop(thread_id, None)
+                if started_at is not None and not prewarm:
+                    self.setup_time += time.perf_counter() - started_at
+                if event_name == "connection.connect_tcp.complete":
+                    if prewarm:
+                        self.prewarmed_connections += 1
+                    else:
+                        self.new_connections += 1
+            elif event_name.endswith(".send_request_headers.started") and not prewarm:
+                self.requests += 1
+
+    def trace_prewarm(self, event_name: str, info: dict):
+        self.trace(event_name, info, prewarm=True)
+
+
+stats = ConnectionStats()
+
+
+class TracingTransport(httpx.HTTPTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        if request.extensions.get("prewarm"):
+            request.extensions["trace"] = stats.trace_prewarm
+        else:
+            request.extensions["trace"] = stats.trace
+        return super().handle_request(request)
+
+
+def http_client() -> httpx.Client:
+    pid = os.getpid()
+    client = _clients.get(pid)
+    if client is None:
+        _clients.clear()  # inherited from the parent process, not ours to use
+        client = httpx.Client(
+            transport=TracingTransport(
+                http2=http2_available,
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=keepalive_expiry,
+                ),
+            ),
+            timeout=60,
+            follow_redirects=True,
+        )
+        _clients[pid] = client
+    return client
+
+
+def register(base_url: str):
+    if base_url not in hosts:
+        hosts.append(base_url)
+
+
+def prewarm():
+    global _last_prewarm
+
+    now = time.time()
+    if now - _last_prewarm < prewarm_interval:
+        return
+    _last_prewarm = now
+
+    thread = Thread(target=prewarm_hosts, daemon=True)
+    thread.start()
+
+
+def prewarm_hosts():
+    client = http_client()
+    for host in list(hosts):
+        try:
+            # any response will do, even a 404, it's the connection we are after
+            client.head(host, timeout=prewarm_timeout, extensions={"prewarm": True})
+        except httpx.HTTPError as err:
+            logger.debug("Failed to prewarm connection to %s: %s", host, err)
+
+
+def log_stats(process_name: str):
+    if stats.requests == 0:
+        return
+    reused = max(stats.requests - stats.new_connections, 0)
+    logger.info(
+        "HTTP in %s: %d requests, %.0f%% on reused connections, %d new connections (%.0fms of setup) on the critical path, %d prewarmed",
+        process_name,
+        stats.requests,
+        100 * reused / stats.requests,
+        stats.new_connections,
+        stats.setup_time * 1000,
+        stats.prewarmed_connections,
+    )
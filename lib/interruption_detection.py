@@ -1,10 +1,13 @@
+import math
+import time
 import multiprocessing
 from multiprocessing import Process, Queue
 from queue import Empty
+from threading import Thread
 from typing import Any, List, Optional, Union
 import numpy as np
 
-from lib.utils import terminate_pid_safely, calculate_volume
+from lib.shared_audio import SharedAudioRing, SharedAudioReader
 
 # This code is a lightweight way of detecting interruption on the fly.
 #
@@ -15,10 +18,32 @@ from lib.utils import terminate_pid_safely, calculate_volume
 # So, at every frame, we detect if the mic volume suddenly got louder than the initial 5 batch frames average, if so, we
 # interrupt the assistant
 #
-# Additionally, if the assistant has not started speaking yet, we do simple above silence_threshold interruption detection
-
-silence_threshold = 300  # same as from main
+# The audio output reports when the reply actually started coming out of the speaker, so the frames before that are
+# skipped and don't count towards that initial average.
+#
+# Additionally, if the assistant has not started speaking yet, we interrupt as soon as the VAD detects the user speaking
+#
+# The checker process is started once and lives for the whole session, but only while the echo check is enabled: with it
+# off nothing would ever read the frames, so no checker is spawned at all. Each reply gets a new generation number, sent
+# with a "reset" message, and every interrupt signal carries the generation it was detected in, so a late signal from
+# a previous reply is never mistaken for the current one.
+#
+# The checker doesn't get the audio through its queue, it reads the mic frames main writes to the shared audio ring
+# (see lib/shared_audio.py) zero-copy, starting from the moment it's told to "listen", and the queue only carries
+# those control messages.
+#
+# In low memory mode the checker runs as a thread of the main process instead, to save a whole interpreter. It does
+# share the GIL with the main loop: numpy doesn't release it for arrays as small as a few frames, so while listening
+# each batch of frames holds it for a bit, but that's a fraction of a millisecond per 32ms frame, and when idle the
+# thread just blocks on its queue (see benchmarks/interruption_check_lag.py). It still reads the frames through the
+# shared audio ring, and is stopped with a "shutdown" message, since threads can't be killed.
+
+# the old fixed VAD threshold, the checker measures the RMS of the whole band
+silence_threshold = 300
 frame_length = 512  # same as from main
+shared_audio_reader_index = 0
+# disabled for now, while off the checker is not started, only the VAD can interrupt
+echo_check_enabled = False
 pre_interrupt_speaking_minimum = (
     0.1 * 32
 )  # 0.1 seconds of speaking to interrupt before audio_playback is reproduced
@@ -29,30 +54,47 @@ global_average_volumes = []
 class InterruptionDetection:
     reply_audio_started: bool
     accumulated_similarity: List[Any]
-    audio_playback_process_pid: Optional[int]
     interrupted: bool
     done: bool
-    interruption_check_process: Process
+    shared_audio: SharedAudioRing
+    interruption_check_process: Optional[Union[Process, Thread]] = None
+    in_thread: bool
     interruption_check_in_queue: Queue
     interruption_check_out_queue: Queue
+    generation: int
     speaking_frame_count: int
     pause_frame_count: int
 
-    def __init__(self) -> None:
+    def __init__(self, shared_audio: SharedAudioRing, in_thread: bool = False) -> None:
+        self.shared_audio = shared_audio
+        self.in_thread = in_thread
+        self.generation = 0
         self.start()
 
     def start(self):
         self.reset()
-        self.interruption_check_in_queue = multiprocessing.Queue()
-        self.interruption_check_out_queue = multiprocessing.Queue()
-        self.speaking_frame_count = 0
-        self.pause_frame_count = 0
+        if not echo_check_enabled:
+            return
 
-        self.interruption_check_process = Process(
-            target=check_next_frame,
-            args=(self.interruption_check_in_queue, self.interruption_check_out_queue),
-        )
-        self.interruption_check_process.start()
+        if (
+            self.interruption_check_process is None
+            or not self.interruption_check_process.is_alive()
+        ):
+            self.interruption_check_in_queue = multiprocessing.Queue()
+            self.interruption_check_out_queue = multiprocessing.Queue()
+            self.interruption_check_process = (Thread if self.in_thread else Process)(
+                target=check_next_frame,
+                args=(
+                    self.shared_audio.reader(shared_audio_reader_index),
+                    self.interruption_check_in_queue,
+                    self.interruption_check_out_queue,
+                ),
+                daemon=True,
+            )
+            self.interruption_check_process.start()
+
+        self.generation += 1
+        self.interruption_check_in_queue.put(("reset", self.generation, 0.0))
 
     def reset(self):
         self.speaking_frame_count = 0
@@ -60,14 +102,25 @@ class InterruptionDetection:
         self.reply_audio_started = False
         self.interrupted = False
         self.done = False
-        self.audio_playback_process_pid = None
 
     def stop(self):
-        self.interruption_check_in_queue.close()
-        self.interruption_check_out_queue.close()
         self.done = True
-        terminate_pid_safely(self.audio_playback_process_pid)
-        self.interruption_check_process.kill()
+
+    def shutdown(self):
+        if self.interruption_check_process is not None:
+            self.shared_audio.log_stats(shared_audio_reader_index, "interruption check")
+            if isinstance(self.interruption_check_process, Process):
+                self.interruption_check_process.kill()
+            else:
+                self.interruption_check_in_queue.put(("shutdown", self.generation, 0.0))
+                self.interruption_check_process.join(timeout=1)
+            self.interruption_check_process = None
+
+    def pid(self) -> Optional[int]:
+        """The checker process, None when it runs as a thread of this one"""
+        if isinstance(self.interruption_check_process, Process):
+            return self.interruption_check_process.pid
+        return None
 
     def pause_for(self, n_frames: int):
         self.pause_frame_count = n_frames
@@ -75,18 +128,19 @@ class InterruptionDetection:
     def is_done(self):
         return self.done
 
-    def start_reply_interruption_check(self, audio_playback_process_id: int):
+    def start_reply_interruption_check(self, audio_started_at: float):
         self.stop()
         self.start()
-        self.audio_playback_process_pid = audio_playback_process_id
         self.reply_audio_started = True
+        if echo_check_enabled:
+            self.interruption_check_in_queue.put(
+                ("listen", self.generation, audio_started_at)
+            )
 
     def interrupt(self):
         self.interrupted = True
 
-    def check_for_interruption(
-        self, pcm: Union[List[Any], bytearray], is_silence: bool
-    ):
+    def check_for_interruption(self, is_silence: bool):
         if self.interrupted:
             return True
 
@@ -105,78 +159,112 @@ class InterruptionDetection:
 
             return False
         else:
-            return False # disable interruption detection for now
+            if not echo_check_enabled:
+                return False
             try:
-                signal = self.interruption_check_out_queue.get(block=False)
-                if signal == "interrupt":
-                    self.interrupt()
-                    return True
+                while True:
+                    signal, generation = self.interruption_check_out_queue.get(
+                        block=False
+                    )
+                    if signal == "interrupt" and generation == self.generation:
+                        self.interrupt()
+                        return True
             except Empty:
                 pass
 
-            self.interruption_check_in_queue.put(pcm)
             return False
 
 
-def check_next_frame(in_queue: Queue, out_queue: Queue):
-    batch = []
-    batch_size = 16
+def check_next_frame(audio: SharedAudioReader, in_queue: Queue, out_queue: Queue):
+    audio.attach()
+    frame_duration = frame_length / 16000
     how_many_initial_batchs_to_define = 5
-
-    initial_batches_volume = []
-    max_volume = 0
-
-    stop_counts = 0
-    loops_since_last_stop = 0
+    generation = 0
+    audio_started_at = 0.0
+    listening = False
 
     while True:
-        item = in_queue.get()
-
-        batch.append(item)
-        if len(batch) < batch_size:
+        try:
+            # while listening, this doubles as the wait for the next frame to arrive
+            message = in_queue.get(timeout=frame_duration if listening else None)
+        except Empty:
+            message = None
+
+        if message is not None:
+            kind, generation, audio_started_at = message
+            if kind == "shutdown":
+                audio.close()
+                return
+            elif kind == "reset":
+                listening = False
+            elif kind == "listen":
+                audio.seek_to_latest()
+                batch_power = 0.0
+                batch_frames = 0
+                batch_size = 16
+                initial_batches_volume = []
+                max_volume = 0
+                stop_counts = 0
+                loops_since_last_stop = 0
+                listening = True
             continue
 
-        pcm_batch = [x for x in batch]
-        batch = []
+        if not listening:
+            continue
 
-        if len(initial_batches_volume) < how_many_initial_batchs_to_define:
-            initial_batches_volume.append(calculate_volume(pcm_batch))
-            if len(initial_batches_volume) == how_many_initial_batchs_to_define:
-                max_volume = max(
-                    float(np.quantile(initial_batches_volume, 0.95)), silence_threshold
+        while listening:
+            frames = audio.read()
+            if frames is None:
+                break
+            if time.time() < audio_started_at:
+                # the reply is not coming out of the speaker yet, nothing to compare against
+                continue
+
+            # mean square of each frame, computed right on the shared memory without copying it out
+            x = frames.astype(np.float32)
+            for frame_power in np.einsum("ij,ij->i", x, x) / frame_length:
+                batch_power += float(frame_power)
+                batch_frames += 1
+                if batch_frames < batch_size:
+                    continue
+
+                volume_pcm = math.sqrt(batch_power / batch_frames)
+                batch_power = 0.0
+                batch_frames = 0
+
+                if len(initial_batches_volume) < how_many_initial_batchs_to_define:
+                    initial_batches_volume.append(volume_pcm)
+                    if len(initial_batches_volume) == how_many_initial_batchs_to_define:
+                        max_volume = max(
+                            float(np.quantile(initial_batches_volume, 0.95)),
+                            silence_threshold,
+                        )
+                        batch_size = 4
+
+                    continue
+
+                loops_since_last_stop += 1
+                if (
+                    loops_since_last_stop == 4 * 2
+                ):  # 4 * 2 (two times 16 frame batches) = ~4 seconds
+                    stop_counts = max(stop_counts - 1, 0)
+                    loops_since_last_stop = 0
+
+                if max_volume not in global_average_volumes:
+                    global_average_volumes.append(max_volume)
+
+                avg_max_volume = sum(global_average_volumes) / len(
+                    global_average_volumes
+                )
+                adjusted_avg_max_volume = avg_max_volume * (
+                    1.2 if len(global_average_volumes) > 1 else 1.5
                 )
-                batch_size = 4
 
-            continue
+                if volume_pcm >= adjusted_avg_max_volume:
+                    stop_counts += 1
+                    loops_since_last_stop = 0
 
-        loops_since_last_stop += 1
-        if (
-            loops_since_last_stop == 4 * 2
-        ):  # 4 * 2 (two times 16 frame batches) = ~4 seconds
-            stop_counts = max(stop_counts - 1, 0)
-            loops_since_last_stop = 0
-
-        volume_pcm = calculate_volume(pcm_batch)
-
-        if max_volume not in global_average_volumes:
-            global_average_volumes.append(max_volume)
-
-        avg_max_volume = sum(global_average_volumes) / len(global_average_volumes)
-        adjusted_avg_max_volume = avg_max_volume * (
-            1.2 if len(global_average_volumes) > 1 else 1.5
-        )
-
-        print(
-            "\n\nCHECKING FOR INTERRUPTIONS STARTED\n\n",
-            volume_pcm,
-            ">=",
-            adjusted_avg_max_volume,
-        )
-
-        if volume_pcm >= adjusted_avg_max_volume:
-            stop_counts += 1
-            loops_since_last_stop = 0
-
-        if stop_counts >= 1:
-            out_queue.put("interrupt")
-            break
+                if stop_counts >= 1:
+                    out_queue.put(("interrupt", generation))
+                    listening = False  # idle until the next reply
+                    break
@@ -0,0 +1,146 @@
+import json
+from multiprocessing import Queue
+from threading import Thread
+import time
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from lib.delta_logging import logging
+
+# Per-turn latency tracing across the main, reply and TTS processes.
+#
+# Any process calls `mark(stage)` and the timestamp travels through `trace_queue` to the LatencyTracer running in
+# the main process, which groups the marks into turns (a turn starts when the end of the user speech is detected),
+# logs a one-line breakdown when the reply audio ends and keeps p50/p95/p99 histograms that can be dumped to a file.
+#
+# Child processes get the queue passed as an argument and assign it to `trace_queue`, the same way the log formatter
+# start_time is shared.
+
+logger = logging.getLogger()
+
+trace_queue: Optional[Queue] = None
+
+TURN_START = "speech_endpoint"
+STAGES = [
+    # every transcription chunk completion, the last one counts
+    "transcription_completed",
+    "transcription_ready",  # transcribe_and_stop returned
+    "first_llm_delta",
+    "first_tts_flush",
+    "first_audio",
+    "reply_audio_ended",
+]
+TURN_END = "reply_audio_ended"
+USE_LAST_MARK = {"transcription_completed"}
+
+
+def mark(stage: str):
+    if trace_queue is not None:
+        trace_queue.put((stage, time.time()))
+
+
+class Turn:
+    started_at: float
+    marks: List[Tuple[str, float]]
+
+    def __init__(self, started_at: float) -> None:
+        self.started_at = started_at
+        self.marks = []
+
+    def latencies(self) -> Dict[str, float]:
+        result: Dict[str, float] = {}
+        for stage, timestamp in self.marks:
+            if stage in result and stage not in USE_LAST_MARK:
+                continue
+            result[stage] = round((timestamp - self.started_at) * 1000, 1)
+        return result
+
+
+class LatencyTracer:
+    report_path: Optional[str]
+    queue: Queue
+    current_turn: Optional[Turn]
+    turns: List[Dict[str, float]]
+    histograms: Dict[str, List[float]]
+
+    def __init__(self, report_path: Optional[str] = None) -> None:
+        global trace_queue
+
+        self.report_path = report_path
+        self.queue = Queue()
+        self.current_turn = None
+        self.turns = []
+        self.histograms = {stage: [] for stage in STAGES}
+        trace_queue = self.queue
+
+    def start(self):
+        thread = Thread(target=self.collect, daemon=True)
+        thread.start()
+
+    def collect(self):
+        while True:
+            try:
+                stage, timestamp = self.queue.get()
+            except (EOFError, OSError):
+                return  # queue closed while shutting down
+            self.record(stage, timestamp)
+
+    def record(self, stage: str, timestamp: float):
+        if stage == TURN_START:
+            self.finish_turn()
+            self.current_turn = Turn(timestamp)
+            return
+
+        if self.current_turn is None:
+            return
+
+        self.current_turn.marks.append((stage, timestamp))
+        if stage == TURN_END:
+            self.finish_turn()
+
+    def finish_turn(self):
+        if self.current_turn is None:
+            return
+
+        latencies = self.current_turn.latencies()
+        self.current_turn = None
+        if len(latencies) == 0:
+            return
+
+        self.turns.append(latencies)
+        for stage, latency in latencies.items():
+            if stage in self.histograms:
+                self.histograms[stage].append(latency)
+
+        logger.info(
+            "Turn latency: %s",
+            ", ".join(
+                f"{stage} {round(latencies[stage])}ms"
+                for stage in STAGES
+                if stage in latencies
+            ),
+        )
+        if self.report_path:
+            self.dump(self.report_path)
+
+    def percentiles(self) -> Dict[str, Dict[str, float]]:
+        result: Dict[str, Dict[str, float]] = {}
+        for stage, values in self.histograms.items():
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            result[stage] = {
+                "count": len(values),
+                "p50": round(float(p50), 1),
+                "p95": round(float(p95), 1),
+                "p99": round(float(p99), 1),
+            }
+        return result
+
+    def dump(self, path: str):
+        with open(path, "w") as report:
+            json.dump(
+                {"percentiles": self.percentiles(), "turns": self.turns},
+                report,
+                indent=2,
+            )
@@ -0,0 +1,62 @@
+from typing import Dict
+
+import psutil
+
+from lib.delta_logging import logging
+
+# Memory taken by each part of BMO, to see where it goes on a Raspberry Pi with 1 or 2GB.
+#
+# Covers the main process and every process under it (reply workers, the interruption checker, the whisper.cpp
+# server, ffplay, ...), named after what they are when main knows their pid. Besides the RSS, it logs the PSS, where
+# the pages shared between processes, like the libraries forked copy-on-write, are split among them, so adding up the
+# PSS of all processes gives the actual total footprint, and the USS, the memory that would be freed by stopping that
+# process.
+
+logger = logging.getLogger()
+
+megabyte = 1024 * 1024
+
+
+def component_name(process: psutil.Process, names: Dict[int, str]) -> str:
+    if process.pid in names:
+        return names[process.pid]
+    try:
+        command_line = " ".join(process.cmdline())
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        command_line = ""
+    if "multiprocessing.resource_tracker" in command_line:
+        return "resource tracker"
+    try:
+        return process.name()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return "unknown"
+
+
+def log_stats(names: Dict[int, str]):
+    main = psutil.Process()
+    names = {main.pid: "main", **names}
+    total_rss = 0
+    total_pss = 0
+    processes = [main] + main.children(recursive=True)
+    for process in processes:
+        try:
+            memory = process.memory_full_info()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue
+        pss = getattr(memory, "pss", memory.rss)  # PSS is only available on Linux
+        total_rss += memory.rss
+        total_pss += pss
+        logger.info(
+            "Memory of %s (pid %d): RSS %.0fMB, PSS %.0fMB, USS %.0fMB",
+            component_name(process, names),
+            process.pid,
+            memory.rss / megabyte,
+            pss / megabyte,
+            memory.uss / megabyte,
+        )
+    logger.info(
+        "Memory in total: PSS %.0fMB over %d processes (RSS adds up to %.0fMB)",
+        total_pss / megabyte,
+        len(processes),
+        total_rss / megabyte,
+    )
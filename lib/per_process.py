@@ -0,0 +1,32 @@
+import os
+import threading
+from typing import Callable, Dict, TypeVar
+
+# Per-process singletons, for clients and models that can't be shared with a forked child, like an SDK client holding
+# a connection pool, or the Piper voice and its onnxruntime session.
+#
+# `per_process(factory)` returns a getter that creates the instance the first time it's called in each process, and
+# drops the one inherited from the parent, so the reply workers and the main process each get their own.
+
+T = TypeVar("T")
+
+
+def per_process(factory: Callable[[], T]) -> Callable[[], T]:
+    instances: Dict[int, T] = {}
+    # per pid, a lock held while forking would stay locked in the child
+    locks: Dict[int, threading.Lock] = {}
+
+    def get() -> T:
+        pid = os.getpid()
+        instance = instances.get(pid)
+        if instance is None:
+            # called from several threads at once, like the transcription workers, only one of them gets to create it
+            with locks.setdefault(pid, threading.Lock()):
+                instance = instances.get(pid)
+                if instance is None:
+                    instances.clear()
+                    instance = factory()
+                    instances[pid] = instance
+        return instance
+
+    return get
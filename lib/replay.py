@@ -0,0 +1,282 @@
+import queue
+import subprocess
+import time
+import wave
+from typing import List, NamedTuple, Optional, Tuple
+import numpy as np
+
+from lib.delta_logging import logging
+from lib.reply_events import (
+    AssistantMessage,
+    ReplyAudioEnded,
+    ReplyAudioStarted,
+    ReplyEvent,
+)
+
+# Replay mode drives the AudioRecording state machine from an audio file instead of the microphone, as fast as the
+# CPU allows, with the speech recognition and ChatGPT engines replaced by recorders. This lets us measure how much
+# headroom the frame loop has and catch regressions in endpointing without a live mic or any API calls.
+
+logger = logging.getLogger()
+
+sample_rate = 16000  # same as from main
+frames_per_second = 32  # 512 samples per frame at 16kHz, same approximation as main
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+def load_audio_file(path: str) -> np.ndarray:
+    if path.endswith(".wav"):
+        with wave.open(path, "rb") as wav_file:
+            if (
+                wav_file.getnchannels() == 1
+                and wav_file.getsampwidth() == 2
+                and wav_file.getframerate() == sample_rate
+            ):
+                return np.frombuffer(
+                    wav_file.readframes(wav_file.getnframes()), dtype=np.int16
+                )
+
+    ffmpeg = subprocess.run(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-i",
+            path,
+            "-f",
+            "s16le",
+            "-ac",
+            "1",
+            "-ar",
+            str(sample_rate),
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return np.frombuffer(ffmpeg.stdout, dtype=np.int16)
+
+
+class FileRecorder:
+    """Drop-in replacement for PvRecorder that reads frames from an audio file"""
+
+    samples: np.ndarray
+    frame_length: int
+    frame_index: int
+    started_at: Optional[float]
+    finished_at: Optional[float]
+
+    def __init__(self, path: str, frame_length: int) -> None:
+        self.samples = load_audio_file(path)
+        self.frame_length = frame_length
+        self.frame_index = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self):
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+
+    def stop(self):
+        pass
+
+    def delete(self):
+        pass
+
+    def read(self) -> List[int]:
+        start = self.frame_index * self.frame_length
+        end = start + self.frame_length
+        if end > len(self.samples):
+            if self.finished_at is None:
+                self.finished_at = time.perf_counter()
+            raise ReplayFinished()
+
+        self.frame_index += 1
+        return self.samples[start:end].tolist()
+
+    def audio_time(self) -> float:
+        return self.frame_index / frames_per_second
+
+    def wall_time(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+
+class StateTransition(NamedTuple):
+    frame: int
+    audio_time: float
+    wall_time: float
+    from_state: str
+    to_state: str
+
+
+class EndpointDecision(NamedTuple):
+    frame: int
+    audio_time: float
+    speaking_frames: int
+    silence_frames: int
+
+
+class ReplayReport:
+    recorder: FileRecorder
+    transitions: List[StateTransition]
+    endpoints: List[EndpointDecision]
+    transcriptions: List[Tuple[float, int]]
+    speculations: List[float]
+    replies: List[float]
+
+    def __init__(self, recorder: FileRecorder) -> None:
+        self.recorder = recorder
+        self.transitions = []
+        self.endpoints = []
+        self.transcriptions = []
+        self.speculations = []
+        self.replies = []
+
+    def state_changed(self, from_state: str, to_state: str):
+        self.transitions.append(
+            StateTransition(
+                self.recorder.frame_index,
+                self.recorder.audio_time(),
+                self.recorder.wall_time(),
+                from_state,
+                to_state,
+            )
+        )
+
+    def endpoint_detected(self, speaking_frames: int, silence_frames: int):
+        self.endpoints.append(
+            EndpointDecision(
+                self.recorder.frame_index,
+                self.recorder.audio_time(),
+                speaking_frames,
+                silence_frames,
+            )
+        )
+
+    def print_summary(self):
+        frames = self.recorder.frame_index
+        wall_time = self.recorder.wall_time()
+        audio_time = self.recorder.audio_time()
+        frames_per_sec = frames / wall_time if wall_time > 0 else float("inf")
+        print("")
+        print(
+            f"Replayed {frames} frames ({audio_time:.2f}s of audio) in {wall_time:.3f}s: "
+            f"{frames_per_sec:.0f} frames/s, {frames_per_sec / frames_per_second:.1f}x real time"
+        )
+        print(
+            f"Transcription flushes: {len(self.transcriptions)}, speculations: {len(self.speculations)}, "
+            f"replies: {len(self.replies)}"
+        )
+        print("State transitions:")
+        for t in self.transitions:
+            print(
+                f"  frame {t.frame:>6}  audio {t.audio_time:>8.2f}s  wall {t.wall_time:>7.3f}s  "
+                f"{t.from_state} -> {t.to_state}"
+            )
+        print("Endpoint decisions:")
+        for e in self.endpoints:
+            print(
+                f"  frame {e.frame:>6}  audio {e.audio_time:>8.2f}s  "
+                f"after {e.speaking_frames} speaking frames and {e.silence_frames} silence frames "
+                f"({e.silence_frames / frames_per_second * 1000:.0f}ms of silence)"
+            )
+
+
+class ReplaySpeechRecognition:
+    report: ReplayReport
+    consumed_bytes: int
+    utterances: int
+
+    def __init__(self, report: ReplayReport) -> None:
+        self.report = report
+        self.consumed_bytes = 0
+        self.utterances = 0
+
+    def restart(self):
+        self.consumed_bytes = 0
+
+    def stop(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def consume(self, audio_buffer):
+        self.consumed_bytes += len(audio_buffer)
+        self.report.transcriptions.append(
+            (self.report.recorder.audio_time(), len(audio_buffer))
+        )
+
+    def partial_transcription(self) -> Optional[str]:
+        return f"replayed utterance {self.utterances + 1}"
+
+    def transcribe_and_stop(self) -> str:
+        self.utterances += 1
+        return f"replayed utterance {self.utterances}"
+
+
+class ReplayChatGPT:
+    report: ReplayReport
+    reply_out_queue: "queue.Queue[Tuple[int, ReplyEvent]]"
+    turn_id: int
+    last_turn_id: int
+
+    def __init__(self, report: ReplayReport) -> None:
+        self.report = report
+        self.reply_out_queue = queue.Queue()
+        self.turn_id = 0
+        self.last_turn_id = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.last_turn_id += 1
+        self.turn_id = self.last_turn_id
+
+    def restart(self):
+        self.stop()
+
+    def shutdown(self):
+        pass
+
+    def prewarm(self):
+        pass
+
+    def reply(self, conversation):
+        self.speak("replayed reply")
+
+    def speculate(self, conversation) -> int:
+        self.last_turn_id += 1
+        self.report.speculations.append(self.report.recorder.audio_time())
+        return self.last_turn_id
+
+    def commit_speculation(self, turn_id: int):
+        self.emit_reply(turn_id, "replayed reply")
+
+    def cancel_speculation(self, turn_id: int):
+        pass
+
+    def speak(self, text: str):
+        self.last_turn_id += 1
+        self.emit_reply(self.last_turn_id, text)
+
+    def emit_reply(self, turn_id: int, text: str):
+        self.turn_id = turn_id
+        self.report.replies.append(self.report.recorder.audio_time())
+        for event in [
+            AssistantMessage({"role": "assistant", "content": text}),
+            ReplyAudioStarted(time.time()),
+            ReplyAudioEnded(),
+        ]:
+            self.reply_out_queue.put((self.turn_id, event))
+
+    def get(
+        self, block: bool, timeout: Optional[float] = None
+    ) -> Tuple[int, ReplyEvent]:
+        return self.reply_out_queue.get(block=block, timeout=timeout)
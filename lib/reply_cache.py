@@ -0,0 +1,150 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from typing import TYPE_CHECKING, Optional
+from typing_extensions import TypedDict
+
+from lib.delta_logging import logging
+
+if TYPE_CHECKING:
+    from lib.chatgpt import Message
+
+# Opt-in cache of replies for the small talk people repeat all the time ("what's up", "thanks", "bye"), so those are
+# spoken right away instead of going through a full streamed LLM round trip.
+#
+# Entries are keyed by the normalized transcription together with a fingerprint of the system prompt and of the
+# assistant message it answers, so "yes" after one question doesn't get the reply "yes" got after another. Only short
+# utterances are cached, evicted by least recently used and by age, and persisted as JSON so they survive restarts.
+# Without a path the cache is kept in memory only, which is what --replay uses.
+
+logger = logging.getLogger()
+
+default_path = os.path.join(".cache", "reply_cache.json")
+max_entries = 256
+ttl = 7 * 24 * 60 * 60  # 1 week, so replies don't get too repetitive over time
+max_utterance_words = 6
+
+
+class CacheEntry(TypedDict):
+    reply: str
+    created_at: float
+    # seconds from sending to the LLM to the first audio, what a hit saves
+    latency: float
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = re.sub(r"['’]", "", text)  # what's up -> whats up
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class ReplyCache:
+    path: Optional[str]
+    entries: "OrderedDict[str, CacheEntry]"
+    hits: int
+    misses: int
+    latency_saved: float
+
+    def __init__(self, path: Optional[str] = default_path) -> None:
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self.load()
+
+    def key(
+        self, transcription: str, system_message: "Message", previous: "Message"
+    ) -> Optional[str]:
+        utterance = normalize(transcription)
+        if utterance == "" or len(utterance.split(" ")) > max_utterance_words:
+            return None
+
+        context = (
+            normalize(previous["content"]) if previous["role"] == "assistant" else ""
+        )
+        fingerprint = json.dumps([system_message["content"], context, utterance])
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()
+
+    def get(self, key: Optional[str]) -> Optional[str]:
+        if key is None:
+            return None
+
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry["created_at"] > ttl:
+            del self.entries[key]
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.latency_saved += entry["latency"]
+        logger.info(
+            "Reply cache hit, %d/%d hits so far, ~%.1fs of latency saved",
+            self.hits,
+            self.hits + self.misses,
+            self.latency_saved,
+        )
+        return entry["reply"]
+
+    def put(self, key: str, reply: str, latency: float):
+        self.entries[key] = {
+            "reply": reply,
+            "created_at": time.time(),
+            "latency": latency,
+        }
+        self.entries.move_to_end(key)
+        while len(self.entries) > max_entries:
+            self.entries.popitem(last=False)
+        self.save()
+
+    def load(self):
+        if self.path is None:
+            return
+        try:
+            with open(self.path, "r") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logger.warning(
+                "Could not read the reply cache at %s, starting empty", self.path
+            )
+            return
+
+        now = time.time()
+        for key, entry in entries.items():
+            if now - entry["created_at"] <= ttl:
+                self.entries[key] = entry
+
+    def save(self):
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # write to a temporary file first so a crash never leaves a half written cache behind
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(temporary_path, self.path)
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return
+        logger.info(
+            "Reply cache: %d hits out of %d lookups (%.0f%%), ~%.1fs of latency saved",
+            self.hits,
+            lookups,
+            100 * self.hits / lookups,
+            self.latency_saved,
+        )
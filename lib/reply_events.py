@@ -0,0 +1,23 @@
+from typing import TYPE_CHECKING, NamedTuple, Union
+
+if TYPE_CHECKING:
+    from lib.chatgpt import Message
+
+# Events sent from the reply process (ChatGPT and the TTS engines) back to the main loop. They are plain NamedTuples
+# so they pickle cheaply through the multiprocessing queues and can be told apart with isinstance.
+
+
+class AssistantMessage(NamedTuple):
+    message: "Message"
+
+
+class ReplyAudioStarted(NamedTuple):
+    # wall clock time the reply audio actually started coming out of the speaker
+    started_at: float
+
+
+class ReplyAudioEnded(NamedTuple):
+    pass
+
+
+ReplyEvent = Union[AssistantMessage, ReplyAudioStarted, ReplyAudioEnded]
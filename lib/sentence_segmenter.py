@@ -0,0 +1,135 @@
+from typing import List, Optional
+
+# Splits the streamed LLM reply into chunks for the TTS engine as the tokens arrive, looking at each new character
+# only once, so the work per token stays constant no matter how long the reply gets.
+#
+# Breaking on a period, or on a dash or a comma, can only be decided on the character that comes after it: "3.5",
+# "e.g. this", "Dr. Who", "well-known" or "1,000" are not breaks, so those decisions wait for the next character.
+# Full-width CJK punctuation (。！？) is never followed by a space, so it breaks right away.
+#
+# The first chunk is kept short so the first audio starts as soon as possible, then chunks are allowed to grow,
+# which sounds more natural and makes fewer TTS requests, as there is time to synthesize while the first ones play.
+
+sentence_terminators = set(".!?…।؟")
+full_width_terminators = set("。！？")
+clause_breaks = set(",;:，、；：-–—/")
+closing_marks = set("\"')]”’»")
+abbreviations = {
+    "mr",
+    "mrs",
+    "ms",
+    "dr",
+    "prof",
+    "sr",
+    "sra",
+    "jr",
+    "st",
+    "vs",
+    "e.g",
+    "i.e",
+    "approx",
+}
+
+# flush at a space after this many words even without any punctuation
+first_chunk_max_words = 8
+max_words = 20
+# longest a chunk gets by waiting for a sentence end rather than breaking on a comma
+max_clause_words = 12
+
+
+class SentenceSegmenter:
+    min_words: int
+    pieces: List[str]
+    words: int
+    total_words: int
+    chunks_emitted: int
+    in_word: bool
+    word: List[str]
+    # "sentence" or "clause", waiting on the next character to decide
+    pending_break: Optional[str]
+    pending_word: str
+
+    def __init__(self, min_words: int) -> None:
+        self.min_words = min_words
+        self.pieces = []
+        self.words = 0
+        self.total_words = 0
+        self.chunks_emitted = 0
+        self.in_word = False
+        self.word = []
+        self.pending_break = None
+        self.pending_word = ""
+
+    def feed(self, token: str) -> List[str]:
+        chunks: List[str] = []
+        for char in token:
+            self.add(char, chunks)
+        return chunks
+
+    def flush(self) -> Optional[str]:
+        chunks: List[str] = []
+        self.pending_break = None
+        self.emit(chunks)
+        return chunks[0] if chunks else None
+
+    def clause_words(self) -> int:
+        # 2, 4, 8, 12... words as the reply goes on
+        return min(self.min_words * 2**self.chunks_emitted, max_clause_words)
+
+    def add(self, char: str, chunks: List[str]):
+        if self.pending_break is not None:
+            if char.isspace():
+                self.commit_break(chunks)
+            elif char in closing_marks or (
+                self.pending_break == "sentence" and char in sentence_terminators
+            ):
+                self.pieces.append(char)
+                return
+            else:
+                # a decimal, an abbreviation, a hyphenated word...
+                self.pending_break = None
+
+        self.pieces.append(char)
+
+        if char.isspace():
+            self.in_word = False
+            self.word = []
+            limit = first_chunk_max_words if self.chunks_emitted == 0 else max_words
+            if self.words >= limit:
+                self.emit(chunks)
+            return
+
+        if not self.in_word:
+            self.in_word = True
+            self.words += 1
+            self.total_words += 1
+
+        if char in full_width_terminators:
+            self.emit(chunks)
+        elif char in sentence_terminators:
+            self.pending_break = "sentence"
+            self.pending_word = "".join(self.word).lower()
+        elif char in clause_breaks:
+            self.pending_break = "clause"
+        self.word.append(char)
+
+    def commit_break(self, chunks: List[str]):
+        kind = self.pending_break
+        self.pending_break = None
+        if kind == "sentence":
+            if self.pending_word in abbreviations or (
+                len(self.pending_word) == 1 and self.pending_word.isalpha()
+            ):
+                return  # "Dr. Smith", "J. R. R. Tolkien"
+            if self.words >= self.min_words:
+                self.emit(chunks)
+        elif kind == "clause" and self.words >= self.clause_words():
+            self.emit(chunks)
+
+    def emit(self, chunks: List[str]):
+        text = "".join(self.pieces).strip()
+        self.pieces = []
+        self.words = 0
+        if text != "":
+            chunks.append(text)
+            self.chunks_emitted += 1
@@ -0,0 +1,160 @@
+from multiprocessing import shared_memory
+from typing import Optional
+import numpy as np
+
+from lib.delta_logging import logging
+
+# Shared-memory transport for the mic audio, so worker processes (the interruption checker, and later things like
+# echo cancellation or a VAD worker) can read the latest frames zero-copy, instead of having every frame pickled
+# through a multiprocessing.Queue.
+#
+# The main process is the only writer: it copies each int16 frame into the next slot of a ring of frames and then
+# bumps a sequence counter in the header. Readers keep their own cursor, also in the header, so the owner can see how
+# far behind each of them is. A reader that falls more than a whole ring behind skips ahead to the oldest frame still
+# available and counts the frames it dropped.
+#
+# Header layout, all int64: [write_seq, then for each reader: cursor, max_lag, dropped]
+
+logger = logging.getLogger()
+
+header_fields = 1
+reader_fields = 3
+max_readers = 4
+
+
+class SharedAudioRing:
+    """Owner side, lives in the main process and writes the frames"""
+
+    frame_length: int
+    capacity: int
+    memory: shared_memory.SharedMemory
+    header: np.ndarray
+    frames: np.ndarray
+
+    def __init__(self, frame_length: int, capacity: int) -> None:
+        self.frame_length = frame_length
+        self.capacity = capacity
+        header_size = (header_fields + reader_fields * max_readers) * 8
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=header_size + capacity * frame_length * 2
+        )
+        self.header, self.frames = map_ring(self.memory, frame_length, capacity)
+        self.header[:] = 0
+
+    def write(self, pcm: np.ndarray):
+        seq = int(self.header[0])
+        self.frames[seq % self.capacity] = pcm
+        # the data has to be in place before readers can see the new sequence number
+        self.header[0] = seq + 1
+
+    def written(self) -> int:
+        return int(self.header[0])
+
+    def reader(self, index: int) -> "SharedAudioReader":
+        if index >= max_readers:
+            raise ValueError(f"Shared audio supports at most {max_readers} readers")
+        return SharedAudioReader(
+            self.memory.name, self.frame_length, self.capacity, index
+        )
+
+    def lag(self, index: int) -> int:
+        offset = header_fields + index * reader_fields
+        return max(int(self.header[0]) - int(self.header[offset]), 0)
+
+    def log_stats(self, index: int, name: str):
+        offset = header_fields + index * reader_fields
+        logger.info(
+            "Shared audio %s reader: current lag %d frames, max lag %d frames, %d frames dropped",
+            name,
+            self.lag(index),
+            self.header[offset + 1],
+            self.header[offset + 2],
+        )
+
+    def close(self):
+        # the numpy views have to go before the buffer they point to can be released
+        del self.header, self.frames
+        self.memory.close()
+        self.memory.unlink()
+
+
+class SharedAudioReader:
+    """Reader side, picklable so it can be passed to a worker process, which then calls attach()"""
+
+    name: str
+    frame_length: int
+    capacity: int
+    index: int
+    memory: Optional[shared_memory.SharedMemory]
+    header: np.ndarray
+    frames: np.ndarray
+
+    def __init__(self, name: str, frame_length: int, capacity: int, index: int) -> None:
+        self.name = name
+        self.frame_length = frame_length
+        self.capacity = capacity
+        self.index = index
+        self.memory = None
+
+    def __getstate__(self):
+        return (self.name, self.frame_length, self.capacity, self.index)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def attach(self):
+        self.memory = shared_memory.SharedMemory(name=self.name)
+        self.header, self.frames = map_ring(
+            self.memory, self.frame_length, self.capacity
+        )
+        self.frames.flags.writeable = False
+        self.seek_to_latest()
+
+    @property
+    def offset(self) -> int:
+        return header_fields + self.index * reader_fields
+
+    def seek_to_latest(self):
+        self.header[self.offset] = self.header[0]
+
+    def lag(self) -> int:
+        return int(self.header[0]) - int(self.header[self.offset])
+
+    def read(self) -> Optional[np.ndarray]:
+        """Returns a (n_frames, frame_length) view over the next contiguous run of unread frames, or None if there
+        are none. The view points right into the ring, so it has to be used before the writer wraps around to it.
+        """
+        write_seq = int(self.header[0])
+        cursor = int(self.header[self.offset])
+        lag = write_seq - cursor
+        if lag <= 0:
+            return None
+
+        if lag > self.header[self.offset + 1]:
+            self.header[self.offset + 1] = lag
+        if lag > self.capacity:
+            self.header[self.offset + 2] += lag - self.capacity
+            cursor = write_seq - self.capacity
+
+        start = cursor % self.capacity
+        end = min(start + (write_seq - cursor), self.capacity)
+        self.header[self.offset] = cursor + (end - start)
+        return self.frames[start:end]
+
+    def close(self):
+        if self.memory is not None:
+            del self.header, self.frames
+            self.memory.close()
+            self.memory = None
+
+
+def map_ring(memory: shared_memory.SharedMemory, frame_length: int, capacity: int):
+    header_length = header_fields + reader_fields * max_readers
+    header = np.ndarray((header_length,), dtype=np.int64, buffer=memory.buf)
+    frames = np.ndarray(
+        (capacity, frame_length),
+        dtype=np.int16,
+        buffer=memory.buf,
+        offset=header_length * 8,
+    )
+    return header, frames
@@ -0,0 +1,88 @@
+from typing import TYPE_CHECKING, List, NamedTuple, Optional
+
+from lib.delta_logging import logging
+from lib.reply_cache import normalize
+
+if TYPE_CHECKING:
+    from lib.chatgpt import ChatGPT, Conversation
+
+# Speculative replies: as soon as the user pauses, the partial transcript is sent to the LLM, instead of waiting for
+# the whole silence timeout and the final transcription. The worker streams it in the background without speaking
+# it, and once the endpoint is confirmed, if the final transcript is the same as the one it speculated on, it's
+# committed and starts playing right away, with most of the LLM latency already behind it. Otherwise it's cancelled.
+#
+# There can be a few speculations in flight at once (one per pause), the oldest is cancelled when going over the
+# limit. Every speculation ends up either won or wasted, so we can tell if it pays off.
+
+logger = logging.getLogger()
+
+speculation_pause = round(0.15 * 32)  # 0.15 seconds of silence after speaking
+
+
+class Speculation(NamedTuple):
+    turn_id: int
+    transcription: str
+    conversation: "Conversation"
+
+
+class SpeculativeReplies:
+    chat_gpt: "ChatGPT"
+    max_speculative: int
+    in_flight: List[Speculation]
+    won: int
+    wasted: int
+
+    def __init__(self, chat_gpt: "ChatGPT", max_speculative: int) -> None:
+        self.chat_gpt = chat_gpt
+        self.max_speculative = max_speculative
+        self.in_flight = []
+        self.won = 0
+        self.wasted = 0
+
+    def start(self, conversation: "Conversation", transcription: str):
+        while len(self.in_flight) >= self.max_speculative:
+            self.discard(self.in_flight[0])
+
+        turn_id = self.chat_gpt.speculate(conversation)
+        self.in_flight.append(Speculation(turn_id, transcription, conversation))
+        logger.info("Speculating on partial transcription: %s", transcription)
+
+    def commit_matching(self, transcription: str) -> Optional["Conversation"]:
+        """Commits the speculation on this transcription, returning the prompt it was sent with"""
+        match: Optional[Speculation] = None
+        for speculation in list(self.in_flight):
+            if match is None and normalize(speculation.transcription) == normalize(
+                transcription
+            ):
+                match = speculation
+            else:
+                self.discard(speculation)
+
+        if match is None:
+            return None
+
+        self.in_flight.remove(match)
+        self.chat_gpt.commit_speculation(match.turn_id)
+        self.won += 1
+        logger.info("Speculation won (%d won, %d wasted)", self.won, self.wasted)
+        return match.conversation
+
+    def cancel_all(self):
+        for speculation in list(self.in_flight):
+            self.discard(speculation)
+
+    def discard(self, speculation: Speculation):
+        self.in_flight.remove(speculation)
+        self.chat_gpt.cancel_speculation(speculation.turn_id)
+        self.wasted += 1
+
+    def log_stats(self):
+        total = self.won + self.wasted
+        if total == 0:
+            return
+        logger.info(
+            "Speculative replies: %d won, %d wasted (%.0f%% won)",
+            self.won,
+            self.wasted,
+            100 * self.won / total,
+        )
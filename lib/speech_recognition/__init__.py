@@ -1,11 +1,9 @@
 import subprocess
-from typing import Dict, Type
+from typing import Optional
 from typing_extensions import Protocol
 
 from lib.delta_logging import logging
-from lib.speech_recognition.lightning_whisper_mlx import LightningWhisperMlx
-from lib.speech_recognition.whisper_api import WhisperAPI
-from lib.speech_recognition.whisper_cpp import WhisperCpp
+from lib.engine_registry import EngineRegistry
 
 logger = logging.getLogger()
 
@@ -17,17 +15,30 @@ class SpeechRecognition(Protocol):
     def stop(self):
         pass
 
+    def shutdown(self):
+        """Releases what the engine started, it's not used again after this"""
+        pass
+
     def consume(self, audio_buffer):
         pass
 
+    def partial_transcription(self) -> Optional[str]:
+        """What was transcribed so far, without stopping, or None if the engine can't tell before the end"""
+        return None
+
     def transcribe_and_stop(self) -> str:
         return ""
 
-ENGINES : Dict[str, Type[SpeechRecognition]] = {
-    "whisper": WhisperAPI,
-    "whisper-cpp": WhisperCpp,
-    "lightning-whisper-mlx": LightningWhisperMlx
-}
+
+ENGINES: EngineRegistry[SpeechRecognition] = EngineRegistry(
+    {
+        "whisper": "lib.speech_recognition.whisper_api:WhisperAPI",
+        "whisper-cpp": "lib.speech_recognition.whisper_cpp:WhisperCpp",
+        "lightning-whisper-mlx": "lib.speech_recognition.lightning_whisper_mlx:LightningWhisperMlx",
+        "faster-whisper": "lib.speech_recognition.faster_whisper:FasterWhisper",
+    }
+)
+
 
 def transcribe(file) -> str:
     whispercpp = subprocess.Popen(
@@ -0,0 +1,196 @@
+from io import BytesIO
+import subprocess
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional
+import wave
+from typing_extensions import Literal
+
+import numpy as np
+
+from lib.delta_logging import logging
+
+try:
+    import soundfile
+
+    soundfile_available = True
+except (ImportError, OSError):  # OSError when libsndfile itself is missing
+    soundfile_available = False
+
+# Encoders for the audio uploaded for transcription. Plain 16 bit PCM WAV is 32KB per second of audio, which on a slow
+# uplink can take longer to upload than the transcription itself, FLAC is lossless at around half of that, and Opus
+# at 24kbps is a tenth of it, with no difference to Whisper for speech.
+#
+# Encoding is not free though, specially on the Raspberry Pi, so with `auto` the codec is picked per chunk as the one
+# with the lowest expected encode time plus upload time. The uplink throughput and each codec's encode speed and
+# compression ratio are measured from the actual uploads and kept as moving averages, starting from rough priors.
+#
+# FLAC is encoded in process with soundfile when it's installed, everything else falls back to an ffmpeg subprocess.
+
+logger = logging.getLogger()
+
+Codec = Literal["wav", "flac", "opus"]
+
+codecs: List[Codec] = ["wav", "flac", "opus"]
+sample_rate = 16000
+opus_bitrate = "24k"
+smoothing = 0.3  # weight of the newest measurement in the moving averages
+
+# set from --upload-codec, None picks one automatically
+preferred_codec: Optional[Codec] = None
+
+
+class EncodedAudio(NamedTuple):
+    data: bytes
+    filename: str
+    codec: Codec
+    encode_time: float
+
+
+class CodecStats:
+    compression_ratio: float  # encoded bytes per byte of PCM
+    encode_time_ratio: float  # seconds of encoding per second of audio
+
+    def __init__(self, compression_ratio: float, encode_time_ratio: float) -> None:
+        self.compression_ratio = compression_ratio
+        self.encode_time_ratio = encode_time_ratio
+
+
+class UplinkEstimator:
+    lock: threading.Lock
+    # bytes per second, None until the first upload is measured
+    throughput: Optional[float]
+    codec_stats: Dict[Codec, CodecStats]
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.throughput = None
+        self.codec_stats = {
+            "wav": CodecStats(compression_ratio=1.0, encode_time_ratio=0.0),
+            "flac": CodecStats(compression_ratio=0.55, encode_time_ratio=0.01),
+            "opus": CodecStats(compression_ratio=0.1, encode_time_ratio=0.06),
+        }
+
+    def choose(self, pcm_bytes: int) -> Codec:
+        with self.lock:
+            if self.throughput is None:
+                # lossless and cheap, a safe bet until the uplink is measured
+                return "flac"
+
+            audio_seconds = pcm_bytes / (sample_rate * 2)
+            expected_times = {
+                codec: stats.encode_time_ratio * audio_seconds
+                + stats.compression_ratio * pcm_bytes / self.throughput
+                for codec, stats in self.codec_stats.items()
+            }
+            return min(expected_times, key=lambda codec: expected_times[codec])
+
+    def record_encoding(self, codec: Codec, pcm_bytes: int, encoded: EncodedAudio):
+        if pcm_bytes == 0:
+            return
+        with self.lock:
+            stats = self.codec_stats[codec]
+            stats.compression_ratio = moving_average(
+                stats.compression_ratio, len(encoded.data) / pcm_bytes
+            )
+            stats.encode_time_ratio = moving_average(
+                stats.encode_time_ratio,
+                encoded.encode_time / (pcm_bytes / (sample_rate * 2)),
+            )
+
+    def record_upload(self, uploaded_bytes: int, upload_time: float):
+        if upload_time <= 0:
+            return
+        with self.lock:
+            throughput = uploaded_bytes / upload_time
+            self.throughput = (
+                throughput
+                if self.throughput is None
+                else moving_average(self.throughput, throughput)
+            )
+
+
+uplink = UplinkEstimator()
+
+
+def moving_average(average: float, value: float) -> float:
+    return average * (1 - smoothing) + value * smoothing
+
+
+def choose_codec(pcm_bytes: int) -> Codec:
+    if preferred_codec is not None:
+        return preferred_codec
+    return uplink.choose(pcm_bytes)
+
+
+def encode(pcm: bytes, codec: Codec) -> EncodedAudio:
+    started_at = time.perf_counter()
+    try:
+        if codec == "wav":
+            data = encode_wav(pcm)
+        elif codec == "flac" and soundfile_available:
+            data = encode_with_soundfile(pcm, "FLAC")
+        else:
+            data = encode_with_ffmpeg(pcm, codec)
+    except (OSError, subprocess.CalledProcessError) as err:
+        logger.warning("Failed to encode audio as %s, sending wav: %s", codec, err)
+        codec = "wav"
+        data = encode_wav(pcm)
+    encode_time = time.perf_counter() - started_at
+    return EncodedAudio(data, f"recording.{file_extension(codec)}", codec, encode_time)
+
+
+def file_extension(codec: Codec) -> str:
+    return "ogg" if codec == "opus" else codec
+
+
+def encode_wav(pcm: bytes) -> bytes:
+    virtual_file = BytesIO()
+    wav_file = wave.open(virtual_file, "wb")
+    wav_file.setnchannels(1)
+    wav_file.setsampwidth(2)
+    wav_file.setframerate(sample_rate)
+    wav_file.writeframes(pcm)
+    wav_file.close()
+    return virtual_file.getvalue()
+
+
+def encode_with_soundfile(pcm: bytes, format: str) -> bytes:
+    virtual_file = BytesIO()
+    soundfile.write(
+        virtual_file,
+        np.frombuffer(pcm, dtype=np.int16),
+        sample_rate,
+        format=format,
+        subtype="PCM_16",
+    )
+    return virtual_file.getvalue()
+
+
+def encode_with_ffmpeg(pcm: bytes, codec: Codec) -> bytes:
+    output_args = (
+        ["-c:a", "libopus", "-b:a", opus_bitrate, "-application", "voip", "-f", "ogg"]
+        if codec == "opus"
+        else ["-c:a", "flac", "-f", "flac"]
+    )
+    ffmpeg = subprocess.run(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-f",
+            "s16le",
+            "-ar",
+            str(sample_rate),
+            "-ac",
+            "1",
+            "-i",
+            "-",
+            *output_args,
+            "-",
+        ],
+        input=pcm,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return ffmpeg.stdout
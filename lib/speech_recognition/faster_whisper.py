@@ -0,0 +1,80 @@
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+from lib.delta_logging import logging
+import lib.speech_recognition.model_residency as model_residency
+from lib.speech_recognition.incremental_transcription import (
+    IncrementalTranscription,
+)
+
+try:
+    from faster_whisper import WhisperModel
+
+    faster_whisper_available = True
+except ImportError:
+    faster_whisper_available = False
+
+# Local speech recognition on the CPU, with faster-whisper, which runs Whisper models on CTranslate2, quantized to int8.
+#
+# The model is loaded once per process and kept resident across turns by `model_residency`, and the chunks are decoded
+# straight from the int16 audio of the buffer, converted to float32 in numpy, without going through a WAV file.
+# Chunking, stitching and the worker pool are the same as for the Whisper API, so partial transcriptions are ready
+# while the user is still speaking.
+#
+# Tuning is done through the environment (or the .env file), the defaults are meant for a Raspberry Pi 4:
+#
+#   FASTER_WHISPER_MODEL      tiny, base, small, medium, large-v3 or a path to a converted model (default base)
+#   FASTER_WHISPER_THREADS    threads used by each transcription (default 4)
+#   FASTER_WHISPER_BEAM_SIZE  1 is greedy decoding, the fastest (default 1)
+
+logger = logging.getLogger()
+
+model_size = os.environ.get("FASTER_WHISPER_MODEL", "base")
+cpu_threads = int(os.environ.get("FASTER_WHISPER_THREADS", "4"))
+beam_size = int(os.environ.get("FASTER_WHISPER_BEAM_SIZE", "1"))
+compute_type = "int8"
+
+
+def load_model() -> "WhisperModel":
+    return model_residency.resident(f"faster-whisper {model_size}", create_model)
+
+
+def create_model() -> "WhisperModel":
+    if not faster_whisper_available:
+        raise Exception(
+            "faster-whisper is not installed, run `pip install faster-whisper`"
+        )
+    return WhisperModel(
+        model_size, device="cpu", compute_type=compute_type, cpu_threads=cpu_threads
+    )
+
+
+def pcm_to_float(audio: bytes) -> np.ndarray:
+    return np.frombuffer(audio, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+class FasterWhisper(IncrementalTranscription):
+    # a stale decode can't be stopped, it keeps the CPU busy until it's done
+    detach_stale_workers = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        loader = threading.Thread(target=load_model, daemon=True)
+        loader.start()
+
+    def transcribe_chunk(
+        self, audio: bytes, prompt: str, language: Optional[str]
+    ) -> Tuple[str, Optional[str]]:
+        segments, info = load_model().transcribe(
+            pcm_to_float(audio),
+            language=language,
+            initial_prompt=prompt or None,
+            beam_size=beam_size,
+            # the chunks are short, the prompt is the context
+            condition_on_previous_text=False,
+        )
+        text = " ".join(segment.text.strip() for segment in segments)
+        return text, info.language
@@ -0,0 +1,330 @@
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, wait
+import statistics
+import threading
+from threading import Thread
+import time
+from typing import Deque, Dict, List, Optional, Set, Tuple
+
+from lib.delta_logging import logging
+import lib.latency_tracing as latency_tracing
+from lib.reply_cache import normalize
+
+# Base for the engines that transcribe the utterance chunk by chunk while the user is still speaking.
+#
+# Main only sends the audio that is new since the last flush, and each chunk is transcribed on its own, together with
+# the last `overlap` of the previous chunk, since a word cut in half at the border would otherwise be lost or garbled.
+# The text of consecutive chunks is then stitched by aligning the words they both transcribed from that overlap, so
+# they don't come out twice. By the time the endpoint fires, only the last chunk is still being transcribed.
+#
+# Each chunk is primed with the text transcribed so far, which helps the model with the spelling of names and the
+# style of the punctuation, and once the language was detected with enough confidence, it's pinned for the rest of
+# the conversation, so a short and ambiguous chunk is never transcribed as some other language.
+#
+# Chunks are transcribed by a fixed pool of workers, through a bounded queue: when the API is slow and the queue is
+# full, new audio is appended to the last chunk still waiting instead of piling up more requests. Each chunk gets a
+# Future, which is what the final transcription waits on. On `restart()` the chunks still waiting are cancelled, and
+# for the API engines, the workers stuck on a request for the previous utterance are replaced by fresh ones, so the new
+# utterance doesn't queue behind them while they finish in the background and their results are dropped. Replacements
+# are only started up to `max_workers` live workers in total, counting the detached ones, and the engines give each
+# request a `request_timeout`, so stuck requests can't pile up threads and connections.
+#
+# Local engines set `detach_stale_workers` to False: their stale decodes keep the CPU (or the whisper.cpp server) busy
+# until they are done, so extra workers would only compete with them. There the new utterance does wait for them.
+#
+# `shutdown()` cancels the chunks still waiting and lets every worker exit once it's done with its current one, for
+# when main restarts after an error and creates a new engine.
+
+logger = logging.getLogger()
+
+sample_rate = 16000
+# bytes of the previous chunk sent again with the next one
+overlap = int(0.5 * sample_rate) * 2
+# a minimum of 0.1s is required for whisper to process
+minimum_chunk = int(0.1 * sample_rate) * 2
+# how far to look for the words the two sides of an overlap have in common
+max_overlap_words = 8
+# the prompt is limited to 224 tokens, the end of the transcription is what matters
+max_prompt_characters = 200
+words_to_pin_language = 3  # shorter chunks are not enough to be sure of the language
+workers = 2
+# live workers, counting the ones detached on restart that are still finishing a request
+max_workers = 4
+# seconds, for the engines to give up on a chunk request long after collect_timeout did
+request_timeout = 10.0
+# chunks waiting for a worker, more audio than that is coalesced into the last one
+max_pending = 2
+collect_timeout = 3.0  # seconds
+
+
+def stitch(previous: str, following: str) -> str:
+    previous_words = previous.split()
+    following_words = following.split()
+    previous_keys = [normalize(word) for word in previous_words]
+    following_keys = [normalize(word) for word in following_words]
+
+    # the borders of the chunks can cut a word in half, so one word on each side is allowed to not match
+    for n in range(
+        min(max_overlap_words, len(previous_keys), len(following_keys)), 0, -1
+    ):
+        for trim_previous, skip_following in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+            end = len(previous_keys) - trim_previous
+            if end - n < 0 or skip_following + n > len(following_keys):
+                continue
+            if n == 1 and (trim_previous or skip_following):
+                # a single word in common is too weak to also throw words away, unless the one we drop is clearly
+                # the beginning of the word that comes next ("how ar" + "how are you")
+                cut_word = previous_keys[-1]
+                next_word = following_keys[skip_following + 1 : skip_following + 2]
+                if (
+                    skip_following
+                    or not cut_word
+                    or not next_word
+                    or not next_word[0].startswith(cut_word)
+                ):
+                    continue
+            if previous_keys[end - n : end] == following_keys[
+                skip_following : skip_following + n
+            ] and any(previous_keys[end - n : end]):
+                return " ".join(
+                    previous_words[:end] + following_words[skip_following + n :]
+                )
+
+    return " ".join(previous_words + following_words)
+
+
+class Chunk:
+    index: int
+    audio: bytes
+    future: "Future[str]"
+
+    def __init__(self, index: int, audio: bytes) -> None:
+        self.index = index
+        self.audio = audio
+        self.future = Future()
+
+
+class IncrementalTranscription(ABC):
+    condition: threading.Condition
+    pending: Deque[Chunk]
+    futures: Dict[int, "Future[str]"]
+    chunk_index: int
+    transcription_cut: int  # index of the first chunk of the current utterance
+    # the end of the audio sent so far, to be sent again with the next chunk
+    tail: bytes
+    carry: bytes  # new audio too short to be sent on its own yet
+    language: Optional[str]
+    # worker thread id -> index of the chunk it's transcribing
+    in_flight: Dict[int, int]
+    detached_workers: Set[int]  # busy with a previous utterance, exit once done
+    live_workers: int
+    detach_stale_workers: bool = True
+    shut_down: bool
+    sent_bytes: int
+    coalesced_chunks: int
+    max_queue_depth: int
+    request_latencies: List[float]
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.futures = {}
+        self.chunk_index = 0
+        self.transcription_cut = 0
+        self.tail = b""
+        self.carry = b""
+        self.language = None
+        self.in_flight = {}
+        self.detached_workers = set()
+        self.live_workers = workers
+        self.shut_down = False
+        self.reset_stats()
+        for _ in range(workers):
+            self.start_worker()
+
+    def reset_stats(self):
+        self.sent_bytes = 0
+        self.coalesced_chunks = 0
+        self.max_queue_depth = 0
+        self.request_latencies = []
+
+    def start_worker(self):
+        thread = Thread(target=self.work, daemon=True)
+        thread.start()
+
+    def restart(self):
+        with self.condition:
+            for chunk in self.pending:
+                chunk.future.cancel()
+            self.pending.clear()
+            self.transcription_cut = self.chunk_index
+            self.futures = {}
+            self.tail = b""
+            self.carry = b""
+            self.reset_stats()
+
+            replacements = 0
+            if self.detach_stale_workers:
+                stale_workers = set(self.in_flight.keys()) - self.detached_workers
+                replacements = min(len(stale_workers), max_workers - self.live_workers)
+                if replacements < len(stale_workers):
+                    logger.warning(
+                        "%d transcription workers still busy with previous utterances, not replacing %d of them",
+                        len(self.detached_workers) + len(stale_workers),
+                        len(stale_workers) - replacements,
+                    )
+                # the ones that can't be replaced stay in the pool and pick up the new chunks once done
+                self.detached_workers |= set(list(stale_workers)[:replacements])
+                self.live_workers += replacements
+        for _ in range(replacements):
+            self.start_worker()
+
+    def stop(self):
+        # the conversation is over, the next one might be in some other language
+        self.language = None
+
+    def shutdown(self):
+        with self.condition:
+            self.shut_down = True
+            for chunk in self.pending:
+                chunk.future.cancel()
+            self.pending.clear()
+            self.condition.notify_all()
+
+    @abstractmethod
+    def transcribe_chunk(
+        self, audio: bytes, prompt: str, language: Optional[str]
+    ) -> Tuple[str, Optional[str]]:
+        """Returns the text of the chunk and, if the engine can tell, the language it detected"""
+
+    def consume(self, audio_buffer):
+        new_audio = self.carry + bytes(audio_buffer)
+        if len(new_audio) < minimum_chunk:
+            # too short on its own, goes together with the next chunk
+            self.carry = new_audio
+            return
+        self.carry = b""
+
+        with self.condition:
+            if len(self.pending) >= max_pending:
+                self.pending[-1].audio += new_audio
+                self.coalesced_chunks += 1
+            else:
+                chunk = Chunk(self.chunk_index, self.tail + new_audio)
+                self.pending.append(chunk)
+                self.futures[chunk.index] = chunk.future
+                self.chunk_index += 1
+                self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+            self.tail = (self.tail + new_audio)[-overlap:]
+            self.condition.notify()
+
+    def work(self):
+        worker_id = threading.get_ident()
+        while True:
+            with self.condition:
+                while len(self.pending) == 0 and not self.shut_down:
+                    self.condition.wait()
+                if self.shut_down:
+                    return
+                chunk = self.pending.popleft()
+                if not chunk.future.set_running_or_notify_cancel():
+                    continue
+                self.in_flight[worker_id] = chunk.index
+                # primed with the latest text, which by now includes the chunks that were in flight when it was queued
+                prompt = self.stitched_so_far()[-max_prompt_characters:]
+                language = self.language
+                self.sent_bytes += len(chunk.audio)
+
+            self.transcribe(chunk, prompt, language)
+
+            with self.condition:
+                del self.in_flight[worker_id]
+                if worker_id in self.detached_workers:
+                    self.detached_workers.discard(worker_id)
+                    self.live_workers -= 1
+                    return
+
+    def transcribe(self, chunk: Chunk, prompt: str, language: Optional[str]):
+        started_at = time.time()
+        try:
+            text, detected_language = self.transcribe_chunk(
+                chunk.audio, prompt, language
+            )
+        except Exception as err:
+            chunk.future.set_exception(err)
+            return
+
+        with self.condition:
+            if chunk.index < self.transcription_cut:
+                chunk.future.set_result(text.strip())
+                return  # from before a restart, nobody is waiting for it anymore
+            self.request_latencies.append(time.time() - started_at)
+        latency_tracing.mark("transcription_completed")
+        if (
+            self.language is None
+            and detected_language is not None
+            and len(text.split()) >= words_to_pin_language
+        ):
+            logger.info("Pinning transcription language to %s", detected_language)
+            self.language = detected_language
+        chunk.future.set_result(text.strip())
+
+    def stitched_so_far(self, skip_missing: bool = False) -> str:
+        """Stitches the chunks transcribed so far, stopping at the first one still in flight unless skip_missing"""
+        text = ""
+        for index in range(self.transcription_cut, self.chunk_index):
+            future = self.futures.get(index)
+            if future is None or not future.done():
+                if skip_missing:
+                    continue
+                break
+            if not future.cancelled() and future.exception() is None:
+                text = stitch(text, future.result())
+        return text
+
+    def partial_transcription(self) -> Optional[str]:
+        try:
+            return self.collect_transcriptions()
+        except Exception:
+            return None
+
+    def transcribe_and_stop(self):
+        result = self.collect_transcriptions()
+        logger.info("Transcription: %s", result)
+        self.log_stats()
+        return result
+
+    def collect_transcriptions(self) -> str:
+        futures = list(self.futures.values())
+        done, not_done = wait(futures, timeout=collect_timeout)
+        if not_done:
+            logger.warning(
+                "%d transcription chunks still not done after %.0fs, leaving them out",
+                len(not_done),
+                collect_timeout,
+            )
+
+        errors = [
+            future.exception()
+            for future in done
+            if not future.cancelled() and future.exception() is not None
+        ]
+        if len(futures) > 0 and len(errors) == len(futures):
+            raise errors[0]  # type: ignore
+
+        return self.stitched_so_far(skip_missing=True)
+
+    def log_stats(self):
+        if len(self.request_latencies) == 0:
+            return
+        logger.info(
+            "Transcribed in %d requests (%d chunks coalesced, max queue depth %d), %.0fKB of audio sent, "
+            "request latency p50 %.0fms, max %.0fms",
+            len(self.request_latencies),
+            self.coalesced_chunks,
+            self.max_queue_depth,
+            self.sent_bytes / 1024,
+            statistics.median(self.request_latencies) * 1000,
+            max(self.request_latencies) * 1000,
+        )
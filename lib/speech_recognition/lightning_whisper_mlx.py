@@ -5,35 +5,41 @@ from typing import Optional
 from lightning_whisper_mlx import LightningWhisperMLX
 
 from lib.delta_logging import logging
+import lib.speech_recognition.model_residency as model_residency
 
 logger = logging.getLogger()
 
 
+def load_model() -> LightningWhisperMLX:
+    return model_residency.resident(
+        "lightning-whisper-mlx base",
+        lambda: LightningWhisperMLX(model="base", batch_size=12, quant=None),
+    )
+
+
 class LightningWhisperMlx:
-    whisper: Optional[LightningWhisperMLX]
-    audio_buffer = bytearray()
+    audio_buffer: bytearray
 
     def __init__(self) -> None:
-        self.whisper = None
+        self.audio_buffer = bytearray()
 
     def restart(self):
-        self.stop()
-        self.whisper = LightningWhisperMLX(model="base", batch_size=12, quant=None)
         self.audio_buffer = bytearray()
+        load_model()  # only loaded the first time, it stays resident across restarts
 
     def stop(self):
-        if self.whisper is None:
-            return
+        self.audio_buffer = bytearray()
 
-        self.whisper = None
+    def shutdown(self):
+        pass  # the model is left to model_residency
 
     def consume(self, audio_buffer):
         self.audio_buffer.extend(audio_buffer)
 
-    def transcribe_and_stop(self):
-        if self.whisper is None:
-            return
+    def partial_transcription(self) -> Optional[str]:
+        return None  # only transcribes the whole buffer at the end
 
+    def transcribe_and_stop(self):
         temp_file = tempfile.NamedTemporaryFile(delete=True, suffix=".wav")
 
         with wave.open(temp_file.name, "wb") as wav_file:
@@ -42,7 +48,7 @@ class LightningWhisperMlx:
             wav_file.setframerate(16000)
             wav_file.writeframes(self.audio_buffer)
 
-        result = str(self.whisper.transcribe(temp_file.name)["text"])
+        result = str(load_model().transcribe(temp_file.name)["text"])
 
         logger.info("Transcription: %s", result)
         return result
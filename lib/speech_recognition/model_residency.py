@@ -0,0 +1,186 @@
+from concurrent.futures import Future
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+import psutil
+
+from lib.delta_logging import logging
+
+# Keeps the local speech recognition models loaded across turns and conversations.
+#
+# Engines reset their own session state on `restart()` and `stop()`, which happens several times per conversation,
+# but get the model itself from `resident()`, which only loads it the first time, so loading is kept out of the turns
+# altogether. Models are only unloaded when the memory they take goes over `memory_budget`, least recently used first,
+# or when they were not used for `idle_timeout` while BMO is on standby, waiting for the wake up word.
+#
+# The memory of each model is measured as the growth of the process RSS while loading it, or with `measure` for models
+# that live outside of the process, like the whisper.cpp server, and reported together with the load times.
+#
+# The lock is only held to look a model up and to register it, never while loading: the first caller registers a
+# Future for the name and loads the model, the others asking for that same model wait on the Future, and everything
+# else (other models, the stats, the idle eviction) goes on in the meantime. Two models loading at once in the same
+# process would both count the RSS growth of the other, but each process only runs one engine.
+
+logger = logging.getLogger()
+
+T = TypeVar("T")
+
+idle_timeout = 30 * 60.0  # seconds unused on standby before a model is unloaded
+# bytes, set from --model-memory-budget, None never unloads for memory
+memory_budget: Optional[int] = None
+
+
+class ResidentModel:
+    name: str
+    model: Any
+    unload: Optional[Callable[[Any], None]]
+    measure: Optional[Callable[[Any], int]]
+    load_time: float
+    loaded_memory: int  # RSS growth while loading
+    last_used: float
+
+    def __init__(
+        self,
+        name: str,
+        model: Any,
+        unload: Optional[Callable[[Any], None]],
+        measure: Optional[Callable[[Any], int]],
+        load_time: float,
+        loaded_memory: int,
+    ) -> None:
+        self.name = name
+        self.model = model
+        self.unload = unload
+        self.measure = measure
+        self.load_time = load_time
+        self.loaded_memory = loaded_memory
+        self.last_used = time.time()
+
+    def memory(self) -> int:
+        if self.measure is not None:
+            try:
+                return self.measure(self.model)
+            except Exception:
+                return 0
+        return self.loaded_memory
+
+
+_models: Dict[str, ResidentModel] = {}
+# name -> the model being loaded, for the callers that ask for it meanwhile
+_loading: Dict[str, "Future[Any]"] = {}
+_models_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def resident(
+    name: str,
+    load: Callable[[], T],
+    unload: Optional[Callable[[T], None]] = None,
+    measure: Optional[Callable[[T], int]] = None,
+) -> T:
+    """Returns the model loaded under this name, loading it first if it's not resident yet"""
+    global _models_pid
+    with _lock:
+        if _models_pid != os.getpid():
+            # inherited from the parent process, not ours to use
+            _models.clear()
+            _loading.clear()
+            _models_pid = os.getpid()
+
+        entry = _models.get(name)
+        if entry is not None:
+            entry.last_used = time.time()
+            return entry.model
+
+        loading = _loading.get(name)
+        if loading is not None:
+            waiting = True
+        else:
+            waiting = False
+            loading = Future()
+            _loading[name] = loading
+
+    if waiting:
+        return loading.result()  # raises whatever the load raised
+
+    try:
+        process = psutil.Process()
+        rss_before = process.memory_info().rss
+        started_at = time.time()
+        model = load()
+        load_time = time.time() - started_at
+        loaded_memory = max(process.memory_info().rss - rss_before, 0)
+    except BaseException as err:
+        with _lock:
+            del _loading[name]
+        loading.set_exception(err)
+        raise
+
+    with _lock:
+        del _loading[name]
+        entry = ResidentModel(name, model, unload, measure, load_time, loaded_memory)
+        _models[name] = entry
+        logger.info(
+            "Loaded %s in %.1fs, %.0fMB resident",
+            name,
+            entry.load_time,
+            entry.memory() / 1024 / 1024,
+        )
+        enforce_budget(keep=name)
+    loading.set_result(model)
+    return model
+
+
+def enforce_budget(keep: str):
+    if memory_budget is None:
+        return
+    while sum(entry.memory() for entry in _models.values()) > memory_budget:
+        candidates = [entry for entry in _models.values() if entry.name != keep]
+        if len(candidates) == 0:
+            logger.warning(
+                "%s alone takes more than the model memory budget of %.0fMB",
+                keep,
+                memory_budget / 1024 / 1024,
+            )
+            return
+        least_recently_used = min(candidates, key=lambda entry: entry.last_used)
+        unload_entry(least_recently_used, "over the memory budget")
+
+
+def unload_entry(entry: ResidentModel, reason: str):
+    del _models[entry.name]
+    logger.info("Unloading %s, %s", entry.name, reason)
+    if entry.unload is not None:
+        entry.unload(entry.model)
+
+
+def unload(name: str):
+    with _lock:
+        entry = _models.get(name)
+        if entry is not None:
+            unload_entry(entry, "on request")
+
+
+def evict_idle():
+    """Unloads the models not used for a long time, called while on standby"""
+    with _lock:
+        now = time.time()
+        for entry in list(_models.values()):
+            if now - entry.last_used > idle_timeout:
+                unload_entry(
+                    entry, f"idle for {(now - entry.last_used) / 60:.0f} minutes"
+                )
+
+
+def log_stats():
+    with _lock:
+        for entry in _models.values():
+            logger.info(
+                "Resident model %s: loaded in %.1fs, %.0fMB, last used %.0fs ago",
+                entry.name,
+                entry.load_time,
+                entry.memory() / 1024 / 1024,
+                time.time() - entry.last_used,
+            )
@@ -1,92 +1,95 @@
 from io import BytesIO
 import os
-from threading import Thread
 import time
-from typing import Dict, Union
-import wave
+from typing import Optional, Tuple
 
 from openai import OpenAI
 
 from lib.delta_logging import logging
+import lib.http_transport as http_transport
+from lib.per_process import per_process
+import lib.speech_recognition.audio_codecs as audio_codecs
+from lib.speech_recognition.incremental_transcription import (
+    IncrementalTranscription,
+    request_timeout,
+)
 
 logger = logging.getLogger()
-openai = OpenAI(
-    api_key=os.environ["OPENAI_API_KEY"],
+openai_api_key = os.environ["OPENAI_API_KEY"]
+openai = per_process(
+    lambda: OpenAI(
+        api_key=openai_api_key,
+        http_client=http_transport.http_client(),
+        timeout=request_timeout,
+        max_retries=1,  # a chunk that's late is left out of the transcription anyway
+    )
 )
-
-
-class WhisperAPI:
-    transcription_index: int
-    transcription_cut: int
-    transcription_results: Dict[int, Union[Exception, str]]
-
-    def __init__(self) -> None:
-        self.transcription_index = 0
-
-    def restart(self):
-        self.stop()
-        self.transcription_cut = self.transcription_index
-        self.transcription_results = {}
-
-    def stop(self):
-        pass
-
-    def consume(self, audio_buffer):
-        if (
-            len(audio_buffer) < 0.1 * 512 * 32
-        ):  # a minimum of 0.1s is required for whisper to process
-            return
-        thread = Thread(
-            target=self.transcribe_async, args=(audio_buffer, self.transcription_index)
-        )
-        thread.start()
-        self.transcription_index += 1
-
-    def transcribe_async(self, audio_buffer, index):
-        try:
-            audio_file = self.create_audio_file(audio_buffer)
-
-            transcription = openai.audio.transcriptions.create(
-                model="whisper-1", file=audio_file
+http_transport.register("https://api.openai.com/v1")
+
+# the API detects the language by name, but only takes it back as an ISO-639-1 code
+language_codes = {
+    "english": "en",
+    "portuguese": "pt",
+    "spanish": "es",
+    "french": "fr",
+    "german": "de",
+    "italian": "it",
+    "dutch": "nl",
+    "polish": "pl",
+    "russian": "ru",
+    "ukrainian": "uk",
+    "turkish": "tr",
+    "arabic": "ar",
+    "hindi": "hi",
+    "japanese": "ja",
+    "korean": "ko",
+    "chinese": "zh",
+    "swedish": "sv",
+    "norwegian": "no",
+    "danish": "da",
+    "finnish": "fi",
+    "czech": "cs",
+    "greek": "el",
+    "hebrew": "he",
+    "indonesian": "id",
+    "vietnamese": "vi",
+    "thai": "th",
+    "romanian": "ro",
+    "hungarian": "hu",
+}
+
+
+class WhisperAPI(IncrementalTranscription):
+    def transcribe_chunk(
+        self, audio: bytes, prompt: str, language: Optional[str]
+    ) -> Tuple[str, Optional[str]]:
+        codec = audio_codecs.choose_codec(len(audio))
+        encoded = audio_codecs.encode(audio, codec)
+        audio_codecs.uplink.record_encoding(encoded.codec, len(audio), encoded)
+        audio_file = BytesIO(encoded.data)
+        audio_file.name = encoded.filename
+
+        started_at = time.perf_counter()
+        if language is not None:
+            response = openai().audio.transcriptions.with_raw_response.create(
+                model="whisper-1", file=audio_file, prompt=prompt, language=language
             )
-
-            if index >= self.transcription_cut:
-                self.transcription_results[index] = transcription.text  # type: ignore
-        except Exception as err:
-            if index >= self.transcription_cut:
-                self.transcription_results[index] = err
-
-    def transcribe_and_stop(self):
-        now = time.time()
-        minimum_transcriptions = max(
-            self.transcription_index - self.transcription_cut, 1
+        else:
+            # verbose_json is what tells which language it detected
+            response = openai().audio.transcriptions.with_raw_response.create(
+                model="whisper-1",
+                file=audio_file,
+                prompt=prompt,
+                response_format="verbose_json",
+            )
+        # without the time the server spent transcribing, what's left is mostly the upload
+        processing_time = float(response.headers.get("openai-processing-ms", 0)) / 1000
+        audio_codecs.uplink.record_upload(
+            len(encoded.data), time.perf_counter() - started_at - processing_time
         )
 
-        while (
-            self.transcription_index >= minimum_transcriptions
-            and len(self.transcription_results.values()) < minimum_transcriptions
-        ):
-            if time.time() - now > 3:
-                break
-            time.sleep(0.03)
-
-        results = list(self.transcription_results.values())
-        if len(results) == 1 and isinstance(results[0], Exception):
-            raise results[0]
-
-        result = " ".join([r for r in results if type(r) == str])
-        logger.info("Transcription: %s", result)
-        return result
-
-    def create_audio_file(self, recording_audio_buffer):
-        virtual_file = BytesIO()
-        wav_file = wave.open(virtual_file, "wb")
-        wav_file.setnchannels(1)
-        wav_file.setsampwidth(2)
-        wav_file.setframerate(16000)
-        wav_file.writeframes(recording_audio_buffer)
-        wav_file.close()
-        virtual_file.name = "recording.wav"
-        virtual_file.seek(0)
-
-        return virtual_file
+        transcription = response.parse()
+        detected_language = getattr(transcription, "language", None)
+        return transcription.text, language or language_codes.get(
+            str(detected_language).lower()
+        )
@@ -1,58 +1,154 @@
+import atexit
 import subprocess
-from typing import Optional
+import threading
+from threading import Thread
+import time
+from typing import Optional, Tuple
+
+import httpx
+import psutil
+
 from lib.delta_logging import logging
+import lib.speech_recognition.model_residency as model_residency
+from lib.speech_recognition.audio_codecs import encode_wav
+from lib.speech_recognition.incremental_transcription import (
+    IncrementalTranscription,
+    request_timeout,
+)
+
+# Runs whisper.cpp as a resident server, fed with the same audio chunks as the Whisper API engine.
+#
+# The server example of whisper.cpp loads the model once and then transcribes each WAV posted to its /inference
+# endpoint, on localhost, so the model stays in memory across turns instead of being loaded from disk on every
+# restart, and the recording, voice activity detection and chunking are shared with the other engines through
+# `IncrementalTranscription`. The server is started in the background as soon as the engine is created, and the
+# chunks wait for it to be ready. It's kept running by `model_residency`, which only kills it when it's over the memory
+# budget or idle for long on standby, and it's killed when BMO exits.
+#
+# It talks to the server through a plain httpx client of its own rather than the shared one of `http_transport`: the
+# requests never leave localhost, so there's no connection setup worth tracing, and counting them would skew the stats
+# of the remote APIs.
 
 logger = logging.getLogger()
 
+SERVER_PATH = "./whisper.cpp/server"
+MODEL_PATH = "./whisper.cpp/models/ggml-medium.en.bin"
+host = "127.0.0.1"
+port = 8178
+threads = 8
+startup_timeout = 60.0  # seconds, loading the medium model on the Raspberry Pi is slow
+startup_poll_interval = 0.1
 
-class WhisperCpp:
-    whispercpp: Optional[subprocess.Popen]
-    first: bool
+
+class WhisperCppServer:
+    process: Optional[subprocess.Popen]
+    client: httpx.Client
+    ready: threading.Event
+    lock: threading.Lock
 
     def __init__(self) -> None:
-        self.whispercpp = None
-
-    def restart(self):
-        self.stop()
-        self.whispercpp = subprocess.Popen(
-            args=[
-                "./whisper.cpp/stream",
-                "-m",
-                "./whisper.cpp/models/ggml-medium.en.bin",
-                "-t",
-                "8",
-                "--step",
-                "500",
-                "--length",
-                "5000",
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
+        self.process = None
+        self.client = httpx.Client()
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+        self.start()
+
+    def start(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+            if self.process is not None:
+                logger.warning("whisper.cpp server died, starting it again")
+            self.ready.clear()
+            if self.client.is_closed:
+                self.client = httpx.Client()
+            self.process = subprocess.Popen(
+                args=[
+                    SERVER_PATH,
+                    "-m",
+                    MODEL_PATH,
+                    "-t",
+                    str(threads),
+                    "--host",
+                    host,
+                    "--port",
+                    str(port),
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            waiter = Thread(
+                target=self.wait_for_startup, args=(self.process,), daemon=True
+            )
+            waiter.start()
+
+    def wait_for_startup(self, process: subprocess.Popen):
+        started_at = time.time()
+        while time.time() - started_at < startup_timeout and process.poll() is None:
+            try:
+                self.client.get(self.url("/"), timeout=1)
+                logger.info(
+                    "whisper.cpp server ready in %.1fs", time.time() - started_at
+                )
+                self.ready.set()
+                return
+            except httpx.TransportError:
+                time.sleep(startup_poll_interval)
+        logger.error("whisper.cpp server failed to start")
+
+    def url(self, path: str) -> str:
+        return f"http://{host}:{port}{path}"
+
+    def inference(self, audio: bytes, prompt: str, language: Optional[str]) -> str:
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        if not self.ready.wait(timeout=startup_timeout):
+            raise Exception("whisper.cpp server is not running")
+
+        data = {"response_format": "json", "temperature": "0.0", "prompt": prompt}
+        if language is not None:
+            data["language"] = language
+        response = self.client.post(
+            self.url("/inference"),
+            files={"file": ("recording.wav", encode_wav(audio), "audio/wav")},
+            data=data,
+            timeout=request_timeout,
         )
-        self.first = True
+        response.raise_for_status()
+        return response.json()["text"]
 
-    def stop(self):
-        if self.whispercpp is None:
-            return
+    def memory(self) -> int:
+        if self.process is None or self.process.poll() is not None:
+            return 0
+        return psutil.Process(self.process.pid).memory_info().rss
 
-        self.whispercpp.stdin.close()  # type: ignore
-        self.whispercpp.kill()
-        self.whispercpp = None
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process = None
+        self.client.close()
 
-    def consume(self, audio_buffer):
-        pass
 
-    def transcribe_and_stop(self):
-        if self.whispercpp is None:
-            return ""
+def server() -> WhisperCppServer:
+    return model_residency.resident(
+        "whisper.cpp server",
+        WhisperCppServer,
+        unload=WhisperCppServer.close,
+        measure=WhisperCppServer.memory,
+    )
 
-        self.whispercpp.terminate()
-        output, _ = self.whispercpp.communicate()
-        output_lines = output.decode().split("\n")
-        output_lines = [line.split("\x1b[2K\r")[-1].strip() for line in output_lines]
-        output = "\n".join([line for line in output_lines if line != ""])
-        logger.info("Transcription: %s", output)
-        self.whispercpp.kill()
 
-        return output
+class WhisperCpp(IncrementalTranscription):
+    # the server decodes one request at a time, stale ones included
+    detach_stale_workers = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        server()  # starts loading the model right away
+
+    def transcribe_chunk(
+        self, audio: bytes, prompt: str, language: Optional[str]
+    ) -> Tuple[str, Optional[str]]:
+        return server().inference(audio, prompt, language), None
@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+import importlib.abc
+import sys
+import threading
+import time
+from typing import Any, Iterator, List, NamedTuple, Optional
+
+# Startup profile, enabled with --startup-profile, to find out what makes BMO slow to start, on the Raspberry Pi
+# mostly the imports of heavy libraries.
+#
+# `install()` puts a finder at the front of sys.meta_path, which lets the regular finders find each module and only
+# wraps its loader, to time how long executing the module took, both in total and without the modules it imported
+# itself. Initialization steps are timed by wrapping them in `phase()`. `report()` prints the phases and the slowest
+# modules once BMO is ready to listen.
+#
+# This module must not import anything outside of the standard library, it's imported before everything else so
+# their imports can be timed.
+
+report_limit = 25  # slowest modules listed
+
+
+class ModuleTiming(NamedTuple):
+    name: str
+    total: float  # seconds, including the modules it imported
+    own: float  # seconds, without the modules it imported
+
+
+enabled = False
+started_at: Optional[float] = None
+imports: List[ModuleTiming] = []
+phases: List[ModuleTiming] = []
+_stack = threading.local()  # time spent in nested imports, per module being imported
+
+
+class TimingLoader(importlib.abc.Loader):
+    loader: Any
+
+    def __init__(self, loader: Any) -> None:
+        self.loader = loader
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack: List[float] = _stack.__dict__.setdefault("nested", [])
+        stack.append(0.0)
+        exec_started_at = time.perf_counter()
+        try:
+            self.loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - exec_started_at
+            nested = stack.pop()
+            if stack:
+                stack[-1] += total
+            imports.append(ModuleTiming(module.__name__, total, total - nested))
+            # put the original loader back, some libraries look at it
+            module.__loader__ = self.loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self.loader
+
+
+class TimingFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = TimingLoader(spec.loader)
+            return spec
+        return None
+
+
+def install():
+    global enabled, started_at
+    enabled = True
+    started_at = time.perf_counter()
+    sys.meta_path.insert(0, TimingFinder())
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    if not enabled:
+        yield
+        return
+    imports_before = sum(timing.own for timing in imports)
+    phase_started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - phase_started_at
+        imported = sum(timing.own for timing in imports) - imports_before
+        phases.append(ModuleTiming(name, total, total - imported))
+
+
+def report():
+    if not enabled or started_at is None:
+        return
+
+    total_imports = sum(timing.own for timing in imports)
+    print(f"Startup profile, ready in {time.perf_counter() - started_at:.2f}s")
+    print(f"  {len(imports)} modules imported in {total_imports:.2f}s")
+    print("  Initialization:")
+    for timing in phases:
+        print(
+            f"    {timing.name:<40} {timing.total * 1000:8.0f}ms, "
+            f"{(timing.total - timing.own) * 1000:.0f}ms of it importing"
+        )
+    print("  Slowest modules (own time, and including what they import):")
+    for timing in sorted(imports, key=lambda timing: timing.own, reverse=True)[
+        :report_limit
+    ]:
+        print(
+            f"    {timing.name:<40} {timing.own * 1000:8.1f}ms {timing.total * 1000:8.1f}ms"
+        )
@@ -1,11 +1,10 @@
 import multiprocessing
-import subprocess
-from typing import Dict, Optional, Type
+from typing import Optional
 from typing_extensions import Protocol
 from lib.delta_logging import logging
-from lib.text_to_speech.elevenlabs_api import ElevenLabsAPI
-from lib.text_to_speech.native_tts import NativeTTS
-from lib.text_to_speech.piper_tts import PiperTTS
+from lib.engine_registry import EngineRegistry
+from lib.reply_events import ReplyAudioEnded, ReplyAudioStarted
+from lib.text_to_speech.audio_output import decode_clip, preload, shared_output
 
 
 logger = logging.getLogger()
@@ -30,32 +29,27 @@ class TextToSpeech(Protocol):
         pass
 
 
-ENGINES: Dict[str, Type[TextToSpeech]] = {
-    "native": NativeTTS,
-    "elevenlabs": ElevenLabsAPI,
-    "piper": PiperTTS,
-}
+ENGINES: EngineRegistry[TextToSpeech] = EngineRegistry(
+    {
+        "native": "lib.text_to_speech.native_tts:NativeTTS",
+        "elevenlabs": "lib.text_to_speech.elevenlabs_api:ElevenLabsAPI",
+        "piper": "lib.text_to_speech.piper_tts:PiperTTS",
+    }
+)
 
 
 def play_audio_file_non_blocking(audio_file):
-    filename = f"static/{audio_file}"
-    subprocess.Popen(
-        ["ffplay", filename, "-autoexit", "-nodisp"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.STDOUT,
-    )
+    shared_output().play(decode_clip(audio_file))
 
 
 def play_audio_file(filename, reply_out_queue: Optional[multiprocessing.Queue] = None):
-    filename = f"static/{filename}"
-    ffplay = subprocess.Popen(
-        ["ffplay", filename, "-autoexit", "-nodisp"],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.STDOUT,
-    )
-    if reply_out_queue is not None:
-        reply_out_queue.put(("reply_audio_started", ffplay.pid))
-    ffplay.wait()
+    def audio_started(started_at: float):
+        if reply_out_queue is not None:
+            reply_out_queue.put(ReplyAudioStarted(started_at))
+
+    output = shared_output()
+    end_marker = output.play(decode_clip(filename), on_start=audio_started)
+    output.wait_until(end_marker)
     logger.info("Playing audio done")
     if reply_out_queue is not None:
-        reply_out_queue.put(("reply_audio_ended", None))
+        reply_out_queue.put(ReplyAudioEnded())
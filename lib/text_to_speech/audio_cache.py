@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from typing import Any, Dict, Optional
+
+from lib.delta_logging import logging
+
+# Content-addressed cache of synthesized audio, so the phrases that keep coming back (greetings, goodbyes, "hashtag",
+# the usual small talk) are synthesized once and then played straight from disk.
+#
+# Each entry is a file named after the sha256 of (engine, voice, settings, text), holding the audio exactly as the
+# engine produced it, so a hit can be pushed to the player as is. The directory is bounded in size, evicting the least
+# recently used files, tracked by their modification time, which is bumped on every hit. Several processes may share
+# the directory, every write goes through a temporary file and an atomic rename.
+#
+# Only ElevenLabs and Piper use it. The native engine hands each sentence to `say` or `espeak-ng`, which synthesize and
+# play it in one go on their own audio device (see lib/text_to_speech/native_tts.py), so there is no audio to keep,
+# and both are fast enough locally that caching them wouldn't save much.
+
+logger = logging.getLogger()
+
+default_directory = os.path.join(".cache", "tts")
+max_size = 100 * 1024 * 1024  # 100MB
+max_text_length = 300  # longer sentences are unlikely to ever repeat
+
+
+def normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+class AudioCache:
+    engine: str
+    fingerprint: str
+    directory: str
+    lock: threading.Lock
+    size: Optional[int]  # lazily computed on the first write
+    hits: int
+    misses: int
+    characters_saved: int
+
+    def __init__(
+        self,
+        engine: str,
+        voice: str,
+        settings: Dict[str, Any],
+        directory: str = default_directory,
+    ) -> None:
+        self.engine = engine
+        self.fingerprint = json.dumps([engine, voice, settings], sort_keys=True)
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.characters_saved = 0
+
+    def path(self, text: str) -> str:
+        key = hashlib.sha256(
+            (self.fingerprint + "\n" + normalize(text)).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.directory, key)
+
+    def get(self, text: str) -> Optional[bytes]:
+        if len(text) > max_text_length:
+            return None
+
+        path = self.path(text)
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+            self.characters_saved += len(text)
+            logger.info(
+                "TTS cache hit for %s, %d/%d hits so far, %d characters not synthesized",
+                self.engine,
+                self.hits,
+                self.hits + self.misses,
+                self.characters_saved,
+            )
+        return audio
+
+    def put(self, text: str, audio: bytes):
+        if len(text) > max_text_length or len(audio) == 0:
+            return
+
+        path = self.path(text)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary_path, "wb") as f:
+                f.write(audio)
+            os.replace(temporary_path, path)
+        except OSError as err:
+            logger.warning("Could not write to the TTS cache: %s", err)
+            return
+
+        with self.lock:
+            if self.size is None:
+                self.size = self.directory_size()
+            else:
+                self.size += len(audio)
+            if self.size > max_size:
+                self.evict()
+
+    def directory_size(self) -> int:
+        return sum(
+            entry.stat().st_size
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        )
+
+    def evict(self):
+        entries = [
+            entry
+            for entry in os.scandir(self.directory)
+            if entry.is_file() and not entry.name.endswith(".tmp")
+        ]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+        # evict down to 90%, so we are not evicting again on every write
+        for entry in entries:
+            if size <= max_size * 0.9:
+                break
+            try:
+                file_size = entry.stat().st_size
+                os.remove(entry.path)
+                size -= file_size
+            except OSError:
+                pass  # already evicted by another process
+        self.size = size
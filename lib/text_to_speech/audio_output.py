@@ -0,0 +1,412 @@
+from abc import ABC, abstractmethod
+from collections import deque
+import functools
+import itertools
+import multiprocessing
+from multiprocessing import Queue
+import os
+import subprocess
+import threading
+from threading import Thread
+import time
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from lib.delta_logging import logging
+
+try:
+    import sounddevice
+
+    sounddevice_available = True
+except (ImportError, OSError):  # OSError when the PortAudio library itself is missing
+    sounddevice_available = False
+
+# One long lived audio output per process, that every TTS engine and every sound effect plays raw PCM (signed 16 bit,
+# mono) through, instead of starting a new ffplay, which has to start up and probe its input, for every reply and
+# every beep. The static clips are decoded once and kept in memory.
+#
+# `play()` only appends to a buffer and returns a marker for the end of that audio, the output drains the buffer from
+# the sounddevice callback, so playback position is known exactly, and `on_start` gets the wall clock time the audio
+# actually reached the speaker, accounting for the output latency. `clear()` drops everything that didn't play yet,
+# which is how an interrupted reply is silenced.
+#
+# Without sounddevice (or without PortAudio, like on a headless box), or when the device can't be opened, the same
+# buffer is fed to a persistent ffplay instead, paced to real time, so position and start times are estimates there.
+#
+# Only the main process opens the audio device: a raw ALSA device can't be opened twice, so the reply workers don't
+# open one of their own. A `worker_channel()` is passed to each of them when it's started, like the latency trace
+# queue, and their `shared_output()` feeds its audio queue, paced to real time the same way as ffplay, while a thread
+# of main plays what comes out of it. The chunks where a `play()` with `on_start` begins carry a token, main sends the
+# time they really started playing back on the worker's own started queue, and the worker calls `on_start` with it.
+# Everything plays at the same `sample_rate`, engines producing some other rate `resample()` first, so there is a
+# single stream. The native TTS engine doesn't go through here at all, see native_tts.py.
+
+logger = logging.getLogger()
+
+sample_rate = 22050  # what Piper and the pcm_22050 format of Elevenlabs produce
+chunk_duration = 0.05  # seconds, how often the paced outputs are fed
+# seconds of audio the paced outputs are fed ahead, what still plays after a clear
+max_lead = 0.2
+
+
+class WorkerChannel(NamedTuple):
+    key: int
+    audio: Queue  # (pcm, key, starts) from all the reply workers to main
+    started: Queue  # [(token, started_at)] from main back to this worker
+
+
+# set in the reply workers, their audio is played by main
+channel: Optional[WorkerChannel] = None
+_audio_queue: Optional[Queue] = None
+_started_queues: Dict[int, Queue] = {}  # main side, by channel key
+# the process playing what comes through _audio_queue
+_serving_pid: Optional[int] = None
+_output: Optional["AudioOutput"] = None
+_output_pid: Optional[int] = None
+_outputs_lock = threading.Lock()
+
+
+class AudioOutput:
+    sample_rate: int
+    bytes_per_second: int
+    condition: threading.Condition
+    buffer: bytearray
+    written: int  # bytes ever passed to play()
+    consumed: int  # bytes ever played or cleared
+    pending_starts: Deque[Tuple[int, Callable[[float], None]]]
+    started: Deque[Tuple[float, Callable[[float], None]]]
+
+    def __init__(self, sample_rate: int) -> None:
+        self.sample_rate = sample_rate
+        self.bytes_per_second = sample_rate * 2
+        self.condition = threading.Condition()
+        self.buffer = bytearray()
+        self.written = 0
+        self.consumed = 0
+        self.pending_starts = deque()
+        self.started = deque()
+        notifier = Thread(target=self.notify_starts, daemon=True)
+        notifier.start()
+
+    def play(
+        self, pcm: bytes, on_start: Optional[Callable[[float], None]] = None
+    ) -> int:
+        with self.condition:
+            if on_start is not None:
+                self.pending_starts.append((self.written, on_start))
+            self.buffer += pcm
+            self.written += len(pcm)
+            self.condition.notify_all()
+            return self.written
+
+    def take(self, size: int, output_delay: float) -> bytes:
+        with self.condition:
+            size = min(size, len(self.buffer)) // 2 * 2
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            played_from = self.consumed
+            self.consumed += size
+
+            while self.pending_starts and self.pending_starts[0][0] < self.consumed:
+                offset, on_start = self.pending_starts.popleft()
+                delay = output_delay + (offset - played_from) / self.bytes_per_second
+                self.started.append((time.time() + max(delay, 0), on_start))
+            self.condition.notify_all()
+            return data
+
+    def clear(self):
+        with self.condition:
+            self.consumed += len(self.buffer)
+            self.buffer.clear()
+            self.pending_starts.clear()
+            self.condition.notify_all()
+
+    def position(self) -> float:
+        """Seconds of audio played (or cleared) since this output was started"""
+        return self.consumed / self.bytes_per_second
+
+    def wait_until(self, marker: int, is_stopped: Callable[[], bool] = lambda: False):
+        with self.condition:
+            while self.consumed < marker and not is_stopped():
+                self.condition.wait(timeout=chunk_duration)
+
+    def notify_starts(self):
+        while True:
+            with self.condition:
+                while not self.started:
+                    self.condition.wait()
+                started_at, on_start = self.started.popleft()
+            on_start(started_at)
+
+    def close(self):
+        pass
+
+
+class SoundDeviceOutput(AudioOutput):
+    stream: "sounddevice.RawOutputStream"
+
+    def __init__(self, sample_rate: int) -> None:
+        # opened first, so if the device is busy or missing it fails before anything else is started
+        self.stream = sounddevice.RawOutputStream(
+            samplerate=sample_rate,
+            channels=1,
+            dtype="int16",
+            latency="low",
+            callback=self.callback,
+        )
+        super().__init__(sample_rate)
+        self.stream.start()
+
+    def callback(self, outdata, frames: int, time_info, status):
+        output_delay = time_info.outputBufferDacTime - time_info.currentTime
+        data = self.take(len(outdata), output_delay)
+        outdata[: len(data)] = data
+        outdata[len(data) :] = b"\0" * (len(outdata) - len(data))
+
+    def close(self):
+        self.stream.close()
+
+
+class PacedOutput(AudioOutput, ABC):
+    """Feeds the buffer to `write()` in real time, a little ahead, for outputs that can't tell what they played"""
+
+    playing_until: float  # monotonic time at which what was written is done playing
+
+    def __init__(self, sample_rate: int) -> None:
+        super().__init__(sample_rate)
+        self.playing_until = 0.0
+        feeder = Thread(target=self.feed, daemon=True)
+        feeder.start()
+
+    @abstractmethod
+    def write(self, data: bytes):
+        pass
+
+    def feed(self):
+        chunk_size = int(self.bytes_per_second * chunk_duration)
+        next_tick = time.monotonic()
+        while True:
+            with self.condition:
+                while len(self.buffer) < 2:
+                    self.condition.wait()
+                    next_tick = max(next_tick, time.monotonic())
+
+            time.sleep(max(next_tick - max_lead - time.monotonic(), 0))
+            output_delay = max(next_tick - time.monotonic(), 0)
+            data = self.take(chunk_size, output_delay)
+            next_tick += len(data) / self.bytes_per_second
+            self.playing_until = next_tick
+            self.write(data)
+
+    def wait_until(self, marker: int, is_stopped: Callable[[], bool] = lambda: False):
+        super().wait_until(marker, is_stopped)
+        # audio counts as consumed once it's written, up to max_lead before it actually plays
+        while not is_stopped() and time.monotonic() < self.playing_until:
+            remaining = self.playing_until - time.monotonic()
+            time.sleep(max(min(remaining, chunk_duration), 0))
+
+
+class FfplayOutput(PacedOutput):
+    process: Optional[subprocess.Popen]
+
+    def __init__(self, sample_rate: int) -> None:
+        self.process = None
+        self.start_process(sample_rate)
+        super().__init__(sample_rate)
+
+    def start_process(self, sample_rate: int):
+        self.process = subprocess.Popen(
+            [
+                "ffplay",
+                "-probesize",
+                "8192",
+                "-f",
+                "s16le",
+                "-ar",
+                str(sample_rate),
+                "-ac",
+                "1",
+                "-nodisp",
+                "-",
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.STDOUT,
+        )
+
+    def write(self, data: bytes):
+        try:
+            self.process.stdin.write(data)  # type: ignore
+            self.process.stdin.flush()  # type: ignore
+        except (BrokenPipeError, ValueError):
+            logger.warning("Audio output died, restarting it")
+            self.start_process(self.sample_rate)
+
+    def close(self):
+        if self.process is not None:
+            self.process.kill()
+
+
+class ForwardedOutput(PacedOutput):
+    """Output of the reply workers, played by the main process"""
+
+    channel: WorkerChannel
+    # by position, like pending_starts
+    start_tokens: Deque[Tuple[int, Callable[[float], None]]]
+    # tokens starting in the chunk just taken, seconds into it
+    chunk_starts: List[Tuple[int, float]]
+    callbacks: Dict[int, Callable[[float], None]]
+    tokens: "itertools.count[int]"
+
+    def __init__(self, channel: WorkerChannel) -> None:
+        self.channel = channel
+        self.start_tokens = deque()
+        self.chunk_starts = []
+        self.callbacks = {}
+        self.tokens = itertools.count(1)
+        super().__init__(sample_rate)
+        receiver = Thread(target=self.receive_starts, daemon=True)
+        receiver.start()
+
+    def play(
+        self, pcm: bytes, on_start: Optional[Callable[[float], None]] = None
+    ) -> int:
+        with self.condition:
+            if on_start is not None:
+                self.start_tokens.append((self.written, on_start))
+            return super().play(pcm)
+
+    def take(self, size: int, output_delay: float) -> bytes:
+        with self.condition:
+            data = super().take(size, output_delay)
+            played_from = self.consumed - len(data)
+            self.chunk_starts = []
+            while self.start_tokens and self.start_tokens[0][0] < self.consumed:
+                offset, on_start = self.start_tokens.popleft()
+                token = next(self.tokens)
+                self.callbacks[token] = on_start
+                delay = max(offset - played_from, 0) / self.bytes_per_second
+                self.chunk_starts.append((token, delay))
+            return data
+
+    def clear(self):
+        with self.condition:
+            self.start_tokens.clear()
+            super().clear()
+
+    def write(self, data: bytes):
+        self.channel.audio.put((data, self.channel.key, self.chunk_starts))
+
+    def receive_starts(self):
+        while True:
+            for token, started_at in self.channel.started.get():
+                on_start = self.callbacks.pop(token, None)
+                if on_start is not None:
+                    on_start(started_at)
+
+
+def worker_channel() -> WorkerChannel:
+    """Called by main for each reply worker it starts, the audio the worker sends through it is played here"""
+    global _audio_queue, _serving_pid
+    with _outputs_lock:
+        if _audio_queue is None or _serving_pid != os.getpid():
+            _audio_queue = multiprocessing.Queue()
+            _serving_pid = os.getpid()
+            _started_queues.clear()
+            player = Thread(target=play_forwarded, args=(_audio_queue,), daemon=True)
+            player.start()
+        key = len(_started_queues) + 1
+        _started_queues[key] = multiprocessing.Queue()
+        return WorkerChannel(key, _audio_queue, _started_queues[key])
+
+
+def play_forwarded(audio_queue: Queue):
+    while True:
+        pcm, key, starts = audio_queue.get()
+        on_start = None
+        if starts:
+            on_start = functools.partial(report_starts, _started_queues[key], starts)
+        shared_output().play(pcm, on_start=on_start)
+
+
+def report_starts(
+    started_queue: Queue, starts: List[Tuple[int, float]], started_at: float
+):
+    started_queue.put([(token, started_at + delay) for token, delay in starts])
+
+
+def open_output() -> AudioOutput:
+    if channel is not None:
+        return ForwardedOutput(channel)
+    if sounddevice_available:
+        try:
+            return SoundDeviceOutput(sample_rate)
+        except Exception as err:
+            # sounddevice.PortAudioError, when the device is busy or missing
+            logger.warning(
+                "Failed to open the audio device (%s), playing audio through ffplay",
+                err,
+            )
+    else:
+        logger.warning("sounddevice is not available, playing audio through ffplay")
+    return FfplayOutput(sample_rate)
+
+
+def shared_output() -> AudioOutput:
+    global _output, _output_pid
+    with _outputs_lock:
+        if _output is None or _output_pid != os.getpid():
+            # the one inherited from the parent process is not ours to use
+            _output = open_output()
+            _output_pid = os.getpid()
+        return _output
+
+
+def resample(pcm: bytes, rate: int) -> bytes:
+    """Converts signed 16 bit mono PCM from `rate` to the `sample_rate` of the output, by linear interpolation"""
+    if rate == sample_rate or len(pcm) < 2:
+        return pcm
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    duration = len(samples) / rate
+    positions = np.arange(round(duration * sample_rate)) * (rate / sample_rate)
+    return (
+        np.interp(positions, np.arange(len(samples)), samples)
+        .astype(np.int16)
+        .tobytes()
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def decode_clip(filename: str) -> bytes:
+    ffmpeg = subprocess.run(
+        [
+            "ffmpeg",
+            "-loglevel",
+            "error",
+            "-i",
+            f"static/{filename}",
+            "-f",
+            "s16le",
+            "-ac",
+            "1",
+            "-ar",
+            str(sample_rate),
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return ffmpeg.stdout
+
+
+def preload(*filenames: str):
+    """Decodes the clips and starts the audio output ahead of time, in the background"""
+
+    def load():
+        shared_output()
+        for filename in filenames:
+            decode_clip(filename)
+
+    thread = Thread(target=load, daemon=True)
+    thread.start()
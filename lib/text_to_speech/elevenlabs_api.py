@@ -1,37 +1,53 @@
 import os
-from queue import Empty
-import subprocess
 import multiprocessing
-from multiprocessing import Queue
-import subprocess
 from threading import Thread
 from lib.delta_logging import logging
-from typing import Dict, Iterator, List, Union
-from typing_extensions import Literal
+import lib.http_transport as http_transport
+import lib.latency_tracing as latency_tracing
+from lib.per_process import per_process
+from lib.reply_events import ReplyAudioStarted
+from lib.text_to_speech.audio_cache import AudioCache
+from lib.text_to_speech.audio_output import AudioOutput, shared_output
+from lib.text_to_speech.playback_scheduler import PlaybackScheduler
+from typing import Iterator
 from elevenlabs.client import ElevenLabs
 from elevenlabs import Voice, VoiceSettings
 
 logger = logging.getLogger()
 
-eleven_labs_api_key = os.environ["ELEVEN_LABS_API_KEY"]
-
 VOICE_SETTINGS_STABILITY = 1
 VOICE_SETTINGS_SIMILARITY_BOOST = 0.75
 VOICE_ID = "pNInz6obpgDQGcFmaJgB"  # pNInz6obpgDQGcFmaJgB
-
-client = ElevenLabs(api_key=eleven_labs_api_key)
+MODEL = "eleven_multilingual_v2"
+OUTPUT_FORMAT = "pcm_22050"  # raw PCM, straight into the audio output without decoding
+
+client = per_process(
+    lambda: ElevenLabs(
+        api_key=os.environ["ELEVEN_LABS_API_KEY"],
+        httpx_client=http_transport.http_client(),
+    )
+)
+http_transport.register("https://api.elevenlabs.io")
+
+audio_cache = AudioCache(
+    "elevenlabs",
+    VOICE_ID,
+    {
+        "model": MODEL,
+        "stability": VOICE_SETTINGS_STABILITY,
+        "similarity_boost": VOICE_SETTINGS_SIMILARITY_BOOST,
+        "output_format": OUTPUT_FORMAT,
+    },
+)
 
 
 class ElevenLabsAPI:
     min_words = 2
-    ffplay: subprocess.Popen
+    output: AudioOutput
     reply_in_queue: multiprocessing.Queue
     reply_out_queue: multiprocessing.Queue
-    word_index: int
-    audio_chunks: Dict[int, List[Union[bytes, Literal["done"]]]]
-    playing_index: int
-    requested_to_stop: bool
-    local_queue: Queue
+    scheduler: PlaybackScheduler
+    player: Thread
 
     def __init__(
         self,
@@ -40,97 +56,78 @@ class ElevenLabsAPI:
     ) -> None:
         self.reply_in_queue = reply_in_queue
         self.reply_out_queue = reply_out_queue
-        self.requested_to_stop = False
-        self.local_queue = Queue()
         self.start()
 
     def start(self):
-        self.word_index = 0
-        self.playing_index = 0
-        self.audio_chunks = {}
-        self.ffplay = subprocess.Popen(
-            args=["ffplay", "-autoexit", "-nodisp", "-"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.STDOUT,
-        )
+        self.scheduler = PlaybackScheduler(self.reply_in_queue, self.reply_out_queue)
+        self.output = shared_output()
+        self.player = Thread(target=self.play_in_order)
+        self.player.start()
 
     def wait_to_finish(self):
-        while True:
-            try:
-                outside_action = self.reply_in_queue.get(block=False)
-                if outside_action == "stop":
-                    self.stop()
-                    break
-            except Empty:
-                pass
-
-            try:
-                action, data = self.local_queue.get(block=False)
-                self.reply_out_queue.put((action, data))
-                if action == "reply_audio_ended":
-                    break
-            except Empty:
-                pass
+        self.scheduler.wait_to_finish(on_stop=self.stop)
 
     def stop(self):
-        self.ffplay.stdin.close()  # type: ignore
-        self.ffplay.wait()
-        self.local_queue.put(("reply_audio_ended", None))
+        self.scheduler.stop()
+        self.output.clear()
 
     def consume(self, word: str):
         if word == "":
             return
-        self.audio_chunks[self.word_index] = []
-        thread = Thread(target=self.generate_async, args=(word, self.word_index))
+        index = self.scheduler.open_segment()
+        thread = Thread(target=self.generate_async, args=(word, index))
         thread.start()
-        self.word_index += 1
-        try:
-            self.reply_out_queue.put(self.local_queue.get(block=False))
-        except Empty:
-            pass
 
     def generate_async(self, word: str, index: int):
-        audio_stream: Iterator[bytes] = client.generate(
-            model="eleven_multilingual_v2",
-            voice=Voice(
-                voice_id=VOICE_ID,
-                settings=VoiceSettings(
-                    stability=VOICE_SETTINGS_STABILITY,
-                    similarity_boost=VOICE_SETTINGS_SIMILARITY_BOOST,
-                ),
-            ),  # type: ignore
-            text=word,
-            stream=True,
-        )
-
-        for chunk_index, audio_chunk in enumerate(audio_stream):
-            if index == 0 and chunk_index == 0:
-                logger.info("First audio chunk arrived")
-                self.local_queue.put(("reply_audio_started", self.ffplay.pid))
-
-            self.audio_chunks[index].append(audio_chunk)
-
-            if index == self.playing_index:
-                self.play_next_chunks()
-
-        self.audio_chunks[index].append("done")
-        self.play_next_chunks()
-
-    def play_next_chunks(self):
-        if self.playing_index not in self.audio_chunks:
-            if self.requested_to_stop:
-                self.stop()
-            return
-
-        if self.ffplay.poll() is not None:
-            return
-
-        while len(self.audio_chunks[self.playing_index]) > 0:
-            audio_chunk = self.audio_chunks[self.playing_index].pop(0)
-            if audio_chunk == "done":
-                self.playing_index += 1
-                self.play_next_chunks()
-                break
-
-            self.ffplay.stdin.write(audio_chunk)  # type: ignore
+        try:
+            cached_audio = audio_cache.get(word)
+            if cached_audio is not None:
+                self.push(index, 0, cached_audio)
+                return
+
+            audio_stream: Iterator[bytes] = client().generate(
+                model=MODEL,
+                voice=Voice(
+                    voice_id=VOICE_ID,
+                    settings=VoiceSettings(
+                        stability=VOICE_SETTINGS_STABILITY,
+                        similarity_boost=VOICE_SETTINGS_SIMILARITY_BOOST,
+                    ),
+                ),  # type: ignore
+                text=word,
+                stream=True,
+                output_format=OUTPUT_FORMAT,
+            )
+
+            audio_chunks = []
+            for chunk_index, audio_chunk in enumerate(audio_stream):
+                if self.scheduler.is_stopped():
+                    return
+                self.push(index, chunk_index, audio_chunk)
+                audio_chunks.append(audio_chunk)
+
+            audio_cache.put(word, b"".join(audio_chunks))
+        finally:
+            self.scheduler.close_segment(index)
+
+    def push(self, index: int, chunk_index: int, audio_chunk: bytes):
+        if index == 0 and chunk_index == 0:
+            logger.info("First audio chunk arrived")
+            latency_tracing.mark("first_audio")
+
+        self.scheduler.push(index, audio_chunk)
+
+    def play_in_order(self):
+        end_marker = None
+        for audio_chunk in self.scheduler.chunks():
+            end_marker = self.output.play(
+                audio_chunk,
+                on_start=self.audio_started if end_marker is None else None,
+            )
+
+        if end_marker is not None:
+            self.output.wait_until(end_marker, self.scheduler.is_stopped)
+        self.scheduler.playback_done()
+
+    def audio_started(self, started_at: float):
+        self.reply_out_queue.put(ReplyAudioStarted(started_at))
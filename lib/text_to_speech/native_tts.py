@@ -1,11 +1,21 @@
 import multiprocessing
-from multiprocessing import Queue
 import platform
 import subprocess
+import time
 from threading import Thread
 from typing import Optional
 from lib.delta_logging import logging
-from queue import Empty
+import lib.latency_tracing as latency_tracing
+from lib.reply_events import ReplyAudioStarted
+from lib.text_to_speech.playback_scheduler import PlaybackScheduler
+
+# Speaks through the text to speech of the OS, `say` on macOS and `espeak-ng` elsewhere, one call per sentence.
+#
+# Unlike the other engines it doesn't go through the shared audio output (lib/text_to_speech/audio_output.py), those
+# commands open the audio device themselves, so there is no way to tell exactly when the audio reached the speaker,
+# and an interruption can only stop it at the end of the sentence being spoken. ReplyAudioStarted is sent right before
+# the first sentence is handed to them, which is as close as it gets, and the interruption checker may count the
+# first few frames before the speech actually started as part of its baseline.
 
 logger = logging.getLogger()
 
@@ -14,9 +24,9 @@ class NativeTTS:
     min_words = 2
     reply_in_queue: multiprocessing.Queue
     reply_out_queue: multiprocessing.Queue
-    word_index: int
-    playing_index: int
-    local_queue: Queue
+    scheduler: PlaybackScheduler
+    player: Thread
+    first: bool
     current_process: Optional[subprocess.Popen] = None
 
     def __init__(
@@ -26,33 +36,19 @@ class NativeTTS:
     ) -> None:
         self.reply_in_queue = reply_in_queue
         self.reply_out_queue = reply_out_queue
-        self.local_queue = Queue()
-        self.word_index = 0
-        self.playing_index = 0
+        self.start()
 
     def start(self):
-        pass
+        self.first = True
+        self.scheduler = PlaybackScheduler(self.reply_in_queue, self.reply_out_queue)
+        self.player = Thread(target=self.play_in_order)
+        self.player.start()
 
     def wait_to_finish(self):
-        self.local_queue = Queue()
-        while True:
-            try:
-                outside_action = self.reply_in_queue.get(block=False)
-                if outside_action == "stop":
-                    self.stop()
-                    break
-            except Empty:
-                pass
-
-            try:
-                action, data = self.local_queue.get(block=False)
-                self.reply_out_queue.put((action, data))
-                if action == "reply_audio_ended":
-                    break
-            except Empty:
-                pass
+        self.scheduler.wait_to_finish(on_stop=self.stop)
 
     def stop(self):
+        self.scheduler.stop()
         if self.current_process:
             self.current_process.terminate()
             logger.info("Subprocess terminated")
@@ -61,30 +57,30 @@ class NativeTTS:
     def consume(self, word: str):
         if word == "":
             return
-        if self.word_index == 0:
+        if self.first:
             logger.info("First audio chunk arrived")
-            self.reply_out_queue.put(("reply_audio_started", -1))
-        thread = Thread(target=self.generate_async, args=(word, self.word_index))
-        thread.start()
-        self.word_index += 1
+            latency_tracing.mark("first_audio")
+            self.first = False
+        index = self.scheduler.open_segment()
+        self.scheduler.push(index, word)
+        self.scheduler.close_segment(index)
 
-    def generate_async(self, word: str, index: int):
-        while self.playing_index != index:
-            pass
-        # Weirdly say sometimes hang and never return, so we use subprocess.call instead for now
-        # cmd = ["say", word] if platform.system() == "Darwin" else ["espeak-ng", word]
-        # self.current_process = subprocess.Popen(
-        #     cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        # )
-        # try:
-        #     self.current_process.wait(timeout=15)
-        # except subprocess.TimeoutExpired:
-        #     logger.info(cmd[0] + " subprocess timed out")
-        #     self.current_process.terminate()
-        if platform.system() == "Darwin":
-            subprocess.call(["say", word])
-        else:
-            subprocess.call(["espeak-ng", word])
-        self.playing_index += 1
-        if self.playing_index == self.word_index:
-            self.local_queue.put(("reply_audio_ended", None))
+    def play_in_order(self):
+        for index, word in enumerate(self.scheduler.chunks()):
+            if index == 0:
+                self.reply_out_queue.put(ReplyAudioStarted(time.time()))
+            # Weirdly say sometimes hang and never return, so we use subprocess.call instead for now
+            # cmd = ["say", word] if platform.system() == "Darwin" else ["espeak-ng", word]
+            # self.current_process = subprocess.Popen(
+            #     cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            # )
+            # try:
+            #     self.current_process.wait(timeout=15)
+            # except subprocess.TimeoutExpired:
+            #     logger.info(cmd[0] + " subprocess timed out")
+            #     self.current_process.terminate()
+            if platform.system() == "Darwin":
+                subprocess.call(["say", word])
+            else:
+                subprocess.call(["espeak-ng", word])
+        self.scheduler.playback_done()
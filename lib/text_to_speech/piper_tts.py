@@ -1,23 +1,135 @@
 import multiprocessing
-from multiprocessing import Queue
-import select
-import subprocess
+import queue
+import threading
 from threading import Thread
+import time
+from typing import Any, NamedTuple
 from lib.delta_logging import logging
+import lib.latency_tracing as latency_tracing
+from lib.per_process import per_process
+from lib.reply_events import ReplyAudioStarted
+from lib.text_to_speech.audio_cache import AudioCache
+import lib.text_to_speech.audio_output as audio_output
+from lib.text_to_speech.audio_output import resample, shared_output
+from lib.text_to_speech.playback_scheduler import PlaybackScheduler
+
+# Piper keeps its voice model loaded for as long as the reply worker lives, instead of starting a new piper process,
+# which loads the ONNX model all over again, for every reply. On the Raspberry Pi that load was most of the time to
+# first audio.
+#
+# A single synthesizer thread per process owns the model and takes sentences tagged with the id of the utterance
+# (the reply) they belong to, so cancelling an utterance just drops its pending sentences and stops feeding the ones
+# being synthesized, while the model stays warm for the next one. The audio of each reply goes into the scheduler of
+# its PiperTTS, and from there into the audio output shared by the whole process.
 
 logger = logging.getLogger()
 
+MODEL_PATH = "./piper/en_US-ryan-medium.onnx"
+
+audio_cache = AudioCache(
+    "piper", MODEL_PATH, {"format": "s16le", "sample_rate": audio_output.sample_rate}
+)
+
+
+class SentenceRequest(NamedTuple):
+    utterance_id: int
+    index: int
+    text: str
+    scheduler: PlaybackScheduler
+
+
+class PiperSynthesizer:
+    # piper.voice.PiperVoice, imported lazily as it's only installed by piper_install.sh
+    voice: Any
+    sample_rate: int
+    requests: "queue.Queue[SentenceRequest]"
+    lock: threading.Lock
+    last_utterance_id: int
+    # utterances up to this id are cancelled, they are only ever started in order
+    cancelled_through: int
+
+    def __init__(self) -> None:
+        self.voice = None
+        self.sample_rate = 22050
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.last_utterance_id = 0
+        self.cancelled_through = 0
+        thread = Thread(target=self.run, daemon=True)
+        thread.start()
+
+    def next_utterance_id(self) -> int:
+        with self.lock:
+            self.last_utterance_id += 1
+            return self.last_utterance_id
+
+    def synthesize(self, request: SentenceRequest):
+        self.requests.put(request)
+
+    def cancel(self, utterance_id: int):
+        with self.lock:
+            self.cancelled_through = max(self.cancelled_through, utterance_id)
+
+    def is_cancelled(self, utterance_id: int) -> bool:
+        return utterance_id <= self.cancelled_through
+
+    def load(self):
+        from piper.voice import PiperVoice
+
+        started_at = time.time()
+        self.voice = PiperVoice.load(MODEL_PATH)
+        self.sample_rate = self.voice.config.sample_rate
+        logger.info("Piper voice loaded in %.2fs", time.time() - started_at)
+        # start the audio output too, so that's not on the way of the first reply either
+        shared_output()
+
+    def run(self):
+        try:
+            self.load()
+        except Exception:
+            logger.exception("Failed to load the Piper voice")
+
+        while True:
+            request = self.requests.get()
+            try:
+                if self.voice is not None and not self.is_cancelled(
+                    request.utterance_id
+                ):
+                    self.synthesize_sentence(request)
+            except Exception:
+                logger.exception("Piper failed to synthesize: %s", request.text)
+            finally:
+                request.scheduler.close_segment(request.index)
+
+    def synthesize_sentence(self, request: SentenceRequest):
+        cached_audio = audio_cache.get(request.text)
+        if cached_audio is not None:
+            request.scheduler.push(request.index, cached_audio)
+            return
+
+        audio_chunks = []
+        for raw_chunk in self.voice.synthesize_stream_raw(request.text):
+            if self.is_cancelled(request.utterance_id):
+                return
+            # the output plays everything at one rate, medium voices already are at it, others are not
+            audio_chunk = resample(raw_chunk, self.sample_rate)
+            request.scheduler.push(request.index, audio_chunk)
+            audio_chunks.append(audio_chunk)
+
+        audio_cache.put(request.text, b"".join(audio_chunks))
+
+
+synthesizer = per_process(PiperSynthesizer)
+
 
 class PiperTTS:
     min_words = 2
-    piper: subprocess.Popen
-    ffplay: subprocess.Popen
-    from_piper_to_ffplay: Thread
+    synthesizer: PiperSynthesizer
+    utterance_id: int
+    player: Thread
     reply_in_queue: multiprocessing.Queue
     reply_out_queue: multiprocessing.Queue
-    local_queue: Queue
-    requested_to_stop: bool
-    first: bool
+    scheduler: PlaybackScheduler
 
     def __init__(
         self,
@@ -29,80 +141,44 @@ class PiperTTS:
         self.start()
 
     def start(self):
-        self.requested_to_stop = False
-        self.first = True
-        self.piper = subprocess.Popen(
-            [
-                "./piper/piper/piper",
-                "--model",
-                "./piper/en-us-ryan-medium.onnx",
-                "--output_raw",
-                "-",
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        )
-        self.ffplay = subprocess.Popen(
-            [
-                "ffplay",
-                "-probesize",
-                "8192",
-                "-f",
-                "s16le",
-                "-ar",
-                "22050",
-                "-ac",
-                "1",
-                "-nodisp",
-                "-autoexit",
-                "-",
-            ],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.STDOUT,
-        )
-        self.from_piper_to_ffplay = Thread(target=self.play_as_available)
-        self.from_piper_to_ffplay.start()
+        self.scheduler = PlaybackScheduler(self.reply_in_queue, self.reply_out_queue)
+        self.synthesizer = synthesizer()
+        self.utterance_id = self.synthesizer.next_utterance_id()
+        self.player = Thread(target=self.play_in_order)
+        self.player.start()
 
     def wait_to_finish(self):
-        self.stop()
+        self.scheduler.wait_to_finish(on_stop=self.stop)
 
     def stop(self):
-        self.requested_to_stop = True
-        remaining, _ = self.piper.communicate()
-        if remaining is not None:
-            self.play_chunk(remaining)
-        self.ffplay.stdin.close()  # type: ignore
-        self.ffplay.wait()
-
-        self.reply_out_queue.put(("reply_audio_ended", None))
+        self.scheduler.stop()
+        self.synthesizer.cancel(self.utterance_id)
+        shared_output().clear()
 
     def consume(self, word: str):
         if word == "":
             return
 
-        self.piper.stdin.write((word + "\n").encode("utf-8"))  # type: ignore
-        self.piper.stdin.flush()  # type: ignore
-
-    def play_as_available(self):
-        while not self.requested_to_stop:
-            # Wait for data to become available
-            ready_to_read, _, _ = select.select([self.piper.stdout.fileno()], [], [])  # type: ignore
-            for stream in ready_to_read:
-                if self.requested_to_stop:
-                    return
-                if stream == self.piper.stdout.fileno():  # type: ignore
-                    output = self.piper.stdout.read1(512 * 32)  # type: ignore
-                    if output:
-                        self.play_chunk(output)
-                    else:
-                        # No more output, break the loop
-                        return
-
-    def play_chunk(self, output):
-        if self.first:
-            logger.info("First audio chunk arrived")
-            self.reply_out_queue.put(("reply_audio_started", self.ffplay.pid))
-            self.first = False
-        self.ffplay.stdin.write(output)  # type: ignore
+        index = self.scheduler.open_segment()
+        self.synthesizer.synthesize(
+            SentenceRequest(self.utterance_id, index, word, self.scheduler)
+        )
+
+    def play_in_order(self):
+        output = None
+        end_marker = 0
+        for audio_chunk in self.scheduler.chunks():
+            if output is None:
+                logger.info("First audio chunk arrived")
+                latency_tracing.mark("first_audio")
+                output = shared_output()
+                end_marker = output.play(audio_chunk, on_start=self.audio_started)
+            else:
+                end_marker = output.play(audio_chunk)
+
+        if output is not None:
+            output.wait_until(end_marker, self.scheduler.is_stopped)
+        self.scheduler.playback_done()
+
+    def audio_started(self, started_at: float):
+        self.reply_out_queue.put(ReplyAudioStarted(started_at))
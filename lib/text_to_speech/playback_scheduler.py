@@ -0,0 +1,129 @@
+from collections import deque
+import multiprocessing
+import threading
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+from lib.reply_events import ReplyAudioEnded
+
+# Shared ordered playback for the TTS engines, without any busy waiting.
+#
+# Engines open one segment per sentence, in the order the sentences arrive, and fill it from whatever thread is
+# synthesizing it. A single player thread per engine iterates `chunks()`, which blocks on a condition variable until
+# the next chunk of the segment that is due is available, so sentences always play in order even if a later one
+# finishes synthesizing first.
+#
+# For the end of the reply, the player calls `playback_done()`, which puts a message on the same reply_in_queue the
+# "stop" commands from the main process arrive on, so `wait_to_finish()` can simply block on that one queue.
+
+PLAYBACK_DONE = "playback_done"
+
+
+class Segment:
+    chunks: Deque[Any]
+    closed: bool
+
+    def __init__(self) -> None:
+        self.chunks = deque()
+        self.closed = False
+
+
+class PlaybackScheduler:
+    reply_in_queue: multiprocessing.Queue
+    reply_out_queue: multiprocessing.Queue
+    condition: threading.Condition
+    segments: Dict[int, Segment]
+    next_index: int
+    playing_index: int
+    input_ended: bool
+    stopped: bool
+
+    def __init__(
+        self,
+        reply_in_queue: multiprocessing.Queue,
+        reply_out_queue: multiprocessing.Queue,
+    ) -> None:
+        self.reply_in_queue = reply_in_queue
+        self.reply_out_queue = reply_out_queue
+        self.condition = threading.Condition()
+        self.segments = {}
+        self.next_index = 0
+        self.playing_index = 0
+        self.input_ended = False
+        self.stopped = False
+
+    def open_segment(self) -> int:
+        with self.condition:
+            index = self.next_index
+            self.segments[index] = Segment()
+            self.next_index += 1
+            return index
+
+    def push(self, index: int, chunk: Any):
+        with self.condition:
+            segment = self.segments.get(index)
+            if segment is None:
+                return
+            segment.chunks.append(chunk)
+            if index == self.playing_index:
+                self.condition.notify_all()
+
+    def close_segment(self, index: int):
+        with self.condition:
+            segment = self.segments.get(index)
+            if segment is None:
+                return
+            segment.closed = True
+            if index == self.playing_index:
+                self.condition.notify_all()
+
+    def end_of_input(self):
+        with self.condition:
+            self.input_ended = True
+            self.condition.notify_all()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def is_stopped(self):
+        return self.stopped
+
+    def next_chunk(self) -> Optional[Any]:
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+
+                segment = self.segments.get(self.playing_index)
+                if segment is not None:
+                    if len(segment.chunks) > 0:
+                        return segment.chunks.popleft()
+                    if segment.closed:
+                        del self.segments[self.playing_index]
+                        self.playing_index += 1
+                        continue
+                elif self.input_ended and self.playing_index >= self.next_index:
+                    return None
+
+                self.condition.wait()
+
+    def chunks(self) -> Iterator[Any]:
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+    def playback_done(self):
+        self.reply_in_queue.put(PLAYBACK_DONE)
+
+    def wait_to_finish(self, on_stop: Callable[[], None]):
+        self.end_of_input()
+        while True:
+            message = self.reply_in_queue.get()
+            if message == "stop":
+                on_stop()
+            elif message == PLAYBACK_DONE:
+                self.reply_out_queue.put(ReplyAudioEnded())
+                return
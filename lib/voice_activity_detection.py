@@ -0,0 +1,96 @@
+from typing import List, Optional, Tuple
+import numpy as np
+
+from lib.audio_features import FrameFeatures
+
+# Adaptive voice activity detection.
+#
+# Instead of a fixed RMS threshold, we keep track of the ambient noise floor in the speech band (200-4000Hz) and
+# consider a frame speech when it is clearly above that floor, most of its energy is in the speech band (so hum and
+# hiss don't count) and its zero-crossing rate isn't white-noise like.
+#
+# The floor is calibrated from the 25th percentile of the first second of listening after startup and after each
+# wake up, and then keeps following the room: it falls quickly when things get quieter and rises slowly on
+# non-speech frames, plus very slowly during speech, so a noise that suddenly appears can't be mistaken for speech
+# forever.
+#
+# After a wake up, that first second is usually when the user starts talking, so only the frames that don't look like
+# speech go into the calibration, and when most of the second was speech the previous floor is kept.
+
+calibration_frames = 32  # 1s of audio
+calibration_percentile = 25
+# fewer non-speech frames than that keep the previous floor
+min_calibration_silence = calibration_frames // 2
+# used until the first calibration is done, about the old fixed 300 RMS on the speech band alone
+default_threshold = 200
+# never go below this, so a very quiet room doesn't trigger on breathing
+min_threshold = 120
+speech_to_noise_ratio = 2.5  # ~8dB above the noise floor
+min_speech_band_ratio = 0.15
+max_zero_crossing_rate = 0.45
+floor_fall_rate = 0.2
+floor_rise_rate = 0.02
+floor_rise_rate_during_speech = 0.002
+
+
+class VoiceActivityDetector:
+    noise_floor: Optional[float]
+    calibration: List[Tuple[float, bool]]  # speech band RMS, and whether it was speech
+    calibrating: bool
+
+    def __init__(self) -> None:
+        self.noise_floor = None
+        self.calibrate()
+
+    def calibrate(self):
+        self.calibration = []
+        self.calibrating = True
+
+    def threshold(self) -> float:
+        if self.noise_floor is None:
+            return default_threshold
+        return max(self.noise_floor * speech_to_noise_ratio, min_threshold)
+
+    def is_speech(self, features: FrameFeatures, adapt: bool = True) -> bool:
+        speech = (
+            features.speech_band_rms > self.threshold()
+            and features.speech_band_ratio >= min_speech_band_ratio
+            and features.zero_crossing_rate <= max_zero_crossing_rate
+        )
+
+        if adapt:
+            if self.calibrating:
+                self.add_calibration_frame(features, speech)
+            else:
+                self.update_noise_floor(features, speech)
+
+        return speech
+
+    def add_calibration_frame(self, features: FrameFeatures, speech: bool):
+        self.calibration.append((features.speech_band_rms, speech))
+        if len(self.calibration) < calibration_frames:
+            return
+
+        silence = [level for level, speech in self.calibration if not speech]
+        if len(silence) >= min_calibration_silence:
+            self.noise_floor = float(np.percentile(silence, calibration_percentile))
+        elif self.noise_floor is None:
+            levels = [level for level, _ in self.calibration]
+            self.noise_floor = float(np.percentile(levels, calibration_percentile))
+        # otherwise the user was talking the whole time, the floor from before is a better guess
+        self.calibration = []
+        self.calibrating = False
+
+    def update_noise_floor(self, features: FrameFeatures, speech: bool):
+        if self.noise_floor is None:
+            self.noise_floor = features.speech_band_rms
+            return
+
+        level = features.speech_band_rms
+        if level < self.noise_floor:
+            rate = floor_fall_rate
+        elif speech:
+            rate = floor_rise_rate_during_speech
+        else:
+            rate = floor_rise_rate
+        self.noise_floor += rate * (level - self.noise_floor)
@@ -1,25 +1,60 @@
+# startup_profile is imported before anything else, to time all the other imports
+import sys
+import lib.startup_profile as startup_profile
+
+if "--startup-profile" in sys.argv:
+    startup_profile.install()
+
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import importlib
 import math
 from multiprocessing import Value
 from multiprocessing.sharedctypes import Synchronized
 from threading import Thread
 import time
-from dotenv import load_dotenv  # has to be the first import
+from dotenv import load_dotenv  # has to be the first import after the startup profile
 
 load_dotenv()
 from lib.delta_logging import logging, red, reset, log_formatter  # has to be the second
 from queue import Empty
-from typing import Any, List, Optional
+from typing import Any, Coroutine, Dict, List, Optional, Set
 from typing_extensions import Literal
 from lib.interruption_detection import InterruptionDetection
+import lib.http_transport as http_transport
+import lib.latency_tracing as latency_tracing
+from lib.latency_tracing import LatencyTracer
+import lib.memory_usage as memory_usage
 from lib.porcupine import wakeup_keywords
-from lib.utils import calculate_volume
-from lib.chatgpt import ChatGPT, Conversation, Message, initial_message
+from lib.audio_features import FrameFeatures, extract_features
+from lib.voice_activity_detection import VoiceActivityDetector
+from lib.audio_buffer import AudioBuffer
+from lib.shared_audio import SharedAudioRing
+from lib.chatgpt import ChatGPT, Message, initial_message, summarize_conversation
+from lib.conversation_context import ConversationContext
+from lib.reply_cache import ReplyCache
+from lib.speculation import SpeculativeReplies, speculation_pause
+from lib.reply_events import (
+    AssistantMessage,
+    ReplyAudioEnded,
+    ReplyAudioStarted,
+    ReplyEvent,
+)
+from lib.replay import (
+    FileRecorder,
+    ReplayChatGPT,
+    ReplayFinished,
+    ReplayReport,
+    ReplaySpeechRecognition,
+)
 import lib.text_to_speech as text_to_speech
 import lib.speech_recognition as speech_recognition
+import lib.speech_recognition.audio_codecs as audio_codecs
+import lib.speech_recognition.model_residency as model_residency
 from lib.speech_recognition import SpeechRecognition
 import os
-import struct
 import pvporcupine
 from pvrecorder import PvRecorder
 import openai
@@ -31,8 +66,9 @@ logger = logging.getLogger()
 
 frame_length = 512
 buffer_size_on_active_listening = frame_length * 32 * 60  # keeps 60s of audio
+buffer_headroom = frame_length * 32 * 10  # snapshots stay valid for at least 10s
+shared_audio_frames = 32 * 2  # 2s of frames shared with the worker processes
 sample_rate = 16000  # sample rate for Porcupine is fixed at 16kHz
-silence_threshold = 300  # maybe need to be adjusted
 silence_limit = 0.5 * 32  # 0.5 seconds of silence
 speaking_minimum = 0.3 * 32  # 0.3 seconds of speaking
 silence_time_to_standby = (
@@ -50,7 +86,19 @@ RecordingState = Literal[
 
 class AudioRecording:
     state: RecordingState
-    conversation: Conversation = [initial_message]
+    context: ConversationContext
+    reply_cache: Optional[ReplyCache]
+    # set while waiting on a reply that can be cached
+    reply_cache_key: Optional[str] = None
+    reply_sent_at: float = 0.0
+    reply_latency: Optional[float] = None
+    speculative_replies: Optional[SpeculativeReplies]
+    speech_onsets: int = 0  # how many stretches of speech started since listening
+    speculated_onset: int = -1  # the stretch of speech the last speculation was made on
+    # recording_audio_buffer.written when audio was last sent for transcription
+    transcribed_until: int = 0
+    # recording_audio_buffer.written at the last frame of speech
+    last_speech_at: int = 0
 
     porcupine: Optional[pvporcupine.Porcupine]
     recorder: PvRecorder
@@ -58,51 +106,112 @@ class AudioRecording:
 
     silence_frame_count: int
     speaking_frame_count: int
-    recording_audio_buffer: bytearray
+    recording_audio_buffer: AudioBuffer
+    shared_audio: SharedAudioRing
+    vad: VoiceActivityDetector
 
     chat_gpt: ChatGPT
     interruption_detection: InterruptionDetection
     speech_recognition: SpeechRecognition
 
-    def __init__(self, recorder: PvRecorder, cli_args: argparse.Namespace) -> None:
+    loop: asyncio.AbstractEventLoop
+    tasks: Set[asyncio.Task]
+
+    def __init__(
+        self,
+        recorder: PvRecorder,
+        cli_args: argparse.Namespace,
+        chat_gpt: Optional[ChatGPT] = None,
+        speech_recognition_engine: Optional[SpeechRecognition] = None,
+    ) -> None:
         self.recorder = recorder
         self.cli_args = cli_args
-        self.recording_audio_buffer = bytearray()
+        self.recording_audio_buffer = AudioBuffer(
+            buffer_size_on_active_listening, headroom=buffer_headroom
+        )
+        self.shared_audio = SharedAudioRing(frame_length, shared_audio_frames)
         self.speaking_frame_count = 0
-        self.chat_gpt = ChatGPT(cli_args)
-        self.interruption_detection = InterruptionDetection()
-        self.speech_recognition = speech_recognition.ENGINES[
-            cli_args.speech_recognition
-        ]()
-        self.speech_recognition.restart()
+        self.context = ConversationContext(initial_message, summarize_conversation)
+        self.reply_cache = self.open_reply_cache() if cli_args.reply_cache else None
+        self.tasks = set()
+        self.vad = VoiceActivityDetector()
+        with startup_profile.phase("ChatGPT reply workers"):
+            self.chat_gpt = chat_gpt or ChatGPT(cli_args)
+        self.speculative_replies = (
+            SpeculativeReplies(self.chat_gpt, cli_args.max_speculative)
+            if cli_args.speculative
+            else None
+        )
+        with startup_profile.phase("interruption detection"):
+            self.interruption_detection = InterruptionDetection(
+                self.shared_audio, in_thread=cli_args.low_memory
+            )
+        with startup_profile.phase("speech recognition"):
+            self.speech_recognition = (
+                speech_recognition_engine
+                or speech_recognition.ENGINES[cli_args.speech_recognition]()
+            )
+            self.speech_recognition.restart()
         self.switch("waiting_for_silence")
 
-        if picovoice_access_key:
-            self.porcupine = pvporcupine.create(
-                access_key=picovoice_access_key,
-                keyword_paths=wakeup_keywords(),
-            )
+        if not cli_args.replay:
+            text_to_speech.preload("beep_wakeup.mp3", "beep_standby.mp3", "byebye.mp3")
+
+        if picovoice_access_key and not cli_args.replay:
+            with startup_profile.phase("porcupine"):
+                self.porcupine = pvporcupine.create(
+                    access_key=picovoice_access_key,
+                    keyword_paths=wakeup_keywords(),
+                )
         else:
             self.porcupine = None
 
     def stop(self):
         self.recorder.stop()
+        # while the workers and the checker are still running, to tell them apart
+        self.log_memory()
         self.chat_gpt.stop()
+        self.chat_gpt.shutdown()
         self.interruption_detection.stop()
+        self.interruption_detection.shutdown()
         self.speech_recognition.stop()
+        self.speech_recognition.shutdown()
+        self.context.log_stats()
+        model_residency.log_stats()
+        http_transport.log_stats("main")
+        if self.reply_cache:
+            self.reply_cache.log_stats()
+        if self.speculative_replies:
+            self.speculative_replies.log_stats()
         if self.porcupine:
             self.porcupine.delete()
+        self.shared_audio.close()
 
     def sleep(self):
         text_to_speech.play_audio_file_non_blocking("beep_standby.mp3")
         self.silence_frame_count = 0
         self.speaking_frame_count = 0
-        self.recording_audio_buffer = bytearray()
+        self.recording_audio_buffer.clear()
+        self.cancel_speculations()
         self.chat_gpt.stop()
         self.speech_recognition.stop()
         self.interruption_detection.stop()
+        self.log_memory()
+
+    def log_memory(self):
+        names: Dict[int, str] = {}
+        for index, worker in enumerate(getattr(self.chat_gpt, "workers", [])):
+            names[worker.process.pid] = (
+                "reply worker" if index == 0 else "spare reply worker"
+            )
+        checker_pid = self.interruption_detection.pid()
+        if checker_pid is not None:
+            names[checker_pid] = "interruption checker"
+        memory_usage.log_stats(names)
 
     def wake_up(self):
+        self.prewarm_connections()
+        self.vad.calibrate()
         self.chat_gpt.restart()
         self.speech_recognition.restart()
         self.interruption_detection.start()
@@ -110,10 +219,11 @@ class AudioRecording:
         text_to_speech.play_audio_file_non_blocking("beep_wakeup.mp3")
 
         user_message: Message = {"role": "user", "content": "Hey, ChatGPT!"}
-        self.conversation.append(user_message)
+        self.context.append(user_message)
 
         self.switch("replying")
-        self.chat_gpt.reply(self.conversation)
+        self.reply_cache_key = None
+        self.chat_gpt.reply(self.context.messages())
 
     def switch(self, state: RecordingState):
         self.recorder.start()
@@ -130,62 +240,197 @@ class AudioRecording:
         elif state == "waiting_for_wakeup":
             self.sleep()
 
-    def next_frame(self):
-        pcm = self.recorder.read()
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.start_reply_event_pump()
+
+        # PvRecorder.read blocks until the next frame is ready, so it gets its own thread to keep the loop free
+        frame_reader = ThreadPoolExecutor(max_workers=1)
+        try:
+            while True:
+                pcm = await self.loop.run_in_executor(frame_reader, self.recorder.read)
+                await self.next_frame(pcm)
+        finally:
+            frame_reader.shutdown(wait=False)
+
+    def spawn(self, coroutine: Coroutine[Any, Any, None]):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Exception thrown in task", exc_info=task.exception())
+
+    def start_reply_event_pump(self):
+        pump = Thread(target=self.pump_reply_events, daemon=True)
+        pump.start()
+
+    def pump_reply_events(self):
+        # Blocks on the reply queue and hands every event to the event loop the moment it arrives, instead of
+        # waiting for the next audio frame. The reply workers share this one queue for their whole lifetime, and
+        # tag every event with the turn it belongs to.
+        while True:
+            try:
+                turn_id, event = self.chat_gpt.get(block=True)
+            except (EOFError, OSError):
+                return  # queue closed while shutting down
+            if event is None:
+                return  # the reply workers were shut down
+            self.loop.call_soon_threadsafe(self.handle_reply_event, turn_id, event)
+
+    def handle_reply_event(self, turn_id: int, event: ReplyEvent):
+        if turn_id != self.chat_gpt.turn_id:
+            return  # from a reply that was already cancelled
+        if self.state != "replying":
+            return  # from a reply that was already cut short
 
+        if isinstance(event, AssistantMessage):
+            self.context.append(event.message)
+        elif isinstance(event, ReplyAudioStarted):
+            if self.reply_latency is None:
+                self.reply_latency = event.started_at - self.reply_sent_at
+            self.silence_frame_count = 0
+            self.speaking_frame_count = 0
+            self.interruption_detection.start_reply_interruption_check(event.started_at)
+            self.speech_recognition.restart()
+        elif isinstance(event, ReplyAudioEnded):
+            latency_tracing.mark("reply_audio_ended")
+            self.interruption_detection.stop()
+            self.remember_reply()
+            if "🔚" in self.context.last()["content"]:
+                self.switch("waiting_for_wakeup")
+            else:
+                self.finish_reply()
+
+    async def next_frame(self, pcm: List[Any]):
         if self.state == "waiting_for_wakeup":
             self.waiting_for_wakeup(pcm)
             return
 
-        self.recording_audio_buffer.extend(struct.pack("h" * len(pcm), *pcm))
-        self.drop_early_recording_audio_frames()
+        features = extract_features(pcm)
+        self.recording_audio_buffer.extend(features.pcm)
+        self.shared_audio.write(features.pcm)
 
         if self.state == "waiting_for_silence":
-            self.waiting_for_silence(pcm)
+            self.waiting_for_silence(features)
 
         elif self.state == "start_reply":
-            start_reply_thread = Thread(target=self.start_reply_async)
-            start_reply_thread.start()
-            self.switch("replying")
+            await self.start_reply()
 
         elif self.state == "replying":
-            self.replying_loop(pcm)
+            self.replying_loop(features)
 
-    def start_reply_async(self):
-        transcription = self.speech_recognition.transcribe_and_stop()
+    async def start_reply(self):
+        self.spawn(self.start_reply_async())
+        self.switch("replying")
+
+    async def start_reply_async(self):
+        transcription = await self.loop.run_in_executor(
+            None, self.speech_recognition.transcribe_and_stop
+        )
+        latency_tracing.mark("transcription_ready")
         if (
             len(transcription.strip()) == 0
-            and self.conversation[-1]["role"] == "assistant"
+            and self.context.last()["role"] == "assistant"
         ):
             logger.info("Transcription too small, probably a mistake, bailing out")
+            self.cancel_speculations()
             self.switch("waiting_for_silence")
             return
 
         if self.state != "replying":
+            self.cancel_speculations()
             return  # probably got interrupted
 
+        cache_key = None
+        if self.reply_cache and len(transcription.strip()) > 0:
+            cache_key = self.reply_cache.key(
+                transcription, initial_message, self.context.last()
+            )
+
         if len(transcription.strip()) > 0:
             user_message: Message = {"role": "user", "content": transcription}
-            self.conversation.append(user_message)
-        self.recording_audio_buffer = self.recording_audio_buffer[-frame_length:]
+            self.context.append(user_message)
+        self.recording_audio_buffer.keep_last(frame_length)
+
+        self.reply_sent_at = time.time()
+        self.reply_latency = None
+        committed_prompt = (
+            self.speculative_replies.commit_matching(transcription)
+            if self.speculative_replies
+            else None
+        )
+        if committed_prompt is not None:
+            self.context.record_prompt(committed_prompt)
+            self.reply_cache_key = cache_key
+            return
 
-        self.chat_gpt.reply(self.conversation)
+        cached_reply = self.reply_cache.get(cache_key) if self.reply_cache else None
+        if cached_reply is not None:
+            self.reply_cache_key = None
+            self.chat_gpt.speak(cached_reply)
+        else:
+            self.reply_cache_key = cache_key
+            self.chat_gpt.reply(self.context.messages())
 
-    def transcribe_buffer(self):
-        self.speech_recognition.consume(self.recording_audio_buffer)
-        self.recording_audio_buffer = self.recording_audio_buffer[
-            -max(frame_length * 32 * 3, 0) :
-        ]
+    def remember_reply(self):
+        if self.reply_cache is None or self.reply_cache_key is None:
+            return
+        message = self.context.last()
+        if message["role"] == "assistant" and self.reply_latency is not None:
+            self.reply_cache.put(
+                self.reply_cache_key, message["content"], self.reply_latency
+            )
+        self.reply_cache_key = None
+
+    def start_speculation(self):
+        self.transcribe_buffer()
+        self.speculated_onset = self.speech_onsets
+        self.spawn(self.speculate(self.speech_onsets))
+
+    async def speculate(self, speech_onset: int):
+        partial_transcription = await self.loop.run_in_executor(
+            None, self.speech_recognition.partial_transcription
+        )
+        if not partial_transcription or len(partial_transcription.strip()) == 0:
+            return
+        if self.state != "waiting_for_silence" or self.speech_onsets != speech_onset:
+            return  # already replying, or the user started talking again
+
+        user_message: Message = {"role": "user", "content": partial_transcription}
+        if self.speculative_replies:
+            self.speculative_replies.start(
+                self.context.messages(record=False) + [user_message],
+                partial_transcription,
+            )
+
+    def cancel_speculations(self):
+        if self.speculative_replies:
+            self.speculative_replies.cancel_all()
 
-    def is_silence(self, pcm):
-        rms = calculate_volume(pcm)
-        return rms < silence_threshold
+    def open_reply_cache(self) -> ReplyCache:
+        return ReplyCache()
 
-    def drop_early_recording_audio_frames(self):
-        if len(self.recording_audio_buffer) > buffer_size_on_active_listening:
-            self.recording_audio_buffer = self.recording_audio_buffer[
-                frame_length:
-            ]  # drop early frames to keep just most recent audio
+    def prewarm_connections(self):
+        # the user is about to talk, so open the connections for transcription and the reply before they are needed
+        http_transport.prewarm()
+        self.chat_gpt.prewarm()
+
+    def transcribe_buffer(self):
+        # only the audio that is new since the last flush is sent, and only if there was some speech in it
+        if self.last_speech_at <= self.transcribed_until:
+            return
+        new_samples = self.recording_audio_buffer.written - self.transcribed_until
+        self.speech_recognition.consume(
+            self.recording_audio_buffer.snapshot_bytes(new_samples)
+        )
+        self.transcribed_until = self.recording_audio_buffer.written
+        self.recording_audio_buffer.keep_last(frame_length * 32 * 3)
+
+    def is_silence(self, features: FrameFeatures, adapt: bool = True):
+        return not self.vad.is_speech(features, adapt=adapt)
 
     def waiting_for_wakeup(self, pcm: List[Any]):
         if not self.porcupine:
@@ -193,15 +438,20 @@ class AudioRecording:
             return
 
         print(f"⚪️ Waiting for wake up word...", end="\r", flush=True)
+        model_residency.evict_idle()
         trigger = self.porcupine.process(pcm)
         if trigger >= 0:
             logger.info("Detected wakeup word #%s", trigger)
             self.wake_up()
 
-    def waiting_for_silence(self, pcm: List[Any]):
-        is_silence = self.is_silence(pcm)
+    def waiting_for_silence(self, features: FrameFeatures):
+        is_silence = self.is_silence(features)
         emoji = "🔈" if is_silence else "🔊"
-        print(f"🔴 {red}Listening... {emoji} {reset}", end="\r", flush=True)
+        print(
+            f"🔴 {red}Listening... {emoji} {reset}{features.speech_band_rms:>6.0f} / {self.vad.threshold():.0f}  ",
+            end="\r",
+            flush=True,
+        )
 
         if is_silence:
             self.silence_frame_count += 1
@@ -210,14 +460,27 @@ class AudioRecording:
                 and self.silence_frame_count >= silence_limit * 2
             ):
                 self.speaking_frame_count = 0
+            if (
+                self.speculative_replies
+                and self.silence_frame_count == speculation_pause
+                and self.speaking_frame_count >= speaking_minimum
+            ):
+                self.start_speculation()
         else:
+            if self.silence_frame_count > 0 or self.speaking_frame_count == 0:
+                self.speech_onsets += 1
+                # the user kept talking, the reply to what they said so far is stale
+                self.cancel_speculations()
             # Cut all empty audio from before to make it smaller
             if self.speaking_frame_count == 0:
-                self.recording_audio_buffer = self.recording_audio_buffer[
-                    -frame_length * 4 :
-                ]
+                self.recording_audio_buffer.keep_last(frame_length * 4)
+                self.prewarm_connections()
             self.speaking_frame_count += 1
             self.silence_frame_count = 0
+            self.last_speech_at = self.recording_audio_buffer.written
+
+        # after a speculation, there is nothing new to transcribe until the user speaks again
+        nothing_new = self.speculated_onset == self.speech_onsets
 
         transcription_flush_step = 1 * 32  # 1s of audio
         if (
@@ -225,6 +488,7 @@ class AudioRecording:
             and (self.silence_frame_count + self.speaking_frame_count)
             % transcription_flush_step
             == 0
+            and not nothing_new
         ):
             self.transcribe_buffer()
 
@@ -232,8 +496,10 @@ class AudioRecording:
             self.silence_frame_count >= silence_limit
             and self.speaking_frame_count >= speaking_minimum
         ):
+            latency_tracing.mark("speech_endpoint")
             logger.info("Detected silence a while after speaking, giving a reply")
-            self.transcribe_buffer()
+            if not nothing_new:
+                self.transcribe_buffer()
             self.switch("start_reply")
 
         if (
@@ -245,48 +511,89 @@ class AudioRecording:
             text_to_speech.play_audio_file("byebye.mp3")
             self.switch("waiting_for_wakeup")
 
-    def replying_loop(self, pcm: List[Any]):
-        try:
-            (action, data) = self.chat_gpt.get(block=False)
-            if action == "assistent_message":
-                self.conversation.append(data)
-            elif action == "reply_audio_started":
-                self.silence_frame_count = 0
-                self.speaking_frame_count = 0
-                self.interruption_detection.start_reply_interruption_check(data)
-                self.speech_recognition.restart()
-            elif action == "reply_audio_ended":
-                self.interruption_detection.stop()
-                if "🔚" in self.conversation[-1]["content"]:
-                    self.switch("waiting_for_wakeup")
-                    return
-        except Empty:
-            pass
+    def finish_reply(self):
+        self.recording_audio_buffer.keep_last(
+            frame_length * 2
+        )  # Capture the last couple frames for better follow up after assistant reply
+        self.speaking_frame_count = 0
+        self.switch("waiting_for_silence")
 
+    def replying_loop(self, features: FrameFeatures):
         if self.interruption_detection.is_done():
-            self.recording_audio_buffer = self.recording_audio_buffer[
-                -frame_length * 2 :
-            ]  # Capture the last couple frames for better follow up after assistant reply
-            self.speaking_frame_count = 0
-            self.switch("waiting_for_silence")
+            self.finish_reply()
         else:
-            is_silence = self.is_silence(pcm)
-            interrupted = self.interruption_detection.check_for_interruption(
-                pcm, is_silence
-            )
+            # don't let the assistant's own voice move the noise floor
+            is_silence = self.is_silence(features, adapt=False)
+            interrupted = self.interruption_detection.check_for_interruption(is_silence)
             if interrupted:
                 logger.info("Interrupted")
                 self.interruption_detection.stop()
+                self.cancel_speculations()
                 self.chat_gpt.restart()
                 # Capture the last few frames when interrupting the assistent, drop anything before that, since we don't want any echo feedbacks
-                # self.recording_audio_buffer = self.recording_audio_buffer[
-                #     -frame_length * 32 * 2 :
-                # ]
-                self.recording_audio_buffer = bytearray()
+                # self.recording_audio_buffer.keep_last(frame_length * 32 * 2)
+                self.recording_audio_buffer.clear()
                 self.speaking_frame_count = 0  # math.ceil(speaking_minimum)
                 self.switch("waiting_for_silence")
 
 
+class ReplayAudioRecording(AudioRecording):
+    report: ReplayReport
+
+    def __init__(self, recorder: FileRecorder, cli_args: argparse.Namespace) -> None:
+        self.report = ReplayReport(recorder)
+        super().__init__(
+            recorder,  # type: ignore
+            cli_args,
+            chat_gpt=ReplayChatGPT(self.report),  # type: ignore
+            speech_recognition_engine=ReplaySpeechRecognition(self.report),
+        )
+
+    def open_reply_cache(self) -> ReplyCache:
+        # in memory only, so a replay neither depends on nor changes the real cache
+        return ReplyCache(path=None)
+
+    def prewarm_connections(self):
+        pass  # no network calls when replaying
+
+    def switch(self, state: RecordingState):
+        previous_state = getattr(self, "state", "starting")
+        if state == "start_reply":
+            self.report.endpoint_detected(
+                self.speaking_frame_count, self.silence_frame_count
+            )
+        self.report.state_changed(previous_state, state)
+        super().switch(state)
+
+    def start_reply_event_pump(self):
+        pass
+
+    async def start_reply(self):
+        # Reply inline and handle its events right away instead of in the background, so the replay does not race
+        # ahead of the reply and stays deterministic
+        self.switch("replying")
+        await self.start_reply_async()
+        while True:
+            try:
+                turn_id, event = self.chat_gpt.get(block=False)
+            except Empty:
+                break
+            self.handle_reply_event(turn_id, event)
+
+
+def replay(cli_args: argparse.Namespace):
+    recorder = FileRecorder(cli_args.replay, frame_length)
+    audio_recording = ReplayAudioRecording(recorder, cli_args)
+    startup_profile.report()
+    try:
+        asyncio.run(audio_recording.run())
+    except ReplayFinished:
+        pass
+    finally:
+        audio_recording.stop()
+    audio_recording.report.print_summary()
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="BMO, the open-source voice assistant with replaceable parts"
@@ -295,10 +602,25 @@ def main():
         "-sr",
         "--speech-recognition",
         dest="speech_recognition",
-        choices=["whisper", "whisper-cpp", "lightning-whisper-mlx"],
+        choices=speech_recognition.ENGINES.keys(),
         default="whisper",
         help="Choose the speech recognition engine to be used, default to whisper",
     )
+    parser.add_argument(
+        "--upload-codec",
+        dest="upload_codec",
+        choices=["auto", *audio_codecs.codecs],
+        default="auto",
+        help="Audio format uploaded to the Whisper API, by default picked from the measured upload speed",
+    )
+    parser.add_argument(
+        "--model-memory-budget",
+        dest="model_memory_budget",
+        metavar="MB",
+        type=int,
+        default=None,
+        help="Unload the least recently used local speech recognition models when they take more memory than this, by default they are only unloaded after 30 minutes idle on standby",
+    )
     parser.add_argument(
         "-tts",
         "--text-to-speech",
@@ -307,26 +629,97 @@ def main():
         default="native",
         help="Choose the text-to-speech engine to be used, default to native",
     )
+    parser.add_argument(
+        "--reply-cache",
+        dest="reply_cache",
+        action="store_true",
+        help="Answer short utterances already seen in the same context from a local cache, without calling the LLM",
+    )
+    parser.add_argument(
+        "--speculative",
+        dest="speculative",
+        action="store_true",
+        help="Start streaming a reply to the partial transcription as soon as you pause, and only play it if the final transcription is the same",
+    )
+    parser.add_argument(
+        "--max-speculative",
+        dest="max_speculative",
+        type=int,
+        default=1,
+        help="How many speculative replies can be in flight at once, default to 1",
+    )
+    parser.add_argument(
+        "--replay",
+        dest="replay",
+        metavar="AUDIO_FILE",
+        default=None,
+        help="Replay an audio file through the listening loop as fast as possible, with recognition and replies stubbed out, and report frames/sec, state transitions and endpoints",
+    )
+    parser.add_argument(
+        "--low-memory",
+        dest="low_memory",
+        action="store_true",
+        help="Share more memory between the worker processes and run the interruption checker as a thread, for boards with 1 or 2GB",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        dest="startup_profile",
+        action="store_true",
+        help="Print how long each module took to import and each part of BMO took to initialize, once it's ready to listen",
+    )
+    parser.add_argument(
+        "--latency-report",
+        dest="latency_report",
+        metavar="JSON_FILE",
+        default=None,
+        help="Keep a JSON file updated with per-turn latencies and p50/p95/p99 for each stage, from end of speech to reply audio",
+    )
 
     cli_args = parser.parse_args()
+    if cli_args.upload_codec != "auto":
+        audio_codecs.preferred_codec = cli_args.upload_codec
+    if cli_args.model_memory_budget is not None:
+        model_residency.memory_budget = cli_args.model_memory_budget * 1024 * 1024
+    if cli_args.low_memory:
+        # The reply workers are forked from main, so what main imported before is shared with them copy-on-write,
+        # the TTS engine they use is imported ahead for that, and freezing the GC keeps the workers from writing to
+        # (and so copying) the pages of every object created so far when they collect
+        importlib.import_module(text_to_speech.ENGINES.module(cli_args.text_to_speech))
+        gc.collect()
+        gc.freeze()
 
     start_time: Synchronized = Value("d", time.time())  # type: ignore
     log_formatter.start_time = start_time
+    LatencyTracer(cli_args.latency_report).start()
+
+    if cli_args.replay:
+        replay(cli_args)
+        return
 
     recorder = PvRecorder(device_index=-1, frame_length=frame_length)
     audio_recording = AudioRecording(recorder, cli_args)
-    try:
-        while True:
-            audio_recording.next_frame()
-    except KeyboardInterrupt:
-        print("Stopping ...")
-        audio_recording.stop()
-        recorder.delete()
-    except:
-        recorder.delete()
-        logger.exception("Exception thrown, trying to restart in 5s...")
-        time.sleep(5)
-        main()
+    startup_profile.report()
+    # Restarts in a loop rather than by calling main() again, which would parse the arguments, freeze the GC and start
+    # the latency tracer once more, and the old workers, checker and shared audio ring are shut down first
+    while True:
+        try:
+            asyncio.run(audio_recording.run())
+            return
+        except KeyboardInterrupt:
+            print("Stopping ...")
+            audio_recording.stop()
+            recorder.delete()
+            return
+        except:
+            logger.exception("Exception thrown, trying to restart in 5s...")
+            try:
+                audio_recording.stop()
+            except Exception:
+                logger.exception("Failed to stop cleanly before restarting")
+            recorder.delete()
+            time.sleep(5)
+            recorder = PvRecorder(device_index=-1, frame_length=frame_length)
+            audio_recording = AudioRecording(recorder, cli_args)
 
 
 if __name__ == "__main__":
@@ -2,11 +2,11 @@
 
 set -eo pipefail
 
+# piper runs inside BMO, so the voice model is loaded only once
+pip install piper-tts==1.2.0
+
 mkdir -p piper
 cd piper
 
-wget https://github.com/rhasspy/piper/releases/download/v0.0.2/piper_arm64.tar.gz
-wget https://github.com/rhasspy/piper/releases/download/v0.0.2/voice-en-us-ryan-medium.tar.gz
-
-tar -xvf piper_arm64.tar.gz
-tar -xvf voice-en-us-ryan-medium.tar.gz
+wget https://huggingface.co/rhasspy/piper-voices/resolve/v1.0.0/en/en_US/ryan/medium/en_US-ryan-medium.onnx
+wget https://huggingface.co/rhasspy/piper-voices/resolve/v1.0.0/en/en_US/ryan/medium/en_US-ryan-medium.onnx.json